@@ -0,0 +1,1213 @@
+#!/usr/bin/env python3
+"""Бенчмарк docker-builder без докера и сети.
+
+Поднимает фейковый Docker Engine API на unix-сокете (сборка и пуш с задержкой, инвентарь образов и контейнеров),
+генерирует локальные git-репы (file://) и прогоняет настоящий main.Builder целиком: холодный запуск,
+запуск после новых комитов и запуск без изменений. Для каждого масштаба выводит время планирования,
+накладные расходы планировщика, время всего запуска и пик памяти.
+
+    ./benchmark.py                      # 5, 50, 200 и 1000 целей
+    ./benchmark.py -s 20 -s 100 --layout globs --json bench.json
+    ./benchmark.py --micro              # микробенчмарки: триггеры, prune, git-метаданные, CLI vs API (список и rm)
+    ./benchmark.py --plan 10000         # только планировщик: 10k целей в 1k репах, с бюджетом времени и памяти
+    ./benchmark.py --faults             # пуш против отказов демона: обрывы, 5xx, 401/404, ошибки в потоке
+    ./benchmark.py --registry           # manifest list против фейкового регистра: типы списков, Basic и Bearer
+    ./benchmark.py --nodes              # узлы сборки: локальный и два arm64v8, зависимые сборки на узле базы
+"""
+
+import argparse
+import base64
+import contextlib
+import hashlib
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import socket
+import socketserver
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import docker_builder
+import main
+
+LAYOUTS = ('context', 'files', 'globs', 'git')
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@localhost',
+    'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@localhost',
+}
+
+
+class FakeDockerState:
+    def __init__(self, build_latency: float, push_latency: float):
+        self.lock = threading.Lock()
+        self.build_latency = build_latency
+        self.push_latency = push_latency
+        # ид образа -> {'tags': set(реп:тег), 'size': байт}, и реп:тег -> ид образа
+        self.images = {}
+        self.tags = {}
+        # имя -> ид образа
+        self.containers = {}
+        # реп:тег -> отказы пуша по попыткам, см. PUSH_FAULTS
+        self.push_faults = {}
+        # Каталог общего для демонов регистра: файл на каждый реп:тег в нем. None - регистра нет, любой FROM
+        # и pull находятся
+        self.registry = None
+        self.requests = 0
+        self._count = 0
+
+    def add_image(self, tag: str, size: int = 50 << 20) -> str:
+        with self.lock:
+            self._count += 1
+            image_id = 'sha256:{}'.format(hashlib.sha256('{}\0{}'.format(tag, self._count).encode()).hexdigest())
+            self.untag(tag)
+            self.images[image_id] = {'tags': {tag}, 'size': size}
+            self.tags[tag] = image_id
+            return image_id
+
+    def tag(self, image_id: str, tag: str):
+        # под self.lock
+        self.untag(tag)
+        self.images[image_id]['tags'].add(tag)
+        self.tags[tag] = image_id
+
+    def untag(self, tag: str):
+        # под self.lock, образ без тегов удаляется
+        image_id = self.tags.pop(tag, None)
+        if image_id is not None:
+            self.images[image_id]['tags'].discard(tag)
+            if not self.images[image_id]['tags']:
+                del self.images[image_id]
+
+    def in_registry(self, image: str) -> bool:
+        return self.registry is None or os.path.exists(os.path.join(self.registry, urllib.parse.quote(image, '')))
+
+    def upload(self, image: str):
+        if self.registry is not None:
+            with open(os.path.join(self.registry, urllib.parse.quote(image, '')), 'w'):
+                pass
+
+    def next_fault(self, tag: str) -> str or None:
+        with self.lock:
+            faults = self.push_faults.get(tag)
+            return faults.pop(0) if faults else None
+
+    def find(self, name: str) -> str or None:
+        with self.lock:
+            if name in self.images:
+                return name
+            if name in self.tags:
+                return self.tags[name]
+            for image_id in self.images:
+                if image_id.startswith('sha256:' + name):
+                    return image_id
+        return None
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def handle(self):
+        # Клиент может бросить keep-alive соединение после ошибки сборки
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    @property
+    def state(self) -> FakeDockerState:
+        return self.server.state
+
+    def _path(self) -> tuple:
+        url = urllib.parse.urlsplit(self.path)
+        with self.state.lock:
+            self.state.requests += 1
+        return re.sub(r'^/v[\d.]+', '', url.path), urllib.parse.parse_qs(url.query)
+
+    def _send(self, code: int, body=b''):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, chunks, delay: float = 0, drop: bool = False):
+        # docker-py читает потоки сборки и пуша только как chunked. drop - оборвать соединение посреди потока
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in chunks[:len(chunks) // 2] if drop else chunks:
+                if delay:
+                    time.sleep(delay)
+                data = json.dumps(chunk).encode() + b'\r\n'
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            if drop:
+                self.wfile.flush()
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+                return
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент ушел, прочитав ошибку
+            self.close_connection = True
+
+    def _body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        path, _ = self._path()
+        state = self.state
+        if path == '/_ping':
+            return self._send(200, b'OK')
+        if path == '/version':
+            return self._send(200, {'ApiVersion': '1.41', 'Version': '20.10.0'})
+        if path == '/info':
+            return self._send(200, {'DockerRootDir': self.server.root_dir})
+        if path == '/images/json':
+            with state.lock:
+                images = [{'Id': i, 'RepoTags': sorted(image['tags']) or None, 'Size': image['size']}
+                          for i, image in state.images.items()]
+            return self._send(200, images)
+        if path == '/containers/json':
+            with state.lock:
+                containers = [{'Id': name, 'Names': ['/' + name], 'ImageID': image_id, 'Image': image_id}
+                              for name, image_id in state.containers.items()]
+            return self._send(200, containers)
+        match = re.match(r'/images/(.+)/json$', path)
+        if match:
+            image_id = state.find(urllib.parse.unquote(match.group(1)))
+            if image_id is None:
+                return self._send(404, {'message': 'No such image'})
+            with state.lock:
+                image = state.images[image_id]
+                return self._send(200, {'Id': image_id, 'RepoTags': sorted(image['tags']), 'Size': image['size']})
+        self._send(404, {'message': 'page not found'})
+
+    def do_DELETE(self):
+        path, _ = self._path()
+        state = self.state
+        match = re.match(r'/images/(.+)$', path)
+        if match:
+            name = urllib.parse.unquote(match.group(1))
+            with state.lock:
+                if name not in state.tags:
+                    return self._send(404, {'message': 'No such image: {}'.format(name)})
+                state.untag(name)
+            return self._send(200, [{'Untagged': name}])
+        match = re.match(r'/containers/(.+)$', path)
+        if match:
+            with state.lock:
+                state.containers.pop(match.group(1), None)
+            return self._send(204)
+        self._send(404, {'message': 'page not found'})
+
+    def do_POST(self):
+        path, query = self._path()
+        body = self._body()
+        state = self.state
+        if path == '/auth':
+            return self._send(200, {'Status': 'Login Succeeded'})
+        if path == '/_bench/requests':
+            with state.lock:
+                requests, state.requests = state.requests - 1, 0
+            return self._send(200, {'requests': requests})
+        if path == '/build':
+            return self._build(query, body)
+        if path.endswith('/prune'):
+            return self._send(200, {})
+        if path == '/images/create':
+            return self._pull(query.get('fromImage', [''])[0], query.get('tag', ['latest'])[0])
+        match = re.match(r'/images/(.+)/push$', path)
+        if match:
+            return self._push(urllib.parse.unquote(match.group(1)), query.get('tag', ['latest'])[0])
+        match = re.match(r'/images/(.+)/tag$', path)
+        if match:
+            image_id = state.find(urllib.parse.unquote(match.group(1)))
+            if image_id is None:
+                return self._send(404, {'message': 'No such image'})
+            with state.lock:
+                state.tag(image_id, '{}:{}'.format(query['repo'][0], query.get('tag', ['latest'])[0]))
+            return self._send(201)
+        if re.match(r'/containers/(.+)/stop$', path):
+            return self._send(204)
+        self._send(404, {'message': 'page not found'})
+
+    def _build(self, query: dict, context: bytes):
+        tag = query.get('t', [''])[0]
+        nocache = query.get('nocache', ['False'])[0].lower() in ('1', 'true')
+        steps = ['FROM alpine', 'COPY src/ /app/src/', 'RUN make']
+        chunks = []
+        for image in _context_froms(context, query.get('dockerfile', ['Dockerfile'])[0]):
+            if self.state.find(image) is not None:
+                continue
+            if not self.state.in_registry(image):
+                # Как настоящий демон: базы нет ни здесь, ни в регистре
+                message = 'pull access denied for {}, repository does not exist'.format(image)
+                return self._stream([{'errorDetail': {'message': message}, 'error': message}])
+            if self.state.registry is not None:
+                self.state.add_image(image)
+        for num, step in enumerate(steps, 1):
+            chunks.append({'stream': 'Step {}/{} : {}\n'.format(num, len(steps), step)})
+            if num == 1 or not nocache and num == 2:
+                chunks.append({'stream': ' ---> Using cache\n'})
+            else:
+                chunks.append({'stream': ' ---> Running in 0123456789ab\nbuilt {} bytes of context\n'.format(
+                    len(context))})
+            chunks.append({'stream': ' ---> 0123456789ab\n'})
+        image_id = self.state.add_image(tag)
+        chunks.append({'aux': {'ID': image_id}})
+        chunks.append({'stream': 'Successfully built {}\n'.format(image_id[7:19])})
+        self._stream(chunks, self.state.build_latency / len(chunks))
+
+    def _pull(self, repository: str, tag: str):
+        image = '{}{}{}'.format(repository, '@' if tag.startswith('sha256:') else ':', tag)
+        if self.state.find(image) is None:
+            if not self.state.in_registry(image):
+                return self._send(404, {'message': 'manifest for {} not found: manifest unknown'.format(image)})
+            self.state.add_image(image)
+        digest = 'sha256:{}'.format(hashlib.sha256(image.encode()).hexdigest())
+        chunks = [{'status': 'Pulling from {}'.format(repository), 'id': tag}, {'status': 'Digest: {}'.format(digest)}]
+        self._stream(chunks, self.state.push_latency / len(chunks))
+
+    def _push(self, repository: str, tag: str):
+        fault = self.state.next_fault('{}:{}'.format(repository, tag))
+        if fault in PUSH_FAULT_HTTP:
+            # Демон отвечает ошибкой до начала потока
+            return self._send(PUSH_FAULT_HTTP[fault][0], {'message': PUSH_FAULT_HTTP[fault][1]})
+        layers = ['{:012x}'.format(n) for n in range(3)]
+        chunks = [{'status': 'The push refers to repository [docker.io/{}]'.format(repository)}]
+        chunks.extend({'status': 'Preparing', 'progressDetail': {}, 'id': layer} for layer in layers)
+        # Первый слой - общий базовый, он уже в регистре
+        chunks.append({'status': 'Layer already exists', 'progressDetail': {}, 'id': layers[0]})
+        for layer in layers[1:]:
+            chunks.append({'status': 'Pushing', 'progressDetail': {'current': 1 << 20, 'total': 2 << 20}, 'id': layer})
+            chunks.append({'status': 'Pushed', 'progressDetail': {}, 'id': layer})
+        digest = 'sha256:{}'.format(hashlib.sha256('{}:{}'.format(repository, tag).encode()).hexdigest())
+        if fault in PUSH_FAULT_STREAM:
+            chunks.append({'errorDetail': {'message': PUSH_FAULT_STREAM[fault]}, 'error': PUSH_FAULT_STREAM[fault]})
+        else:
+            chunks.append({'status': '{}: digest: {} size: 1234'.format(tag, digest)})
+            chunks.append({'progressDetail': {}, 'aux': {'Tag': tag, 'Digest': digest, 'Size': 1234}})
+            if fault != 'drop':
+                self.state.upload('{}:{}'.format(repository, tag))
+        self._stream(chunks, self.state.push_latency / len(chunks), fault == 'drop')
+
+
+def _context_froms(context: bytes, dockerfile: str) -> list:
+    # Образы из FROM докерфайла в контексте сборки (tar, возможно gzip), без стадий и scratch
+    try:
+        with tarfile.open(fileobj=io.BytesIO(context)) as tar:
+            text = tar.extractfile(dockerfile).read().decode('utf8', 'replace')
+    except (tarfile.TarError, KeyError, AttributeError):
+        return []
+    images, stages = [], {'scratch'}
+    for line in text.splitlines():
+        args = [arg for arg in line.split() if not arg.startswith('--')]
+        if len(args) < 2 or args[0].upper() != 'FROM':
+            continue
+        if args[1] not in stages:
+            tagged = '@' in args[1] or ':' in args[1].rsplit('/', 1)[-1]
+            images.append(args[1] if tagged else args[1] + ':latest')
+        if len(args) > 3 and args[2].upper() == 'AS':
+            stages.add(args[3])
+    return images
+
+
+# Отказы фейкового пуша: HTTP-ответ до начала потока, ошибка внутри потока, 'drop' - обрыв соединения
+PUSH_FAULT_HTTP = {
+    'http401': (401, 'unauthorized: authentication required'),
+    'http404': (404, 'An image does not exist locally with the tag: bench/missing'),
+    'http500': (500, 'Get https://registry-1.docker.io/v2/: net/http: request canceled'),
+}
+PUSH_FAULT_STREAM = {
+    'stream503': 'received unexpected HTTP status: 503 Service Unavailable',
+    'denied': 'denied: requested access to the resource is denied',
+}
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, path: str, root_dir: str, state: FakeDockerState):
+        super().__init__(path, FakeDockerHandler)
+        self.root_dir = root_dir
+        self.state = state
+
+
+def _serve(path: str, root_dir: str, build_latency: float, push_latency: float, images: list, inventory: int,
+           containers: int, push_faults: dict, registry: str or None):
+    state = FakeDockerState(build_latency, push_latency)
+    state.push_faults = push_faults
+    state.registry = registry
+    for tag in images:
+        state.add_image(tag)
+    # Чужие образы и контейнеры на них, которые docker_prune должен просмотреть и не тронуть
+    ids = [state.add_image('inventory/image{}:latest'.format(n)) for n in range(inventory)]
+    for n in range(containers if ids else 0):
+        state.containers['inventory{}'.format(n)] = ids[n % len(ids)]
+    FakeDockerServer(path, root_dir, state).serve_forever()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__('localhost')
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+class FakeDocker:
+    """Docker Engine API на unix-сокете, ровно то, что использует docker_builder.
+    Работает в отдельном процессе, как и настоящий демон, чтобы не делить с builder'ом GIL.
+    containers - контейнеров на чужих образах, по умолчанию на каждый десятый.
+    push_faults - {реп:тег: [отказ или None на каждую попытку пуша]}, см. PUSH_FAULT_HTTP и PUSH_FAULT_STREAM.
+    registry - каталог регистра, общего для нескольких демонов: пуш кладет туда образ, а pull и FROM находят
+    только то, что есть локально или в нем."""
+    def __init__(self, path: str, root_dir: str, build_latency: float = 0.05, push_latency: float = 0.02,
+                 images: list = None, inventory: int = 0, containers: int = None, push_faults: dict = None,
+                 registry: str = None):
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self._process = multiprocessing.get_context('spawn').Process(
+            target=_serve, daemon=True, args=(
+                path, root_dir, build_latency, push_latency, images or [], inventory,
+                inventory // 10 if containers is None else containers, push_faults or {}, registry
+            )
+        )
+        self._process.start()
+        # Файл сокета появляется до listen(), ждем, пока он начнет принимать соединения
+        while True:
+            if not self._process.is_alive():
+                raise RuntimeError('Fake docker died')
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(path)
+                break
+            except OSError:
+                time.sleep(0.01)
+
+    @property
+    def url(self) -> str:
+        return 'unix://' + self.path
+
+    def requests(self) -> int:
+        # Сколько запросов к API было с прошлого вызова
+        conn = _UnixConnection(self.path)
+        try:
+            conn.request('POST', '/_bench/requests')
+            return json.loads(conn.getresponse().read())['requests']
+        finally:
+            conn.close()
+
+    def close(self):
+        self._process.terminate()
+        self._process.join()
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, body=b'', headers: dict = None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        for key, value in dict({'Content-Type': 'application/json'}, **(headers or {})).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        # Basic - логин в каждом запросе, Bearer - токен из /token, живущий token_uses запросов
+        server = self.server
+        auth = self.headers.get('Authorization', '')
+        with server.lock:
+            server.logins += auth.startswith('Basic ')
+        if server.auth == 'basic':
+            if auth == 'Basic {}'.format(server.basic()):
+                return True
+            challenge = 'Basic realm="fake"'
+        else:
+            token = auth[7:] if auth.startswith('Bearer ') else None
+            with server.lock:
+                uses = server.tokens.get(token)
+                if uses is not None and (not server.token_uses or uses < server.token_uses):
+                    server.tokens[token] += 1
+                    return True
+            challenge = 'Bearer realm="http://{}/token",service="fake"'.format(server.host)
+        self._send(401, {'errors': [{'code': 'UNAUTHORIZED'}]}, {'WWW-Authenticate': challenge})
+        return False
+
+    def _token(self, query: dict):
+        server = self.server
+        with server.lock:
+            server.token_requests.append(query.get('scope', [''])[0])
+            server.logins += self.headers.get('Authorization', '').startswith('Basic ')
+            if self.headers.get('Authorization', '') != 'Basic {}'.format(server.basic()):
+                return self._send(401, {'details': 'incorrect username or password'})
+            token = 'token{}'.format(len(server.token_requests))
+            server.tokens[token] = 0
+        self._send(200, {'token': token})
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/token':
+            return self._token(urllib.parse.parse_qs(url.query))
+        if not self._authorized():
+            return
+        server = self.server
+        match = re.match(r'/v2/(.+)/(manifests|blobs)/([^/]+)$', url.path)
+        with server.lock:
+            found = match and server.objects.get((match.group(1), match.group(3)))
+        if not found:
+            return self._send(404, {'errors': [{'code': 'MANIFEST_UNKNOWN'}]})
+        media_type, body = found
+        self._send(200, body, {'Content-Type': media_type, 'Docker-Content-Digest': _sha256(body)})
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self._authorized():
+            return
+        match = re.match(r'/v2/(.+)/manifests/([^/]+)$', self.path)
+        if not match:
+            return self._send(404, {'errors': [{'code': 'NAME_UNKNOWN'}]})
+        self.server.put(match.group(1), match.group(2), self.headers.get('Content-Type'), body)
+        self._send(201, b'', {'Docker-Content-Digest': _sha256(body)})
+
+
+class FakeRegistry(ThreadingHTTPServer):
+    """Docker Registry HTTP API v2 на 127.0.0.1: манифесты, блобы конфигов и авторизация по вызову.
+    auth - 'basic' или 'bearer', token_uses - через сколько запросов токен протухает (0 - никогда)."""
+    daemon_threads = True
+
+    def __init__(self, auth: str = 'bearer', credentials: tuple = ('bench', 'password'), token_uses: int = 0):
+        super().__init__(('127.0.0.1', 0), FakeRegistryHandler)
+        self.host = '127.0.0.1:{}'.format(self.server_address[1])
+        self.auth = auth
+        self.credentials = credentials
+        self.token_uses = token_uses
+        self.lock = threading.Lock()
+        # (реп, тег или digest) -> (media type, тело), токен -> сколько раз использован, scope запросов токена
+        # и сколько запросов пришло с логином и паролем
+        self.objects = {}
+        self.tokens = {}
+        self.token_requests = []
+        self.logins = 0
+        threading.Thread(target=self.serve_forever, name='registry', daemon=True).start()
+
+    def basic(self) -> str:
+        return base64.b64encode('{}:{}'.format(*self.credentials).encode()).decode()
+
+    def put(self, repository: str, reference: str, media_type: str, body: bytes) -> str:
+        digest = _sha256(body)
+        with self.lock:
+            for ref in (reference, digest):
+                self.objects[(repository, ref)] = (media_type, body)
+        return digest
+
+    def manifest(self, repository: str, reference: str) -> tuple:
+        # -> (media type, разобранное тело) или (None, None)
+        with self.lock:
+            media_type, body = self.objects.get((repository, reference), (None, b'null'))
+        return media_type, json.loads(body)
+
+    def add_image(self, repository: str, tag: str, arch: str, variant: str = None, oci: bool = False) -> dict:
+        # Образ из конфига без слоев, вернет его дескриптор для списков
+        config = {'architecture': arch, 'os': 'linux'}
+        if variant:
+            config['variant'] = variant
+        config = json.dumps(config).encode()
+        config_digest = self.put(repository, _sha256(config), 'application/octet-stream', config)
+        media_type = docker_builder.OCI_MANIFEST if oci else docker_builder.DOCKER_MANIFEST
+        body = json.dumps({
+            'schemaVersion': 2, 'mediaType': media_type, 'layers': [],
+            'config': {'mediaType': 'application/vnd.docker.container.image.v1+json', 'digest': config_digest,
+                       'size': len(config)},
+        }).encode()
+        platform_ = json.loads(config)
+        return {'mediaType': media_type, 'size': len(body), 'digest': self.put(repository, tag, media_type, body),
+                'platform': platform_}
+
+    def add_index(self, repository: str, tag: str, manifests: list, oci: bool = True):
+        media_type = docker_builder.OCI_INDEX if oci else docker_builder.DOCKER_MANIFEST_LIST
+        body = json.dumps({'schemaVersion': 2, 'mediaType': media_type, 'manifests': manifests}).encode()
+        self.put(repository, tag, media_type, body)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _sha256(data: bytes) -> str:
+    return 'sha256:{}'.format(hashlib.sha256(data).hexdigest())
+
+
+def _git(path: str, *args) -> str:
+    run = subprocess.run(
+        ['git', '-C', path] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=dict(os.environ, **GIT_ENV)
+    )
+    if run.returncode:
+        raise RuntimeError('git {}: {}'.format(' '.join(args), run.stderr.decode()))
+    return run.stdout.decode()
+
+
+def _write(path: str, data: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(data)
+
+
+def _commit(path: str, message: str):
+    _git(path, 'add', '-A')
+    _git(path, 'commit', '-q', '-m', message)
+
+
+def make_fixtures(root: str, count: int, builds: int, files: int, layout: str) -> tuple:
+    """Создаст одинаковые репы по builds докерфайлов (в последнем может быть меньше) и files исходников,
+    всего count целей сборки. Вернет (targets, git_triggers, пути репов) в формате TARGETS и GIT_TRIGGERS."""
+    template = os.path.join(root, 'template')
+    os.makedirs(template)
+    _git(template, 'init', '-q')
+    for n in range(builds):
+        _write(os.path.join(template, 'Dockerfile.svc{}'.format(n)),
+               'FROM alpine\nCOPY src/ /app/src/\nCOPY app.py /app/\nRUN make\n')
+    for n in range(files):
+        _write(os.path.join(template, 'src', 'module{}.py'.format(n)), 'VALUE = {}\n'.format(n))
+    _write(os.path.join(template, 'app.py'), 'print("app")\n')
+    _write(os.path.join(template, 'entrypoint.sh'), '#!/bin/sh\nexec python app.py\n')
+    _write(os.path.join(template, 'docs', 'README.md'), 'docs\n')
+    _write(os.path.join(template, '.dockerignore'), 'docs\n*.md\n')
+    _commit(template, 'init')
+    _git(template, 'tag', '-a', '-m', '0.1.0', '0.1.0')
+    triggers = {
+        'context': [],
+        'files': ['entrypoint.sh'],
+        'globs': ['**/*.sh', 'docs/*'],
+        'git': ['entrypoint.sh', '*shared'],
+    }[layout]
+    git_triggers = {}
+    if layout == 'git':
+        shared = os.path.join(root, 'shared')
+        shutil.copytree(template, shared)
+        git_triggers['shared'] = {'git': 'file://' + shared, 'triggers': {'shared': ['src/*', '**/*.sh']}}
+    targets, paths = [], []
+    for n in range((count + builds - 1) // builds):
+        path = os.path.join(root, 'origin', 'repo{}'.format(n))
+        shutil.copytree(template, path)
+        paths.append(path)
+        targets.append({
+            'git': 'file://' + path,
+            'dir': 'repo{}'.format(n),
+            'targets': [{
+                'registry': 'repo{}'.format(n),
+                'triggers': triggers,
+                'build': [['Dockerfile.svc{}'.format(b), 'svc{}-{{tag}}'.format(b)]
+                          for b in range(min(builds, count - n * builds))],
+            }],
+        })
+    return targets, git_triggers, paths
+
+
+def churn(paths: list, fraction: float, commits: int, files: int, rng: random.Random) -> int:
+    # Новые комиты в части репов: правки исходников из контекста и документации вне его
+    changed = rng.sample(paths, max(1, int(len(paths) * fraction))) if fraction else []
+    for path in changed:
+        for n in range(commits):
+            target = os.path.join(path, 'src', 'module{}.py'.format(rng.randrange(files)))
+            with open(target, 'a', encoding='utf8') as f:
+                f.write('# churn {}\n'.format(n))
+            with open(os.path.join(path, 'docs', 'README.md'), 'a', encoding='utf8') as f:
+                f.write('churn {}\n'.format(n))
+            _commit(path, 'churn {}'.format(n))
+    return len(changed)
+
+
+class BenchBuilder(main.Builder):
+    # Настоящий Builder, плюс время, проведенное в самом планировщике задач
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.sched_time = 0.0
+
+    def _schedule(self):
+        work_time = time.perf_counter()
+        super()._schedule()
+        self.sched_time += time.perf_counter() - work_time
+
+    def _complete(self, worker):
+        work_time = time.perf_counter()
+        super()._complete(worker)
+        self.sched_time += time.perf_counter() - work_time
+
+
+def run_builder(cfg: dict, targets: list, git_triggers: dict, memory: bool) -> dict:
+    args = argparse.Namespace(v=False, nope=False, force=False, trace=None, profile=None, daemon=False)
+    builder = BenchBuilder(dict(cfg), targets, git_triggers, args, None)
+    if memory:
+        tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            builder.start()
+        peak = tracemalloc.get_traced_memory()[1] if memory else 0
+    finally:
+        if memory:
+            tracemalloc.stop()
+    report = docker_builder.metrics.report()
+    phases = report['phases']
+    tasks = report['tasks']
+    return {
+        'built': len([t for t in tasks if t['stage'] == 'build' and t['ok']]),
+        'failed': len([t for t in tasks if not t['ok']]),
+        'sync': phases.get('sync', {}).get('seconds', 0),
+        'plan': phases.get('plan', {}).get('seconds', 0),
+        'sched': builder.sched_time,
+        'makespan': report['finished'] - report['started'],
+        'peak_mb': peak / (1 << 20),
+    }
+
+
+def bench_scale(scale: int, cli, tmp: str) -> list:
+    root = os.path.join(tmp, 'scale{}'.format(scale))
+    work_dir = os.path.join(root, 'work')
+    os.makedirs(work_dir)
+    with open(os.path.join(work_dir, '.docker_credentials'), 'w') as f:
+        f.write('bench password\n')
+    targets, git_triggers, paths = make_fixtures(root, scale, cli.builds, cli.files, cli.layout)
+    daemon = FakeDocker(
+        os.path.join(root, 'docker.sock'), root, cli.build_latency, cli.push_latency, inventory=cli.inventory
+    )
+    os.environ['DOCKER_HOST'] = daemon.url
+    cfg = dict(
+        main.CFG, work_dir=work_dir, arch_detect=False, max_build_t=cli.build_t, max_push_t=cli.push_t,
+        max_sync_t=cli.sync_t, disk_watermark=0, build_timings='', metrics='', metrics_prom='',
+    )
+    rng = random.Random(scale)
+    rows = []
+    try:
+        for run in ('cold', 'churn', 'idle'):
+            changed = churn(paths, cli.churn, cli.commits, cli.files, rng) if run == 'churn' else 0
+            result = run_builder(cfg, targets, git_triggers, not cli.no_memory)
+            result.update(scale=scale, run=run, repos_changed=changed, requests=daemon.requests())
+            rows.append(result)
+            print_row(result)
+    finally:
+        daemon.close()
+        os.environ.pop('DOCKER_HOST', None)
+    return rows
+
+
+def print_row(row: dict or None):
+    if row is None:
+        print('{:>7} {:>6} {:>6} {:>6} {:>8} {:>8} {:>9} {:>9} {:>8} {:>8}'.format(
+            'targets', 'run', 'built', 'failed', 'sync s', 'plan s', 'sched ms', 'makespan', 'peak MB', 'api req'))
+        return
+    print('{scale:>7} {run:>6} {built:>6} {failed:>6} {sync:>8.3f} {plan:>8.3f} {sched_ms:>9.1f} {makespan:>9.3f} '
+          '{peak_mb:>8.1f} {requests:>8}'.format(sched_ms=row['sched'] * 1000, **row))
+
+
+def print_plan_row(row: dict or None):
+    if row is None:
+        print('{:>7} {:>6} {:>6} {:>7} {:>8} {:>8} {:>9} {:>8}  {}'.format(
+            'targets', 'repos', 'run', 'planned', 'sync s', 'plan s', 'us/target', 'peak MB', 'budget'))
+        return
+    print('{targets:>7} {repos:>6} {run:>6} {planned:>7} {sync:>8.3f} {plan:>8.3f} {per_target:>9.1f} {peak_mb:>8.1f}  '
+          '{budget}'.format(per_target=row['plan'] / row['targets'] * 1e6, **row))
+
+
+def bench_plan(count: int, cli, tmp: str) -> list:
+    # Только планировщик: count целей в cli.plan_repos репах. Время планирования без синхронизации репов
+    # и пик памяти Python должны уложиться в бюджет
+    repos = min(cli.plan_repos, count)
+    root = os.path.join(tmp, 'plan{}'.format(count))
+    work_dir = os.path.join(root, 'work')
+    os.makedirs(work_dir)
+    with open(os.path.join(work_dir, '.docker_credentials'), 'w') as f:
+        f.write('bench password\n')
+    targets, git_triggers, paths = make_fixtures(root, count, (count + repos - 1) // repos, cli.files, cli.layout)
+    daemon = FakeDocker(os.path.join(root, 'docker.sock'), root, 0, 0)
+    os.environ['DOCKER_HOST'] = daemon.url
+    cfg = dict(
+        main.CFG, work_dir=work_dir, arch_detect=False, max_sync_t=cli.sync_t, metrics='', metrics_prom='',
+        build_timings='',
+    )
+    args = argparse.Namespace(v=False, nope=True, force=False, trace=None, profile=None, daemon=False)
+    rng = random.Random(count)
+    rows = []
+    try:
+        for run in ('cold', 'churn', 'idle'):
+            if run == 'churn':
+                churn(paths, cli.churn, cli.commits, cli.files, rng)
+            docker_builder.metrics.reset()
+            if not cli.no_memory:
+                tracemalloc.start()
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    planner = docker_builder.GenerateBuilds(dict(cfg), targets, git_triggers, args)
+                    plans = planner.get()[0]
+                peak = tracemalloc.get_traced_memory()[1] if not cli.no_memory else 0
+            finally:
+                if not cli.no_memory:
+                    tracemalloc.stop()
+            # Следующий запуск должен видеть эти сборки завершенными
+            for plan in plans:
+                planner.done(plan.name)
+            phases = docker_builder.metrics.report()['phases']
+            sync = phases.get('sync', {}).get('seconds', 0)
+            row = dict(
+                targets=count, repos=len(paths), run=run, planned=len(plans), sync=sync,
+                plan=phases.get('plan', {}).get('seconds', 0) - sync, peak_mb=peak / (1 << 20),
+            )
+            over = [name for name, over in (('time', row['plan'] > cli.plan_budget),
+                                            ('memory', row['peak_mb'] > cli.plan_memory)) if over]
+            row['budget'] = 'over: {}'.format(', '.join(over)) if over else 'ok'
+            rows.append(row)
+            print_plan_row(row)
+    finally:
+        docker_builder.docker_logout()
+        daemon.close()
+        os.environ.pop('DOCKER_HOST', None)
+    return rows
+
+
+# Сценарии отказов пуша: имя, отказы по попыткам, должен ли пуш пройти и за сколько попыток (из PUSH_RETRIES)
+PUSH_RETRIES = 4
+PUSH_CASES = (
+    ('clean', [], True, 1),
+    ('dropped connection', ['drop'], True, 2),
+    ('daemon 500', ['http500'], True, 2),
+    ('registry 503 in stream, then drop', ['stream503', 'drop'], True, 3),
+    ('unauthorized before stream', ['http401'], False, 1),
+    ('no such image', ['http404'], False, 1),
+    ('denied in stream', ['denied'], False, 1),
+    ('dropped every time', ['drop'] * PUSH_RETRIES, False, PUSH_RETRIES),
+)
+
+
+def bench_push_faults(tmp: str) -> list:
+    # Движок пуша против фейкового демона с отказами: что повторяется с задержкой, а что падает сразу
+    root = os.path.join(tmp, 'faults')
+    os.makedirs(root)
+    tags = ['bench/fault{}:latest'.format(n) for n in range(len(PUSH_CASES))]
+    faults = {tag: list(case[1]) for tag, case in zip(tags, PUSH_CASES)}
+    daemon = FakeDocker(os.path.join(root, 'docker.sock'), root, 0, 0, images=tags, push_faults=faults)
+    os.environ['DOCKER_HOST'] = daemon.url
+    events = queue.Queue()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            workers = [docker_builder.Push(tag, events, retries=PUSH_RETRIES, backoff=0.01) for tag in tags]
+            for worker in workers:
+                worker.join()
+    finally:
+        docker_builder.docker_logout()
+        daemon.close()
+        os.environ.pop('DOCKER_HOST', None)
+    rows = []
+    print('{:<36} {:>8} {:>8}  {}'.format('push fault', 'result', 'attempts', 'check'))
+    for (name, _, ok, attempts), worker in zip(PUSH_CASES, workers):
+        row = dict(case=name, ok=not worker.status(), attempts=worker.attempts, err=worker.err)
+        expected = 'ok' if ok else 'failed'
+        row['check'] = 'ok' if (row['ok'], row['attempts']) == (ok, attempts) else \
+            'expected {} in {}: {}'.format(expected, attempts, worker.err[:60])
+        print('{:<36} {:>8} {:>8}  {}'.format(name, 'ok' if row['ok'] else 'failed', row['attempts'], row['check']))
+        rows.append(row)
+    return rows
+
+
+# Платформы образов в FakeRegistry: (architecture, variant)
+AMD64, ARM64, ARM = ('amd64', None), ('arm64', 'v8'), ('arm', 'v7')
+REGISTRY_LOGIN = {'username': 'bench', 'password': 'password'}
+REGISTRY_CASES = (
+    # имя, параметры FakeRegistry, теги: (платформа, OCI ли) или список таких (тег - сам список, с аттестацией),
+    # логин, тип публикуемого списка или None, если публикация должна упасть, сколько раз получить токен (минимум)
+    ('docker images -> manifest list', {}, {'amd64': (AMD64, False), 'arm64v8': (ARM64, False)},
+     REGISTRY_LOGIN, docker_builder.DOCKER_MANIFEST_LIST, 1),
+    ('oci images -> oci index', {}, {'amd64': (AMD64, True), 'arm64v8': (ARM64, True)},
+     REGISTRY_LOGIN, docker_builder.OCI_INDEX, 1),
+    ('docker + oci -> manifest list', {}, {'amd64': (AMD64, True), 'arm64v8': (ARM64, False)},
+     REGISTRY_LOGIN, docker_builder.DOCKER_MANIFEST_LIST, 1),
+    ('list + image -> flat list', {}, {'multi': [(AMD64, True), (ARM64, True)], 'arm32v7': (ARM, True)},
+     REGISTRY_LOGIN, docker_builder.OCI_INDEX, 1),
+    ('basic auth', {'auth': 'basic'}, {'amd64': (AMD64, False), 'arm32v7': (ARM, False)},
+     REGISTRY_LOGIN, docker_builder.DOCKER_MANIFEST_LIST, 0),
+    ('bearer token expires -> re-auth', {'token_uses': 2}, {'amd64': (AMD64, False), 'arm64v8': (ARM64, False)},
+     REGISTRY_LOGIN, docker_builder.DOCKER_MANIFEST_LIST, 3),
+    ('bearer, wrong password', {}, {'amd64': (AMD64, False)}, dict(REGISTRY_LOGIN, password='wrong'), None, 1),
+    ('basic, no credentials', {'auth': 'basic'}, {'amd64': (AMD64, False)}, {}, None, 0),
+    # Не Docker Hub: логин от хаба туда не уходит
+    ('third-party bearer, no hub login', {'hub': False}, {'amd64': (AMD64, False)}, REGISTRY_LOGIN, None, 0),
+    ('third-party basic, no hub login', {'hub': False, 'auth': 'basic'}, {'amd64': (AMD64, False)},
+     REGISTRY_LOGIN, None, 0),
+)
+REGISTRY_NAMES = ['latest', '1.0']
+
+
+def bench_registry() -> list:
+    # ManifestPush против FakeRegistry: какой тип списка публикуется, как разворачиваются списки в тегах,
+    # авторизация Basic и Bearer, новый токен после 401 на протухший. Логин docker_builder - от Docker Hub,
+    # так что регистр по умолчанию изображает хаб, а с 'hub': False - сторонний регистр
+    rows = []
+    print('{:<36} {:>8}  {}'.format('registry case', 'result', 'check'))
+    for name, params, images, login, media_type, tokens in REGISTRY_CASES:
+        params = dict(params)
+        hub = params.pop('hub', True)
+        registry = FakeRegistry(**params)
+        repository = 'bench/app'
+        platforms = []
+        for tag, image in images.items():
+            if isinstance(image, list):
+                manifests = [registry.add_image(repository, '', arch, variant, oci) for (arch, variant), oci in image]
+                # Аттестация buildx, в список попасть не должна
+                manifests.append({'mediaType': docker_builder.OCI_MANIFEST, 'digest': _sha256(b'attestation'),
+                                  'size': 11, 'platform': {'architecture': 'unknown', 'os': 'unknown'}})
+                registry.add_index(repository, tag, manifests)
+                platforms.extend(m['platform'] for m in manifests[:-1])
+            else:
+                (arch, variant), oci = image
+                platforms.append(registry.add_image(repository, tag, arch, variant, oci)['platform'])
+        with docker_builder._docker_lock:
+            docker_builder._docker_credentials.clear()
+            docker_builder._docker_credentials.update(login)
+        docker_hub = docker_builder.DOCKER_HUB
+        if hub:
+            docker_builder.DOCKER_HUB = registry.host
+        try:
+            worker = docker_builder.ManifestPush(
+                '{}/{}'.format(registry.host, repository), list(images), REGISTRY_NAMES, queue.Queue())
+            worker.join()
+        finally:
+            docker_builder.DOCKER_HUB = docker_hub
+            docker_builder.docker_logout()
+            registry.close()
+        errors = []
+        if not hub and registry.logins:
+            errors.append('hub login sent {} times'.format(registry.logins))
+        if media_type is None:
+            if not worker.status():
+                errors.append('published, expected failure')
+        elif worker.status():
+            errors.append(worker.err[:60])
+        else:
+            for ref in REGISTRY_NAMES + [worker.digest]:
+                got, body = registry.manifest(repository, ref)
+                if got != media_type or body['mediaType'] != media_type:
+                    errors.append('{}: {}'.format(ref, got))
+                elif [m['platform'] for m in body['manifests']] != platforms:
+                    errors.append('{}: platforms {}'.format(ref, [m['platform'] for m in body['manifests']]))
+        if len(registry.token_requests) < tokens:
+            errors.append('{} token requests'.format(len(registry.token_requests)))
+        if any(scope != 'repository:{}:pull,push'.format(repository) for scope in registry.token_requests):
+            errors.append('token scopes {}'.format(sorted(set(registry.token_requests))))
+        row = dict(case=name, ok=not worker.status(), check='; '.join(errors) or 'ok')
+        print('{:<36} {:>8}  {}'.format(name, 'ok' if row['ok'] else 'failed', row['check']))
+        rows.append(row)
+    return rows
+
+
+# Репы --nodes: svc0 - база arm64v8, svc1 - на локальном amd64, и отдельная цель реп-app, зависимая от svc0
+# своего репа. В каждом третьем репе app зависит еще и от базы следующего, они могут оказаться на разных узлах
+NODES_REPOS = 12
+NODES_DOCKERFILES = ('FROM arm64v8/alpine\nCOPY src/ /app/src/\n', 'FROM amd64/alpine\nCOPY src/ /app/src/\n')
+# Пуш заметно дольше сборки: зависимая сборка на чужом узле успевает стартовать до пуша своей базы
+NODES_PUSH_LATENCY = 0.5
+NODES_APP = 'FROM bench/{}\nCOPY app.py /app/\n'
+NODES_APP_TWO_BASES = 'FROM bench/{} AS first\nFROM bench/{}\nCOPY --from=first /app/src/ /app/first/\n'
+
+
+def bench_nodes(cli, tmp: str) -> list:
+    # Локальный amd64 и два узла arm64v8, у каждого свои образы и общий регистр. Фейковый демон не соберет
+    # образ от базы, которой нет ни у него, ни в регистре - так что зависимая сборка, отправленная не на узел
+    # своей базы до ее пуша, упадет
+    root = os.path.join(tmp, 'nodes')
+    work_dir = os.path.join(root, 'work')
+    registry = os.path.join(root, 'registry')
+    os.makedirs(work_dir)
+    os.makedirs(registry)
+    with open(os.path.join(work_dir, '.docker_credentials'), 'w') as f:
+        f.write('bench password\n')
+    for image in ('arm64v8/alpine:latest', 'amd64/alpine:latest'):
+        with open(os.path.join(registry, urllib.parse.quote(image, '')), 'w'):
+            pass
+    targets, git_triggers, paths = make_fixtures(
+        root, NODES_REPOS * len(NODES_DOCKERFILES), len(NODES_DOCKERFILES), cli.files, 'files')
+    for n, (target, path) in enumerate(zip(targets, paths)):
+        # depends - с {arch}, как в TARGETS: подставляется архитектура зависимой сборки
+        bases = ['repo{}:svc0-{{arch}}'.format(m) for m in ([n] if n % 3 else [n, n + 1])]
+        app = NODES_APP if len(bases) == 1 else NODES_APP_TWO_BASES
+        for b, dockerfile in enumerate(NODES_DOCKERFILES):
+            _write(os.path.join(path, 'Dockerfile.svc{}'.format(b)), dockerfile)
+        _write(os.path.join(path, 'Dockerfile.app'), app.format(*[base.format(arch='arm64v8') for base in bases]))
+        _commit(path, 'nodes')
+        own = target['targets'][0]
+        own['build'] = [[build[0], build[1].replace('{tag}', '{arch}')] for build in own['build']]
+        target['targets'].append({
+            'registry': 'repo{}-app'.format(n), 'triggers': own['triggers'], 'depends': bases,
+            'build': [['Dockerfile.app', 'app-{arch}']],
+        })
+    count = NODES_REPOS * (len(NODES_DOCKERFILES) + 1)
+    daemons = [
+        FakeDocker(os.path.join(root, 'docker{}.sock'.format(n)), root, cli.build_latency, NODES_PUSH_LATENCY,
+                   registry=registry) for n in range(3)
+    ]
+    os.environ['DOCKER_HOST'] = daemons[0].url
+    nodes = {'arm64v8': [daemon.url for daemon in daemons[1:]]}
+    cfg = dict(
+        main.CFG, work_dir=work_dir, arch='amd64', arch_detect=True, nodes=nodes, max_build_t=cli.build_t,
+        max_push_t=cli.push_t, max_sync_t=cli.sync_t, disk_watermark=0, build_timings='', metrics='', metrics_prom='',
+    )
+    args = argparse.Namespace(v=False, nope=False, force=False, trace=None, profile=None, daemon=False)
+    builder = BenchBuilder(cfg, targets, git_triggers, args, None)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            builder.start()
+        requests = [daemon.requests() for daemon in daemons]
+    finally:
+        for daemon in daemons:
+            daemon.close()
+        os.environ.pop('DOCKER_HOST', None)
+    tasks = docker_builder.metrics.report()['tasks']
+    builds = [t for t in tasks if t['stage'] == 'build']
+    failed = sorted(t['target'] for t in builds if not t['ok'])
+    placed = {}
+    for t in builds:
+        placed[t['node']] = placed.get(t['node'], 0) + 1
+    print('{:<8} {:>6} {:>6}  {:<24} {:>8}'.format('node', 'arch', 'builds', 'url', 'api req'))
+    for n, daemon in enumerate(daemons):
+        print('{:<8} {:>6} {:>6}  {:<24} {:>8}'.format(
+            'local' if not n else 'node{}'.format(n), 'amd64' if not n else 'arm64v8',
+            placed.get('local' if not n else daemon.url, 0), os.path.basename(daemon.path), requests[n]))
+    # Зависимые: собраны на узле своих баз или, если базы на разных узлах, после их пуша
+    pinned = len([name for name, deps in builder.depends.items()
+                  if {builder.node_of.get(dep) for dep in deps} == {builder.node_of.get(name)}])
+    print('dependents on their base node: {} of {}'.format(pinned, len(builder.depends)))
+    row = dict(case='nodes', targets=count, built=len(builds) - len(failed), failed=failed, nodes=placed,
+               pinned=pinned)
+    errors = ['{} failed'.format(', '.join(failed))] if failed else []
+    if len(builds) != count:
+        errors.append('{} of {} built'.format(len(builds), count))
+    row['check'] = '; '.join(errors) or 'ok'
+    print('built {} of {}, check: {}'.format(row['built'], count, row['check']))
+    if row['check'] != 'ok':
+        print(output.getvalue())
+    return [row]
+
+
+def _timeit(name: str, func, repeat: int = 1) -> float:
+    best = None
+    for _ in range(repeat):
+        work_time = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - work_time
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<48} {:>10.4f} sec'.format(name, best))
+    return best
+
+
+def micro(cli, tmp: str):
+    # Триггеры по 100k измененных путей
+    rng = random.Random(1)
+    paths = ['pkg{}/sub{}/file{}.{}'.format(rng.randrange(200), rng.randrange(50), n, rng.choice(('py', 'c', 'md')))
+             for n in range(100000)]
+    files = docker_builder.ChangedFiles(paths)
+    for patterns in (['pkg7/sub3/file70000.py'], ['pkg199*'], ['pkg1*/sub4*/*.c'], ['**/*.sh', '**/file99999.md']):
+        matcher = docker_builder.TriggerMatcher(patterns)
+        _timeit('triggers x100k {}'.format(patterns), lambda: matcher.match(files), 3)
+    # Сотни шаблонов всех видов. Ни один не срабатывает - худший случай, проверяется все
+    patterns = micro_patterns(MICRO_PATTERNS, rng)
+    matcher = docker_builder.TriggerMatcher(patterns)
+    _timeit('triggers compile x{} mixed'.format(len(patterns)), lambda: docker_builder.TriggerMatcher(patterns), 3)
+    _timeit('triggers x100k x{} mixed, no match'.format(len(patterns)), lambda: matcher.match(files), 3)
+    # Последний шаблон срабатывает на последнем файле
+    patterns = patterns + [paths[-1]]
+    matcher = docker_builder.TriggerMatcher(patterns)
+    _timeit('triggers x100k x{} mixed, last match'.format(len(patterns)), lambda: matcher.match(files), 3)
+
+    # prune 10k своих образов среди 10k чужих образов и 10k контейнеров через фейковый демон
+    root = os.path.join(tmp, 'micro')
+    os.makedirs(root)
+    images = ['bench/prune{}:latest'.format(n) for n in range(10000)]
+    # По образу на удаление через API и через CLI
+    rm_images = {way: ['bench/rm-{}{}:latest'.format(way, n) for n in range(MICRO_RM)] for way in ('api', 'cli')}
+    daemon = FakeDocker(os.path.join(root, 'docker.sock'), root, 0, 0,
+                        images=images + rm_images['api'] + rm_images['cli'], inventory=10000, containers=10000)
+    os.environ['DOCKER_HOST'] = daemon.url
+    try:
+        targets = [docker_builder.BuildPlan(image) for image in images]
+        # Индексы и сопоставление отдельно от запросов к демону и удалений
+        images_list, containers_list = docker_builder._docker_images(), docker_builder._docker_containers()
+        _timeit('prune select {} images x {} containers'.format(len(images_list), len(containers_list)),
+                lambda: docker_builder._prune_select(targets, images_list, containers_list), 3)
+        _timeit('docker_prune 10k images (list + select + rmi)', lambda: docker_builder.docker_prune(targets))
+        micro_cli_api()
+    finally:
+        docker_builder.docker_logout()
+        daemon.close()
+        os.environ.pop('DOCKER_HOST', None)
+
+    # git-метаданные 50 репов: первый проход и из кеша
+    _, _, repo_paths = make_fixtures(root, 50, 1, 10, 'context')
+    cfg = {'arch': 'amd64'}
+    _timeit('git tags x50 repos, cold', lambda: [docker_builder._git_get_tags(path, cfg) for path in repo_paths])
+    _timeit('git tags x50 repos, cached', lambda: [docker_builder._git_get_tags(path, cfg) for path in repo_paths], 3)
+
+
+# Шаблонов триггеров в микробенчмарке, поровну точных, префиксов, glob с префиксом и glob без него
+MICRO_PATTERNS = 600
+
+
+def micro_patterns(count: int, rng: random.Random) -> list:
+    # Шаблоны по тем же каталогам, что и пути микробенчмарка, но мимо файлов
+    patterns = []
+    for n in range(count):
+        pkg, sub = rng.randrange(200), rng.randrange(50)
+        patterns.append((
+            'pkg{}/sub{}/missing{}.py'.format(pkg, sub, n),
+            'pkg{}/sub{}/missing{}*'.format(pkg, sub, n),
+            'pkg{}/sub*/missing{}.[ch]'.format(pkg, n),
+            '**/missing{}/*.{}'.format(n, rng.choice(('py', 'c', 'md'))),
+        )[n % 4])
+    return patterns
+
+
+# Сколько образов удалить по одному в сравнении CLI и API
+MICRO_RM = 200
+
+
+def micro_cli_api():
+    # Пул API против CLI, как docker_builder работал раньше: список образов и удаление по одному
+    count = len(docker_builder._docker_images())
+    api = {
+        'list': _timeit('docker images via API ({})'.format(count), docker_builder._docker_images, 5),
+        'rm': _timeit('docker rmi x{} via API'.format(MICRO_RM), lambda: [
+            docker_builder.docker_prune_image('bench/rm-api{}:latest'.format(n)) for n in range(MICRO_RM)]),
+    }
+    if not shutil.which('docker'):
+        # Без CLI сравнения нет, и это надо видеть в выводе
+        for name in ('docker images via CLI', 'docker rmi via CLI'):
+            print('{:<48} {:>14}'.format(name, 'unavailable'))
+        print('CLI vs API: not compared, no docker CLI in PATH')
+        return
+    cli = {
+        'list': _timeit('docker images via CLI ({})'.format(count), lambda: subprocess.run(
+            ['docker', 'images', '-q'], stdout=subprocess.PIPE, stderr=subprocess.PIPE), 5),
+        'rm': _timeit('docker rmi x{} via CLI'.format(MICRO_RM), lambda: [subprocess.run(
+            ['docker', 'rmi', 'bench/rm-cli{}:latest'.format(n)], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        ) for n in range(MICRO_RM)]),
+    }
+    for op in ('list', 'rm'):
+        print('CLI vs API {}: {:.1f}x'.format(op, cli[op] / api[op] if api[op] else 0))
+
+
+def cl_parse():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of docker-builder against a fake docker')
+    parser.add_argument('-s', '--scale', metavar='N', type=int, action='append',
+                        help='Number of build targets, can be repeated (default: 5 50 200 1000)')
+    parser.add_argument('--builds', type=int, default=2, help='Dockerfiles per repo (default: 2)')
+    parser.add_argument('--files', type=int, default=50, help='Source files per repo (default: 50)')
+    parser.add_argument('--layout', choices=LAYOUTS, default='files', help='Trigger layout (default: files)')
+    parser.add_argument('--churn', type=float, default=0.2, help='Part of repos changed before the 2nd run')
+    parser.add_argument('--commits', type=int, default=3, help='Commits per changed repo (default: 3)')
+    parser.add_argument('--build-latency', type=float, default=0.05, help='Fake build time, sec')
+    parser.add_argument('--push-latency', type=float, default=0.02, help='Fake push time, sec')
+    parser.add_argument('--inventory', type=int, default=200, help='Foreign images in the fake docker')
+    parser.add_argument('--build-t', type=int, default=4, help='max_build_t (default: 4)')
+    parser.add_argument('--push-t', type=int, default=2, help='max_push_t (default: 2)')
+    parser.add_argument('--sync-t', type=int, default=8, help='max_sync_t (default: 8)')
+    parser.add_argument('--no-memory', action='store_true', help='Don\'t trace memory, it slows the run down')
+    parser.add_argument('--micro', action='store_true', help='Run microbenchmarks instead')
+    parser.add_argument('--nodes', action='store_true',
+                        help='Build dependent targets on a local and two remote fake daemons instead')
+    parser.add_argument('--registry', action='store_true',
+                        help='Check manifest list publishing against a fake registry instead')
+    parser.add_argument('--faults', action='store_true',
+                        help='Check push retries and fatal errors against a fake daemon with injected faults instead')
+    parser.add_argument('--plan', metavar='N', type=int, action='append',
+                        help='Benchmark only the planner with N targets instead, can be repeated')
+    parser.add_argument('--plan-repos', type=int, default=1000, help='Repos for --plan targets (default: 1000)')
+    parser.add_argument('--plan-budget', type=float, default=60,
+                        help='Planning time budget per run for --plan, sec (default: 60)')
+    parser.add_argument('--plan-memory', type=float, default=1024,
+                        help='Peak Python memory budget for --plan, MB (default: 1024)')
+    parser.add_argument('--json', metavar='FILE', help='Write results in json')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directory')
+    return parser.parse_args()
+
+
+def main_():
+    cli = cl_parse()
+    tmp = tempfile.mkdtemp(prefix='docker-builder-bench-')
+    rows = []
+    try:
+        if cli.micro:
+            micro(cli, tmp)
+        elif cli.faults:
+            rows.extend(bench_push_faults(tmp))
+        elif cli.registry:
+            rows.extend(bench_registry())
+        elif cli.nodes:
+            rows.extend(bench_nodes(cli, tmp))
+        elif cli.plan:
+            print_plan_row(None)
+            for count in cli.plan:
+                rows.extend(bench_plan(count, cli, tmp))
+        else:
+            print_row(None)
+            for scale in cli.scale or [5, 50, 200, 1000]:
+                rows.extend(bench_scale(scale, cli, tmp))
+    finally:
+        if cli.keep:
+            print('Keep {}'.format(tmp))
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    if cli.json and rows:
+        with open(cli.json, 'w', encoding='utf8') as f:
+            json.dump(rows, f, indent=1)
+    if any(row.get('budget', 'ok') != 'ok' or row.get('check', 'ok') != 'ok' for row in rows):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main_()
@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import hmac
+import http.server
+import json
 import os
 import platform
+import queue
+import random
+import re
+import resource
 import shutil
+import socket
 import subprocess
 import sys
+import tarfile
 import threading
 import time
+import urllib.parse
 
 import docker  # pip3 install docker
 import requests  # pip3 install requests
+import urllib3  # ставится с requests
 
-# TODO: Обработка зависимостей, например 'depends'=[] список зависимостей типа индекс\имя, индекс\имя. Хз как лучше.
-# TODO: Переписать работу с докером с subprocess на docker
 
 DEF_TAGS = {        # Подстановки доступные в теге:
     'arch': '',     # Архитектура системы где запущен скрипт: amd64, arm64v8, arm32v7 или unknown
@@ -23,110 +39,749 @@ DEF_TAGS = {        # Подстановки доступные в теге:
 }                   # Примеры: '{arch}-{tag}' -> 'arm64v8-0.7.1', 'build_{c_short}' -> 'build_dc36179' и т.д.
 
 
+class ContextCache:
+    """Тарболы контекста сборки в каталоге work_dir: один на (реп, HEAD, .dockerignore), общий для всех
+    докерфайлов репа и для следующих запусков. Без .git и игнорируемого в .dockerignore. Пишется на диск
+    потоково и потоково же отдается докеру, целиком в памяти не бывает."""
+    def __init__(self, directory: str):
+        self._dir = directory
+        self._lock = threading.Lock()
+        # ключ -> лок его создания, и реп -> тарбол, использованный в этом запуске
+        self._building = {}
+        self._used = {}
+        self.built = 0
+        self.reused = 0
+        self.size = 0
+        self.work_time = 0.0
+
+    def get(self, w_dir: str, dockerfile: str) -> str or None:
+        # Путь к тарболу. None - без кеша: не гит или докерфайл сам в .dockerignore (докер отправил бы его все равно)
+        head = _git_get_full_hash(w_dir) if _is_git(w_dir) else ''
+        rules = _dockerignore(w_dir)
+        if not head or _is_ignored(dockerfile, rules):
+            return None
+        try:
+            with open(os.path.join(w_dir, '.dockerignore'), 'rb') as fp:
+                ignore = hashlib.sha256(fp.read()).hexdigest()
+        except OSError:
+            ignore = ''
+        repo = hashlib.sha256(os.path.abspath(w_dir).encode()).hexdigest()[:16]
+        key = hashlib.sha256('{}\0{}'.format(head, ignore).encode()).hexdigest()[:16]
+        path = os.path.join(self._dir, '{}-{}.tar'.format(repo, key))
+        with self._lock:
+            lock = self._building.setdefault(path, threading.Lock())
+            self._used[repo] = path
+        with lock:
+            if os.path.isfile(path):
+                with self._lock:
+                    self.reused += 1
+                return path
+            self._create(w_dir, path, rules)
+        return path
+
+    def _create(self, w_dir: str, path: str, rules: list):
+        work_time, size, files = time.time(), 0, 0
+        with tracer.span('context {}'.format(w_dir), 'context'):
+            os.makedirs(self._dir, exist_ok=True)
+            # Без исключений (!) в игнорируемый каталог можно даже не заходить
+            negate = any(rule[2] for rule in rules)
+            tmp = '{}.tmp'.format(path)
+            try:
+                with tarfile.open(tmp, 'w') as tar:
+                    for dir_, dirs, names in os.walk(w_dir):
+                        rel_dir = os.path.relpath(dir_, w_dir)
+                        rel_dir = '' if rel_dir == '.' else rel_dir + '/'
+                        if not rel_dir and '.git' in dirs:
+                            dirs.remove('.git')
+                        for name in sorted(dirs + names):
+                            rel = rel_dir + name
+                            if _is_ignored(rel, rules):
+                                if not negate and name in dirs:
+                                    dirs.remove(name)
+                                continue
+                            tar.add(os.path.join(dir_, name), arcname=rel, recursive=False)
+                            files += 1
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            size = os.path.getsize(path)
+        work_time = time.time() - work_time
+        with self._lock:
+            self.built += 1
+            self.size += size
+            self.work_time += work_time
+        metrics.task('context', w_dir, work_time, True, bytes=size, files=files,
+                     peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    def cleanup(self):
+        # Удаляем прошлые тарболы репов, у которых в этом запуске был новый
+        used = set(self._used.values())
+        try:
+            names = os.listdir(self._dir)
+        except OSError:
+            return
+        for name in names:
+            if name.split('-', 1)[0] in self._used and os.path.join(self._dir, name) not in used:
+                try:
+                    os.remove(os.path.join(self._dir, name))
+                except OSError:
+                    pass
+
+
 class Build(threading.Thread):
-    def __init__(self, tag, path, w_dir):
-        super().__init__()
+    def __init__(self, tag, path, w_dir, buildargs: dict = None, reuse: str = None, cache: dict = None,
+                 events: queue.Queue = None, timings: str = None, base_url: str = None,
+                 contexts: ContextCache = None, size: bool = False):
+        super().__init__(name='build {}'.format(tag))
         self.tag = tag
+        # DOCKER_HOST узла, на котором собирать, None - локальный демон
+        self.base_url = base_url
+        # Общий кеш тарболов контекста, None - контекст собирает docker-py для каждой сборки
+        self._contexts = contexts
         self._path = path
         self._w_dir = w_dir
+        self._buildargs = buildargs
+        # ид уже собранного образа с тем же отпечатком, его достаточно перетегировать
+        self._reuse = reuse
+        # {'nocache': bool, 'cache_from': [реп:тег] или None}, по умолчанию без кеша
+        self._cache = cache or {'nocache': True, 'cache_from': None}
+        self._events = events
+        # файл журнала таймингов сборок, JSON-строка на сборку
+        self._timings = timings
+        # Узнать размер собранного образа, для CFG['disk_watermark']
+        self._size = size
         self._status = None
         self.err = ''
         self.work_time = 0
+        self.image_id = None
+        self.image_size = 0
+        # Шаги докерфайла по мере сборки: номер, инструкция, время, из кеша ли, объем вывода
+        self.steps = []
         self.start()
 
     def status(self):
         return self._status
 
+    @property
+    def step(self) -> dict or None:
+        # текущий (последний начатый) шаг
+        return self.steps[-1] if self.steps else None
+
     def run(self):
-        client = docker.from_env()
-        work_time, _status = time.time(), 0
-        try:
-            client.images.build(tag=self.tag, dockerfile=self._path, path=self._w_dir, rm=True, nocache=True)
-        except Exception as e:
-            self.err = str(e)
-            _status = 1
-        finally:
-            self.work_time, self._status = int(time.time() - work_time), _status
+        with tracer.span(self.name, 'thread', node=self.base_url or 'local'):
+            client = _docker_client(self.base_url)
+            work_time, _status = time.time(), 0
+            try:
+                if self._reuse:
+                    client.images.get(self._reuse).tag(*self.tag.rsplit(':', 1))
+                    self.image_id = self._reuse
+                else:
+                    self._pull_cache_from(client)
+                    self._build(client)
+                if self._size:
+                    self.image_size = docker_image_size(self.image_id, self.base_url)
+            except Exception as e:
+                self.err = str(e)
+                _status = 1
+            finally:
+                self._close_step()
+                self.work_time, self._status = int(time.time() - work_time), _status
+                self._write_timings(time.time() - work_time)
+                metrics.task('build', self.tag, time.time() - work_time, not _status, node=self.base_url,
+                             steps=len(self.steps), cached_steps=len([step for step in self.steps if step['cached']]))
+                _notify(self._events, self)
+
+    def _build(self, client):
+        kwargs = dict(
+            tag=self.tag, buildargs=self._buildargs, rm=True, nocache=self._cache['nocache'],
+            cache_from=self._cache['cache_from'], decode=True
+        )
+        dockerfile = os.path.relpath(self._path, self._w_dir)
+        context = self._contexts and self._contexts.get(self._w_dir, dockerfile)
+        if not context:
+            self._read_stream(client.api.build(dockerfile=self._path, path=self._w_dir, **kwargs))
+            return
+        with open(context, 'rb') as fileobj:
+            self._read_stream(client.api.build(fileobj=fileobj, custom_context=True, dockerfile=dockerfile, **kwargs))
+
+    def _pull_cache_from(self, client):
+        # Классический билдер не тянет cache_from сам. Нет образа - соберем без него
+        for image in self._cache['cache_from'] or []:
+            try:
+                client.api.pull(*image.rsplit(':', 1))
+            except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+                print('Cache image {} not pulled: {}'.format(image, e))
+
+    def _read_stream(self, stream):
+        # Разбираем JSON-поток билдера по мере поступления
+        for chunk in stream:
+            if 'error' in chunk:
+                raise RuntimeError(chunk['error'].strip())
+            if 'aux' in chunk and isinstance(chunk['aux'], dict) and 'ID' in chunk['aux']:
+                self.image_id = chunk['aux']['ID']
+            line = chunk.get('stream') or chunk.get('status') or ''
+            if not line:
+                continue
+            match = _BUILD_STEP.match(line)
+            if match:
+                self._close_step()
+                self.steps.append({
+                    'step': int(match.group(1)), 'instruction': match.group(2).strip(),
+                    'start': time.time(), 'duration': None, 'cached': False, 'output': 0
+                })
+                continue
+            step = self.step
+            if step is not None:
+                step['output'] += len(line.encode())
+                if line.strip() == '---> Using cache':
+                    step['cached'] = True
+            match = _BUILD_SUCCESS.match(line)
+            if match and not self.image_id:
+                self.image_id = match.group(1)
+        if not self.image_id:
+            raise RuntimeError('Build stream ended without image ID')
+
+    def _close_step(self):
+        step = self.step
+        if step is not None and step['duration'] is None:
+            step['duration'] = time.time() - step['start']
+
+    def _write_timings(self, duration: float):
+        if not self._timings or self._reuse:
+            return
+        record = {
+            'tag': self.tag, 'dockerfile': self._path, 'time': int(time.time()), 'duration': round(duration, 3),
+            'status': self._status, 'image': self.image_id,
+            'steps': [
+                {
+                    'step': step['step'], 'instruction': step['instruction'], 'duration': round(step['duration'], 3),
+                    'cached': step['cached'], 'output': step['output']
+                } for step in self.steps
+            ]
+        }
+        with _timings_lock:
+            with open(self._timings, 'a', encoding='utf8') as fp:
+                fp.write(json.dumps(record) + '\n')
+
+
+_BUILD_STEP = re.compile(r'Step (\d+)/\d+ : (.*)', re.S)
+_BUILD_SUCCESS = re.compile(r'Successfully built ([0-9a-f]+)')
+_timings_lock = threading.Lock()
+
+
+# nocache - всегда без кеша, cache - всегда с кешем, force - без кеша только при force,
+# cache_from - с кешем из ранее запушенного образа
+CACHE_POLICIES = ('nocache', 'cache', 'force', 'cache_from')
 
 
 class Push(threading.Thread):
-    def __init__(self, tag):
-        super().__init__()
+    def __init__(self, tag, events: queue.Queue = None, retries: int = 4, backoff: float = 2, base_url: str = None):
+        super().__init__(name='push {}'.format(tag))
         self.tag = tag
+        # Пушит тот узел, на котором образ собран
+        self.base_url = base_url
         self._repository, self._tag = tag.rsplit(':', 1)
+        self._events = events
+        self._retries = max(1, retries)
+        self._backoff = backoff
         self._status = None
         self.err = ''
         self.work_time = 0
+        # Прогресс по слоям: ид слоя -> {status, current, total}
+        self.layers = {}
+        self.bytes_pushed = 0
+        self.layers_skipped = 0
+        self.attempts = 0
+        self.digest = None
         self.start()
 
     def status(self):
         return self._status
 
     def run(self):
-        client = docker.from_env()
-        work_time, _status = time.time(), None
-        for retry in range(1, 5):
+        with tracer.span(self.name, 'thread', node=self.base_url or 'local'):
+            client = _docker_client(self.base_url)
+            work_time, _status = time.time(), 1
+            for retry in range(1, self._retries + 1):
+                self.attempts = retry
+                try:
+                    self._read_stream(
+                        client.api.push(repository=self._repository, tag=self._tag, stream=True, decode=True))
+                except PushStreamError as e:
+                    self.err = str(e)
+                    if not e.retry:
+                        break
+                except docker.errors.APIError as e:
+                    # Демон ответил ошибкой до начала потока. Отказ в доступе, нет образа и прочие 4xx
+                    # повтором не исправить, кроме таймаута и лимита запросов
+                    self.err = str(e)
+                    if _PUSH_FATAL.search(self.err) or (e.is_client_error() and e.status_code not in (408, 429)):
+                        break
+                except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                    # Включая обрыв соединения посреди потока, его docker-py отдает как есть из urllib3
+                    self.err = 'socket error: {}'.format(e)
+                except Exception as e:
+                    self.err = str(e)
+                    break
+                else:
+                    self.err = ''
+                    _status = 0
+                    break
+                if retry < self._retries:
+                    # Экспоненциальная задержка с джиттером. Уже залитые слои докер при повторе пропустит сам
+                    delay = random.uniform(0, min(PUSH_BACKOFF_MAX, self._backoff * 2 ** (retry - 1)))
+                    print('Error push {}:{}. Retry {} in {:.1f} sec. MSG: {}'.format(
+                        self._repository, self._tag, retry, delay, self.err))
+                    time.sleep(delay)
+            self.bytes_pushed = sum(
+                layer['total'] or layer['current'] for layer in self.layers.values() if layer['status'] == 'Pushed'
+            )
+            self.layers_skipped = len(
+                [layer for layer in self.layers.values() if layer['status'] == 'Layer already exists']
+            )
+            self.work_time, self._status = int(time.time() - work_time), _status
+            metrics.task('push', self.tag, time.time() - work_time, not _status, node=self.base_url,
+                         bytes=self.bytes_pushed, layers_skipped=self.layers_skipped, attempts=self.attempts)
+            _notify(self._events, self)
+
+    def _read_stream(self, stream):
+        for chunk in stream:
+            if 'error' in chunk:
+                message = chunk['error'].strip()
+                raise PushStreamError(message, not _PUSH_FATAL.search(message))
+            if isinstance(chunk.get('aux'), dict) and chunk['aux'].get('Digest'):
+                self.digest = chunk['aux']['Digest']
+            layer_id, status = chunk.get('id'), chunk.get('status', '')
+            if not layer_id or status.startswith(self._tag + ':'):
+                continue
+            layer = self.layers.setdefault(layer_id, {'status': '', 'current': 0, 'total': 0})
+            layer['status'] = status
+            detail = chunk.get('progressDetail') or {}
+            layer['current'] = detail.get('current', layer['current'])
+            layer['total'] = detail.get('total', layer['total'])
+        if not self.digest:
+            raise PushStreamError('Push stream ended without digest', True)
+
+
+class PushStreamError(RuntimeError):
+    # Ошибка внутри потока пуша, retry - имеет ли смысл повторять
+    def __init__(self, message: str, retry: bool):
+        super().__init__(message)
+        self.retry = retry
+
+
+# Предельная задержка перед повтором пуша, сек
+PUSH_BACKOFF_MAX = 60
+# Такие ошибки повтором не исправить
+_PUSH_FATAL = re.compile(r'denied|unauthorized|authentication required|does not exist|invalid reference', re.I)
+
+
+class Pull(threading.Thread):
+    # Заранее скачивает базовый образ из FROM на узел сборки, пока идут другие сборки
+    def __init__(self, image: str, events: queue.Queue = None, base_url: str = None):
+        super().__init__(name='pull {}'.format(image))
+        self.tag = image
+        self.base_url = base_url
+        self._events = events
+        self._status = None
+        self.err = ''
+        self.work_time = 0
+        self.digest = None
+        self.start()
+
+    def status(self):
+        return self._status
+
+    def run(self):
+        with tracer.span(self.name, 'thread', node=self.base_url or 'local'):
+            work_time, _status = time.time(), 0
             try:
-                self.err = client.images.push(repository=self._repository, tag=self._tag)
-            except requests.exceptions.ConnectionError as e:
-                print('Error push {}:{}. Retry {}. MSG: {}'.format(self._repository, self._tag, retry, e))
+                for chunk in _docker_client(self.base_url).api.pull(self.tag, stream=True, decode=True):
+                    if 'error' in chunk:
+                        raise RuntimeError(chunk['error'].strip())
+                    if chunk.get('status', '').startswith('Digest: '):
+                        self.digest = chunk['status'][8:].strip()
             except Exception as e:
                 self.err = str(e)
                 _status = 1
-                break
-            else:
-                _status = 0
-                break
-        if _status is None:
-            self.err += ' socket error'
-            _status = 1
-        self.work_time, self._status = int(time.time() - work_time), _status
+            finally:
+                self.work_time, self._status = int(time.time() - work_time), _status
+                metrics.task('pull', self.tag, time.time() - work_time, not _status, node=self.base_url)
+                _notify(self._events, self)
+
+
+class Remove(threading.Thread):
+    # Удаляет запушенный образ на его узле, пока планировщик запускает следующие задачи
+    def __init__(self, tag: str, events: queue.Queue = None, base_url: str = None):
+        super().__init__(name='remove {}'.format(tag))
+        self.tag = tag
+        self.base_url = base_url
+        self._events = events
+        self._status = None
+        self.err = ''
+        self.work_time = 0
+        self.start()
+
+    def status(self):
+        return self._status
+
+    def run(self):
+        with tracer.span(self.name, 'thread', node=self.base_url or 'local'):
+            work_time, _status = time.time(), 0
+            try:
+                docker_prune_image(self.tag, True, self.base_url)
+            except Exception as e:
+                self.err = str(e)
+                _status = 1
+            finally:
+                self.work_time, self._status = int(time.time() - work_time), _status
+                metrics.task('remove', self.tag, time.time() - work_time, not _status, node=self.base_url)
+                _notify(self._events, self)
 
 
 class ManifestPush(threading.Thread):
-    """docker manifest rm aculeasis/rhvoice-rest:latest
-       docker manifest create \
-        aculeasis/rhvoice-rest:latest \
-        -a aculeasis/rhvoice-rest:amd64 \
-        -a aculeasis/rhvoice-rest:arm32v7 \
-        -a aculeasis/rhvoice-rest:arm64v8
-        docker manifest push aculeasis/rhvoice-rest:latest"""
-    def __init__(self, target: str, tags: list):
-        super().__init__()
-        self.tag = '{}:latest'.format(target)
-        self.targets = []
-        for i in tags:
-            self.targets.extend(['-a', '{}:{}'.format(target, i)])
+    """Собирает из уже запушенных образов (по одному на архитектуру) manifest list и пушит его под тегами names.
+    Работает напрямую с HTTP API регистра, платформу каждого образа берет из его конфига."""
+    def __init__(self, target: str, tags: list, names: list, events: queue.Queue = None):
+        super().__init__(name='manifest {}'.format(target))
+        self.tag = '{}:{}'.format(target, ','.join(names))
+        self._target = target
+        self._tags = tags
+        self._names = names
+        self._events = events
         self._status = None
         self.err = ''
         self.work_time = 0
+        self.digest = None
         self.start()
 
     def status(self):
         return self._status
 
-    def _call(self, cmd: str, args: list):
-        run = subprocess.run(
-            ['docker', 'manifest', cmd, self.tag] + args,
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE
-        )
-        if run.returncode:
-            return run.returncode, '{} "{}" {}'.format(cmd, args, run.stderr.decode())
-        return 0, ''
+    def _publish(self) -> str:
+        host, repository = _registry_split(self._target)
+        # Логин - от Docker Hub, в чужие регистры его не отдаем
+        with _docker_lock:
+            credentials = dict(_docker_credentials) if host == DOCKER_HUB else None
+        registry = RegistryClient(host, credentials)
+        manifests = []
+        for tag in self._tags:
+            manifests.extend(registry.platform_manifests(repository, tag))
+        if all(m['mediaType'] == OCI_MANIFEST for m in manifests):
+            media_type = OCI_INDEX
+        else:
+            media_type = DOCKER_MANIFEST_LIST
+        body = json.dumps({'schemaVersion': 2, 'mediaType': media_type, 'manifests': manifests}, indent=3).encode()
+        digest = None
+        for name in self._names:
+            digest = registry.put_manifest(repository, name, body, media_type)
+        return digest
 
     def run(self):
-        work_time, _status = time.time(), 0
+        with tracer.span(self.name, 'thread'):
+            work_time, _status = time.time(), 0
+            try:
+                self.digest = self._publish()
+            except Exception as e:
+                self.err = str(e)
+                _status = 1
+            finally:
+                self.work_time, self._status = int(time.time() - work_time), _status
+                metrics.task('manifest', self.tag, time.time() - work_time, not _status)
+                _notify(self._events, self)
+
+
+DOCKER_HUB = 'registry-1.docker.io'
+REGISTRY_TIMEOUT = 60
+DOCKER_MANIFEST = 'application/vnd.docker.distribution.manifest.v2+json'
+DOCKER_MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+
+
+class RegistryError(RuntimeError):
+    pass
+
+
+def _registry_split(name: str) -> tuple:
+    # 'aculeasis/mdmt2' -> (хост регистра, реп в нем), как это делает докер
+    first, _, rest = name.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        host, repository = first, rest
+    else:
+        host, repository = DOCKER_HUB, name
+    if host in ('docker.io', 'index.docker.io'):
+        host = DOCKER_HUB
+    if host == DOCKER_HUB and '/' not in repository:
+        repository = 'library/' + repository
+    return host, repository
+
+
+class RegistryClient:
+    """Клиент Docker Registry HTTP API v2. Авторизация по вызову из WWW-Authenticate: Bearer-токен
+    на реп (Docker Hub и большинство регистров) или Basic. Локальный регистр (localhost) - по http."""
+    def __init__(self, host: str, credentials: dict = None):
+        scheme = 'http' if host.split(':', 1)[0] in ('localhost', '127.0.0.1') else 'https'
+        self._base = '{}://{}/v2'.format(scheme, host)
+        self._credentials = credentials or {}
+        self._session = requests.Session()
+        self._session.request = _traced_request(self._session.request, 'registry')
+        # scope -> заголовок Authorization
+        self._auth = {}
+
+    def _request(self, method: str, repository: str, path: str, headers: dict = None, data: bytes = None):
+        url = '{}/{}/{}'.format(self._base, repository, path)
+        scope = 'repository:{}:pull,push'.format(repository)
+        headers = dict(headers or {})
+        for attempt in range(2):
+            if scope in self._auth:
+                headers['Authorization'] = self._auth[scope]
+            resp = self._session.request(method, url, headers=headers, data=data, timeout=REGISTRY_TIMEOUT)
+            if resp.status_code != 401 or attempt or 'WWW-Authenticate' not in resp.headers:
+                break
+            self._authenticate(resp.headers['WWW-Authenticate'], scope)
+        if not resp.ok:
+            raise RegistryError('Registry {} {}: {} {}'.format(method, url, resp.status_code, resp.text[:200].strip()))
+        return resp
+
+    def _authenticate(self, challenge: str, scope: str):
+        scheme, _, params = challenge.partition(' ')
+        auth = (self._credentials['username'], self._credentials['password']) if self._credentials else None
+        if scheme.lower() == 'basic':
+            if not auth:
+                raise RegistryError('Registry requires credentials')
+            self._auth[scope] = 'Basic {}'.format(base64.b64encode('{}:{}'.format(*auth).encode()).decode())
+            return
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        if 'realm' not in params:
+            raise RegistryError('Unsupported registry auth: {}'.format(challenge))
+        resp = self._session.get(
+            params['realm'], params={'service': params.get('service'), 'scope': scope}, auth=auth,
+            timeout=REGISTRY_TIMEOUT
+        )
+        if not resp.ok:
+            raise RegistryError('Registry auth {}: {} {}'.format(params['realm'], resp.status_code, resp.text[:200]))
+        data = resp.json()
+        self._auth[scope] = 'Bearer {}'.format(data.get('token') or data.get('access_token'))
+
+    def get_manifest(self, repository: str, reference: str) -> tuple:
+        # -> (media type, тело, digest)
+        accept = ', '.join((DOCKER_MANIFEST, DOCKER_MANIFEST_LIST, OCI_MANIFEST, OCI_INDEX))
+        resp = self._request('GET', repository, 'manifests/{}'.format(reference), headers={'Accept': accept})
+        body = resp.content
+        media_type = resp.headers.get('Content-Type', '').split(';', 1)[0] or json.loads(body).get('mediaType')
+        digest = resp.headers.get('Docker-Content-Digest') or 'sha256:{}'.format(hashlib.sha256(body).hexdigest())
+        return media_type, body, digest
+
+    def get_digest(self, repository: str, reference: str) -> str:
+        # digest тега без тела манифеста, для списка - digest самого списка, как его запоминает docker pull
+        accept = ', '.join((DOCKER_MANIFEST, DOCKER_MANIFEST_LIST, OCI_MANIFEST, OCI_INDEX))
+        resp = self._request('HEAD', repository, 'manifests/{}'.format(reference), headers={'Accept': accept})
+        if not resp.headers.get('Docker-Content-Digest'):
+            raise RegistryError('Registry {}: no digest for {}:{}'.format(self._base, repository, reference))
+        return resp.headers['Docker-Content-Digest']
+
+    def get_blob(self, repository: str, digest: str) -> bytes:
+        return self._request('GET', repository, 'blobs/{}'.format(digest)).content
+
+    def put_manifest(self, repository: str, reference: str, body: bytes, media_type: str) -> str:
+        resp = self._request(
+            'PUT', repository, 'manifests/{}'.format(reference), headers={'Content-Type': media_type}, data=body
+        )
+        return resp.headers.get('Docker-Content-Digest') or 'sha256:{}'.format(hashlib.sha256(body).hexdigest())
+
+    def platform_manifests(self, repository: str, reference: str) -> list:
+        # Дескрипторы для manifest list. Если тег сам уже список - берем его образы, без аттестаций
+        media_type, body, digest = self.get_manifest(repository, reference)
+        data = json.loads(body)
+        if media_type in (DOCKER_MANIFEST_LIST, OCI_INDEX):
+            return [m for m in data['manifests'] if m.get('platform', {}).get('architecture') != 'unknown']
+        config = json.loads(self.get_blob(repository, data['config']['digest']))
+        platform_ = {'architecture': config['architecture'], 'os': config['os']}
+        if config.get('variant'):
+            platform_['variant'] = config['variant']
+        return [{'mediaType': media_type, 'size': len(body), 'digest': digest, 'platform': platform_}]
+
+
+def _notify(events: queue.Queue or None, worker: threading.Thread):
+    # Сообщаем планировщику о завершении задачи, он проснется сразу а не по таймеру
+    if events is not None:
+        events.put(worker)
+
+
+class Metrics:
+    """Метрики запуска: время фаз (синхронизация, триггеры, планирование, prune, сборка, весь запуск)
+    и каждой задачи (sync, pull, context, build, push, remove, manifest). В конце запуска пишутся как текстовый файл
+    для textfile collector node_exporter'а и как JSON-отчет."""
+    PREFIX = 'docker_builder'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            # фаза -> [секунд всего, сколько раз]
+            self.phases = {}
+            # {stage, target, seconds, ok, и числовые значения задачи}
+            self.tasks = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        # Время накапливается, если фаза входит несколько раз
+        work_time = time.perf_counter()
         try:
-            self._call('rm', [])
-            _status, self.err = self._call('create', self.targets)
-            if not _status:
-                _status, self.err = self._call('push', [])
-        except Exception as e:
-            self.err = str(e)
-            _status = 1
+            with tracer.span(name, 'phase'):
+                yield
         finally:
-            self.work_time, self._status = int(time.time() - work_time), _status
+            self.add_phase(name, time.perf_counter() - work_time)
+
+    def add_phase(self, name: str, seconds: float):
+        with self._lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += 1
+
+    def task(self, stage: str, target: str, seconds: float, ok: bool, node: str or None = None, **values):
+        # node - base_url демона, на котором шла задача, None - локальный
+        with self._lock:
+            self.tasks.append(dict(values, stage=stage, target=target, node=node or 'local', seconds=round(seconds, 6),
+                                   ok=ok))
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                'started': self.started,
+                'finished': time.time(),
+                'phases': {name: {'seconds': round(v[0], 6), 'count': v[1]} for name, v in self.phases.items()},
+                'tasks': list(self.tasks),
+            }
+
+    def prometheus(self) -> str:
+        report = self.report()
+        lines = []
+
+        def metric(name: str, help_: str, samples: list):
+            name = '{}_{}'.format(self.PREFIX, name)
+            lines.extend(['# HELP {} {}'.format(name, help_), '# TYPE {} gauge'.format(name)])
+            # Одна серия на набор меток: повторы (тот же образ дважды на одном узле) суммируются
+            merged = {}
+            for labels, value in samples:
+                merged[labels] = merged.get(labels, 0) + value
+            for labels, value in merged.items():
+                labels = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels)
+                lines.append('{}{} {}'.format(name, '{{{}}}'.format(labels) if labels else '', value))
+
+        metric('last_run_timestamp_seconds', 'When the last run finished.', [((), report['finished'])])
+        metric('run_seconds', 'Run makespan.', [((), round(report['finished'] - report['started'], 6))])
+        metric('phase_seconds', 'Time spent in run phases.',
+               [((('phase', name),), v['seconds']) for name, v in sorted(report['phases'].items())])
+        tasks = report['tasks']
+        metric('task_seconds', 'Duration of each task.',
+               [((('stage', t['stage']), ('target', t['target']), ('node', t.get('node', 'local')),
+                  ('status', 'ok' if t['ok'] else 'failed')), t['seconds']) for t in tasks])
+        counts = {}
+        for t in tasks:
+            key = (t['stage'], 'ok' if t['ok'] else 'failed')
+            counts[key] = counts.get(key, 0) + 1
+        metric('tasks', 'Tasks by stage and status.',
+               [((('stage', stage), ('status', status)), count) for (stage, status), count in sorted(counts.items())])
+        values = sorted({k for t in tasks for k in t if k not in ('stage', 'target', 'node', 'seconds', 'ok')})
+        for key in values:
+            metric('task_{}'.format(key), 'Task {}.'.format(key.replace('_', ' ')),
+                   [((('stage', t['stage']), ('target', t['target']), ('node', t.get('node', 'local'))), t[key])
+                    for t in tasks if key in t])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path: str or None, prom_path: str or None):
+        # Пишем через временный файл, чтобы коллектор не прочитал половину
+        for path, data in ((json_path, lambda: json.dumps(self.report(), indent=1)), (prom_path, self.prometheus)):
+            if not path:
+                continue
+            try:
+                with open(path + '.tmp', 'w', encoding='utf8') as f:
+                    f.write(data())
+                os.replace(path + '.tmp', path)
+            except OSError as e:
+                print('Error writing metrics {}: {}'.format(path, e))
+
+
+metrics = Metrics()
+
+
+class Tracer:
+    """Спаны запуска в формате Chrome Trace Event: потоки, подпроцессы, вызовы API докера и регистра.
+    Файл открывается в chrome://tracing или Perfetto. Пока не включен - ничего не записывает."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = False
+        self._events = []
+        # ид потока -> имя, для подписей дорожек
+        self._threads = {}
+        self._start = 0.0
+
+    def enable(self):
+        with self._lock:
+            self.enabled = True
+            self._events = []
+            self._threads = {}
+            self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, cat, start, time.perf_counter(), args)
+
+    def _add(self, name: str, cat: str, start: float, end: float, args: dict):
+        thread = threading.current_thread()
+        event = {
+            'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+            'ts': round((start - self._start) * 1e6, 1), 'dur': round((end - start) * 1e6, 1),
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            self._threads[thread.ident] = thread.name
+
+    def write(self, path: str):
+        with self._lock:
+            events = [
+                {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                for tid, name in self._threads.items()
+            ] + self._events
+        try:
+            with open(path, 'w', encoding='utf8') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        except OSError as e:
+            print('Error writing trace {}: {}'.format(path, e))
+
+
+tracer = Tracer()
+
+
+def _run(cmd: list, **kwargs) -> subprocess.CompletedProcess:
+    # subprocess.run со спаном трассировки, имя спана - команда без -C путь
+    args = cmd[3:] if cmd[1:2] == ['-C'] else cmd[1:]
+    with tracer.span(' '.join(cmd[:1] + args[:1]), 'subprocess', cmd=' '.join(cmd)):
+        return subprocess.run(cmd, **kwargs)
+
+
+def _traced_request(request, cat: str):
+    # Обертка над requests.Session.request: спан на каждый HTTP-вызов
+    def wrapper(method, url, *args, **kwargs):
+        with tracer.span('{} {}'.format(method, urllib.parse.urlsplit(url).path), cat):
+            return request(method, url, *args, **kwargs)
+    return wrapper
 
 
 def _get_arch() -> str:
@@ -134,85 +789,679 @@ def _get_arch() -> str:
     return aarch.get(platform.uname()[4].lower(), 'unknown')
 
 
-def _get_arch_from_dockerfile(path) -> str:
-    # вернет архитектуру, если найдет ее во FROM. Или ''
-    if not os.path.isfile(path):
-        raise RuntimeError('File not found {}'.format(path))
-    aarch = ['amd64', 'arm64v8', 'arm32v7']
-    with open(path, encoding='utf8') as f:
-        for i in f.readlines():
-            if i.startswith('FROM'):
-                for test in aarch:
-                    if test in i.lower():
-                        return test
-                return ''
+def _dockerfile_arch(instructions: list) -> str:
+    # вернет архитектуру, если найдет ее в первом FROM. Или ''
+    for instruction, args in instructions:
+        if instruction == 'FROM':
+            for test in ('amd64', 'arm64v8', 'arm32v7'):
+                if test in args.lower():
+                    return test
+            return ''
     return ''
 
 
+class DockerfileInfo:
+    """Все, что планировщику нужно от докерфайла. Файл читается и разбирается один раз за запуск."""
+    __slots__ = ('sources', 'source_args', 'args', 'froms', 'arch')
+
+    def __init__(self, path: str):
+        instructions = _dockerfile_instructions(path)
+        # источники COPY/ADD как в файле и ARG всего файла со значениями по умолчанию, для $VAR в них
+        self.sources, self.source_args = _dockerfile_sources(instructions)
+        # ARG до первого FROM и [образ, стадия] всех FROM
+        self.args, self.froms = _dockerfile_froms(instructions)
+        self.arch = _dockerfile_arch(instructions)
+
+    def bases(self, buildargs: dict or None) -> list:
+        return _base_images(self.args, self.froms, buildargs)
+
+    def context_sources(self, buildargs: dict or None) -> tuple:
+        return _resolve_sources(tuple(self.sources), self.source_args, buildargs)
+
+    def regex(self, buildargs: dict or None):
+        # Регулярка по источникам COPY/ADD с подставленными ARG
+        return _sources_regex(self.context_sources(buildargs))
+
+
+def _dockerfile_instructions(path) -> list:
+    # вернет список из [инструкция, аргументы] с учетом переносов строк и комментариев
+    result = []
+    line_ = ''
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#') or (not line and not line_):
+                continue
+            if line.endswith('\\'):
+                line_ += line[:-1] + ' '
+                continue
+            line_ += line
+            if line_.strip():
+                instruction, _, args = line_.strip().partition(' ')
+                result.append([instruction.upper(), args.strip()])
+            line_ = ''
+    if line_.strip():
+        instruction, _, args = line_.strip().partition(' ')
+        result.append([instruction.upper(), args.strip()])
+    return result
+
+
+def _dockerfile_sources(instructions: list) -> tuple:
+    # вернет (источники из COPY/ADD, которые берутся из контекста сборки (без --from=), и url из ADD;
+    # ARG всего файла -> значение по умолчанию или None). ARG стадии без значения наследует глобальное
+    sources, defaults = [], {}
+    for instruction, args in instructions:
+        if instruction == 'ARG':
+            for arg in args.split():
+                name, eq, default = arg.partition('=')
+                if eq or name not in defaults:
+                    defaults[name] = default.strip('"\'') if eq else None
+        if instruction not in ('COPY', 'ADD'):
+            continue
+        parts = None
+        if args.startswith('['):
+            try:
+                parts = json.loads(args)
+            except ValueError:
+                pass
+        if not isinstance(parts, list):
+            parts = args.split()
+        flags = []
+        while parts and str(parts[0]).startswith('--'):
+            flags.append(parts.pop(0))
+        if [flag for flag in flags if flag.startswith('--from')]:
+            continue
+        sources.extend(src for src in parts[:-1] if not str(src).startswith('<<'))
+    return sources, defaults
+
+
+def _resolve_sources(sources: tuple, defaults: dict, buildargs: dict or None) -> tuple:
+    # Подставляет ARG в источники: --build-arg, иначе значение по умолчанию. Если хоть один источник не
+    # вычисляется (ARG без значения, неизвестная переменная), источник - весь контекст
+    values = {name: (buildargs or {}).get(name, default) for name, default in defaults.items()}
+    unresolved = []
+
+    def expand(match):
+        value = values.get(match.group(1) or match.group(4))
+        if match.group(2) == '-':
+            return value or match.group(3)
+        if match.group(2) == '+':
+            return match.group(3) if value else ''
+        if not value:
+            unresolved.append(match.group(0))
+        return value or ''
+
+    resolved = tuple(_ARG_REF.sub(expand, str(src)) for src in sources)
+    if unresolved or any('$' in src for src in resolved):
+        return ('.',)
+    return resolved
+
+
+def _dockerfile_froms(instructions: list) -> tuple:
+    # вернет (ARG до первого FROM с их значениями по умолчанию, [[образ, имя стадии или '']] из всех FROM)
+    args, froms = {}, []
+    for instruction, value in instructions:
+        if instruction == 'ARG' and not froms:
+            for arg in value.split():
+                name, _, default = arg.partition('=')
+                args[name] = default.strip('"\'')
+        elif instruction == 'FROM':
+            parts = [part for part in value.split() if not part.startswith('--')]
+            if parts:
+                stage = parts[2].lower() if len(parts) > 2 and parts[1].lower() == 'as' else ''
+                froms.append([parts[0], stage])
+    return args, froms
+
+
+# $VAR, ${VAR}, ${VAR:-default}, ${VAR:+alt}
+_ARG_REF = re.compile(r'\$(?:{(\w+)(?::?([-+])([^}]*))?}|(\w+))')
+
+
+def _base_images(args: dict, froms: list, buildargs: dict or None) -> list:
+    # Внешние базовые образы сборки: ARG подставлены (--build-arg переопределяет только объявленные),
+    # ссылки на предыдущие стадии и scratch пропущены, без тега - :latest
+    values = {name: (buildargs or {}).get(name, default) for name, default in args.items()}
+
+    def expand(match):
+        value = values.get(match.group(1) or match.group(4)) or ''
+        if match.group(2) == '-':
+            return value or match.group(3)
+        if match.group(2) == '+':
+            return match.group(3) if value else ''
+        return value
+
+    images, stages = [], set()
+    for image, stage in froms:
+        image = _ARG_REF.sub(expand, image)
+        if image and image.lower() not in stages and image != 'scratch' and '$' not in image:
+            if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+                image += ':latest'
+            if image not in images:
+                images.append(image)
+        if stage:
+            stages.add(stage)
+    return images
+
+
+def base_image_digest(image: str, registries: dict) -> str or None:
+    # Текущий digest базового образа в регистре. registries - кеш клиентов по хостам
+    if '@' in image:
+        return image.split('@', 1)[1]
+    name, tag = image.rsplit(':', 1)
+    host, repository = _registry_split(name)
+    if host not in registries:
+        with _docker_lock:
+            # Логин из credentials - для хаба, чужим регистрам его не отдаем
+            credentials = dict(_docker_credentials) if host == DOCKER_HUB else None
+        registries[host] = RegistryClient(host, credentials)
+    try:
+        return registries[host].get_digest(repository, tag)
+    except (RegistryError, requests.exceptions.RequestException) as e:
+        print('Base image {} digest unknown: {}'.format(image, e))
+    return None
+
+
+def _glob_to_regex(pattern: str) -> str:
+    # glob как в докере: * и ? в пределах каталога, ** - любое число каталогов, [...] - класс символов
+    result = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            result += '(?:.*/)?'
+            i += 2
+        elif pattern.startswith('**', i):
+            result += '.*'
+            i += 1
+        elif char == '*':
+            result += '[^/]*'
+        elif char == '?':
+            result += '[^/]'
+        elif char == '[' and pattern.find(']', i + 2) > 0:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            result += '[{}]'.format(chars.replace('\\', '\\\\'))
+            i = end
+        else:
+            result += re.escape(char)
+        i += 1
+    return result
+
+
+_GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+class ChangedFiles:
+    """Измененные файлы репа: множество для точных совпадений и сортированный список для префиксов."""
+    __slots__ = ('files', 'sorted')
+
+    def __init__(self, files):
+        self.files = set(files)
+        self.sorted = sorted(self.files)
+
+    def __contains__(self, file):
+        return file in self.files
+
+    def __iter__(self):
+        return iter(self.sorted)
+
+    def __len__(self):
+        return len(self.files)
+
+    def startswith(self, prefix: str) -> list:
+        # все файлы начинающиеся с prefix, бинарным поиском
+        start = bisect.bisect_left(self.sorted, prefix)
+        end = start
+        while end < len(self.sorted) and self.sorted[end].startswith(prefix):
+            end += 1
+        return self.sorted[start:end]
+
+    def has_prefix(self, prefix: str) -> bool:
+        idx = bisect.bisect_left(self.sorted, prefix)
+        return idx < len(self.sorted) and self.sorted[idx].startswith(prefix)
+
+
+class TriggerMatcher:
+    """Файловые триггеры цели, разобранные один раз.
+    'file' - точное совпадение, 'src*' - любой файл начинающийся с src (и в подкаталогах),
+    '*' - любой файл, glob: * и ? в пределах каталога, ** - любое число каталогов, [...] - класс символов.
+    '*name' - триггер из GIT_TRIGGERS, здесь пропускается. Glob с начала пишется как '**/...'."""
+    def __init__(self, patterns: tuple):
+        self.any = False
+        # [шаблон, способ проверки, аргумент] в исходном порядке
+        self._checks = []
+        free = []  # glob без литерального префикса, одна регулярка на всех
+        for pattern in patterns:
+            if pattern == '*':
+                self.any = True
+            elif pattern.startswith('*') and not pattern.startswith('**'):
+                continue
+            elif not _GLOB_CHARS.search(pattern):
+                self._checks.append([pattern, 'exact', pattern])
+            elif pattern.endswith('*') and not pattern.endswith('**') and not _GLOB_CHARS.search(pattern[:-1]):
+                self._checks.append([pattern, 'prefix', pattern[:-1]])
+            else:
+                # Замыкающая одиночная * как и раньше захватывает подкаталоги
+                regex = _glob_to_regex(pattern[:-1]) + '.*' if pattern.endswith('*') and not pattern.endswith('**') \
+                    else _glob_to_regex(pattern)
+                prefix = pattern[:_GLOB_CHARS.search(pattern).start()]
+                if prefix:
+                    self._checks.append([pattern, 'glob', (prefix, re.compile(regex + r'\Z'))])
+                else:
+                    free.append((pattern, regex))
+        # '**/хвост' из depth компонент пути сверяется только с последними depth компонентами файла, и только
+        # с шаблонами, у которых первая компонента хвоста та же (или не литеральная). Так на сотнях шаблонов
+        # регулярке не нужно ни перебирать каталоги, ни пробовать все альтернативы. Остальные - целиком
+        groups = {}
+        for pattern, regex in free:
+            rest = pattern[3:]
+            if pattern.startswith('**/') and '**' not in rest and not rest.endswith('*'):
+                first = rest.partition('/')[0]
+                key = (rest.count('/') + 1, None if _GLOB_CHARS.search(first) else first)
+                groups.setdefault(key, []).append((pattern, _glob_to_regex(rest), rest))
+            else:
+                groups.setdefault((None, None), []).append((pattern, regex, pattern))
+        # число компонент или None -> [литеральные хвосты или None, {первая компонента или None: (регулярка, имена)}]
+        self._free = {}
+        for (depth, first), items in groups.items():
+            names = {'p{}'.format(idx): item[0] for idx, item in enumerate(items)}
+            regex = re.compile('|'.join('(?P<p{}>{}\\Z)'.format(idx, item[1]) for idx, item in enumerate(items)))
+            # Литеральные хвосты ('**/*.py' -> '.py', '**/Makefile' -> 'Makefile') отсекают лишние файлы до регулярки
+            suffixes = tuple(re.split(r'[*?\]]', item[2])[-1] for item in items)
+            entry = self._free.setdefault(depth, [(), {}])
+            entry[0] = entry[0] + suffixes if entry[0] is not None and all(suffixes) else None
+            entry[1][first] = (regex, names)
+
+    def _free_matches(self, changes: ChangedFiles):
+        # (файл, шаблон) по glob без литерального префикса
+        for depth, (suffixes, regexes) in self._free.items():
+            files = changes if suffixes is None else [file for file in changes if file.endswith(suffixes)]
+            for file in files:
+                if depth is None:
+                    tail, keys = file, (None,)
+                else:
+                    # последние depth компонент пути
+                    parts = file.rsplit('/', depth)
+                    if len(parts) < depth:
+                        continue
+                    tail = file if len(parts) == depth else file[len(parts[0]) + 1:]
+                    keys = (parts[-depth], None)
+                for key in keys:
+                    match = key in regexes and regexes[key][0].match(tail)
+                    if match:
+                        yield file, regexes[key][1][match.lastgroup]
+                        break
+
+    def match(self, changes: ChangedFiles) -> str or None:
+        # вернет первый сработавший шаблон или None
+        for pattern, kind, arg in self._checks:
+            if kind == 'exact':
+                if arg in changes:
+                    return pattern
+            elif kind == 'prefix':
+                if changes.has_prefix(arg):
+                    return pattern
+            elif any(arg[1].match(file) for file in changes.startswith(arg[0])):
+                return pattern
+        for _, pattern in self._free_matches(changes):
+            return pattern
+        return None
+
+    def select(self, files: ChangedFiles) -> list:
+        # все подходящие файлы, по порядку
+        if self.any:
+            return list(files)
+        result = set()
+        for pattern, kind, arg in self._checks:
+            if kind == 'exact':
+                if arg in files:
+                    result.add(arg)
+            elif kind == 'prefix':
+                result.update(files.startswith(arg))
+            else:
+                result.update(file for file in files.startswith(arg[0]) if arg[1].match(file))
+        result.update(file for file, _ in self._free_matches(files))
+        return sorted(result)
+
+
+@functools.lru_cache(maxsize=1024)
+def _trigger_matcher(patterns: tuple) -> TriggerMatcher:
+    return TriggerMatcher(patterns)
+
+
+def _dockerignore(w_dir: str) -> list:
+    # правила из .dockerignore: [регулярка, число каталогов в шаблоне, это исключение (!)]
+    rules = []
+    try:
+        with open(os.path.join(w_dir, '.dockerignore'), encoding='utf8') as f:
+            lines = f.readlines()
+    except OSError:
+        return rules
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        line = os.path.normpath(line.lstrip('!').strip()).lstrip('/')
+        if line in ('', '.'):
+            continue
+        rules.append([re.compile(_glob_to_regex(line) + r'\Z'), line.count('/') + 1, negate])
+    return rules
+
+
+def _is_ignored(file: str, rules: list) -> bool:
+    # Как в докере: побеждает последнее совпавшее правило, шаблон каталога исключает все его содержимое
+    ignored = False
+    parts = None
+    for regex, dirs, negate in rules:
+        match = regex.match(file)
+        if not match:
+            parts = parts or file.split('/')
+            match = len(parts) > dirs and regex.match('/'.join(parts[:dirs]))
+        if match:
+            ignored = not negate
+    return ignored
+
+
+@functools.lru_cache(maxsize=1024)
+def _sources_regex(sources: tuple):
+    # Одна регулярка на все источники COPY/ADD: файл, содержимое каталога или glob. None - источников нет
+    patterns = []
+    for src in sources:
+        if '://' in src:
+            continue
+        src = os.path.normpath(src.lstrip('/')) if src.strip('/') else '.'
+        if src == '.':
+            return re.compile('.*')
+        patterns.append(_glob_to_regex(src))
+    if not patterns:
+        return None
+    return re.compile(r'(?:{})(?:/.*)?\Z'.format('|'.join(patterns)))
+
+
+def _repo_files(w_dir: str) -> list:
+    # все файлы рабочей копии кроме .git
+    files = []
+    for dir_, dirs, names in os.walk(w_dir):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        files.extend(os.path.relpath(os.path.join(dir_, name), w_dir) for name in names)
+    return files
+
+
+def _context_files(files, sources_regex, rules: list) -> list:
+    # вернет отсортированный список файлов контекста, на которые ссылаются COPY/ADD, без игнорируемых
+    if sources_regex is None:
+        return []
+    return sorted(file for file in files if sources_regex.match(file) and not _is_ignored(file, rules))
+
+
+def _git_tree(path) -> dict:
+    # вернет {файл: хеш блоба} для HEAD, без чтения самих файлов
+    run = _run(
+        ['git', '-C', path, 'ls-tree', '-r', '-z', 'HEAD'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if run.returncode:
+        return {}
+    tree = {}
+    for line in run.stdout.decode().split('\0'):
+        if '\t' in line:
+            info, file = line.split('\t', 1)
+            tree[file] = info.split()[-1]
+    return tree
+
+
+def _build_fingerprint(w_dir: str, dockerfile: str, tag: str, buildargs: dict or None, info: DockerfileInfo,
+                       repo: dict, triggers: str = '') -> str:
+    # Отпечаток сборки: докерфайл, файлы из его COPY/ADD, тег, аргументы сборки и отпечаток файлов под триггерами.
+    # Хеши файлов берем из git, читаем только то, чего в нем нет.
+    fingerprint = hashlib.sha256()
+    with open(os.path.join(w_dir, dockerfile), 'rb') as fp:
+        fingerprint.update(fp.read())
+    for src in info.context_sources(buildargs):
+        if '://' in src:
+            fingerprint.update('url\0{}\0'.format(src).encode())
+    tree = repo['tree']
+    # Докерфайлы репа обычно копируют одно и то же, список файлов контекста считаем один раз на набор источников
+    regex = info.regex(buildargs)
+    key = regex.pattern if regex else None
+    if key not in repo['context']:
+        repo['context'][key] = _context_files(tree or _repo_files(w_dir), regex, repo['rules'])
+    for file in repo['context'][key]:
+        file_hash = tree.get(file)
+        if file_hash is None:
+            file_hash = hashlib.sha256()
+            try:
+                with open(os.path.join(w_dir, file), 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1 << 20), b''):
+                        file_hash.update(chunk)
+            except OSError:
+                pass
+            file_hash = file_hash.hexdigest()
+        fingerprint.update('{}\0{}\0'.format(file, file_hash).encode())
+    params = {'tag': tag, 'buildargs': buildargs}
+    if triggers:
+        params['triggers'] = triggers
+    fingerprint.update(json.dumps(params, sort_keys=True).encode())
+    return fingerprint.hexdigest()
+
+
 def _is_git(path) -> bool:
-    # гит или не гит
-    run = subprocess.run(['git', '-C', path, 'status'], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    return not run.returncode
+    # гит или не гит: рабочая копия с читаемым HEAD, без запуска git status
+    git_dir = _git_dir(path)
+    return git_dir is not None and os.path.abspath(git_dir) != os.path.abspath(path) and bool(_git_get_full_hash(path))
 
 
-def _git_clone(url, path) -> bool:
+def _is_git_mirror(path) -> bool:
+    # голый реп без рабочей копии
+    run = _run(
+        ['git', '-C', path, 'rev-parse', '--is-bare-repository'],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.PIPE
+    )
+    return not run.returncode and run.stdout.decode().strip() == 'true'
+
+
+def _git_clone(url, path, mirror: bool = False) -> bool:
     if os.path.isdir(path):
         shutil.rmtree(path, ignore_errors=True)
-    run = subprocess.run(['git', 'clone', url, path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Зеркало - голый реп без блобов, для списка измененных файлов хватит комитов и деревьев
+    cmd = ['git', 'clone', '--mirror', '--filter=blob:none', url, path] if mirror else ['git', 'clone', url, path]
+    run = _run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if run.returncode:
         print('Clone error {} to {}: {}'.format(url, path, run.stderr.decode()))
         return False
     return True
 
 
-def _git_pull(path) -> list:
-    # вернет список изменившихся файлов
+def _git_pull(path) -> tuple:
+    # вернет список изменившихся файлов, хеш до и после пула
     old_hash = _git_get_full_hash(path)
-    run = subprocess.run(['git', '-C', path, 'pull'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    run = _run(['git', '-C', path, 'pull'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     new_hash = _git_get_full_hash(path)
     if run.returncode:
         print('Pull error {}'.format(path))
         print(run.stderr.decode())
-        return []
+        return [], old_hash, new_hash
     if old_hash == new_hash or not len(old_hash) or not len(new_hash):
-        return []
-    run = subprocess.run(
+        return [], old_hash, new_hash
+    return _git_diff(path, old_hash, new_hash) or [], old_hash, new_hash
+
+
+def _git_remote_head(url) -> str:
+    # HEAD удаленного репа без fetch, или '' если не вышло
+    run = _run(['git', 'ls-remote', url, 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if run.returncode:
+        return ''
+    line = run.stdout.decode().split('\n', 1)[0]
+    return line.split('\t', 1)[0] if '\t' in line else ''
+
+
+def _git_fetch(path) -> tuple:
+    # _git_pull для зеркала: вернет список изменившихся файлов, хеш до и после
+    old_hash = _git_get_full_hash(path)
+    run = _run(
+        ['git', '-C', path, 'fetch', '--prune', 'origin'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    new_hash = _git_get_full_hash(path)
+    if run.returncode:
+        print('Fetch error {}'.format(path))
+        print(run.stderr.decode())
+        return [], old_hash, new_hash
+    if old_hash == new_hash or not len(old_hash) or not len(new_hash):
+        return [], old_hash, new_hash
+    return _git_diff_tree(path, old_hash, new_hash) or [], old_hash, new_hash
+
+
+def _git_diff_tree(path, old_hash, new_hash) -> list or None:
+    # как _git_diff, но сравнивает только деревья - работает в зеркале без блобов
+    run = _run(
+        ['git', '-C', path, 'diff-tree', '-r', '-z', '--name-only', '--no-commit-id', old_hash, new_hash],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if not run.returncode:
+        return [file for file in run.stdout.decode().strip('\n\0').split('\0') if file]
+    return None
+
+
+def _git_diff(path, old_hash, new_hash) -> list or None:
+    # вернет список файлов изменившихся между комитами или None, если old_hash неизвестен
+    run = _run(
         ['git', '-C', path, 'diff', '-z', '--name-only', old_hash, new_hash],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE
     )
     if not run.returncode:
-        return run.stdout.decode().strip('\n\0').split('\0')
-    return []
+        return [file for file in run.stdout.decode().strip('\n\0').split('\0') if file]
+    return None
+
+
+def _git_dir(path) -> str or None:
+    # .git рабочей копии, файл-ссылка gitdir: или сам голый реп
+    dot_git = os.path.join(path, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    if os.path.isfile(dot_git):
+        with open(dot_git, encoding='utf8') as f:
+            line = f.readline().strip()
+        if line.startswith('gitdir:'):
+            return os.path.join(path, line[7:].strip())
+        return None
+    if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects')):
+        return path
+    return None
+
+
+def _git_read_ref(git_dir: str, ref: str) -> str:
+    # хеш ссылки из refs/ или packed-refs, '' если не нашли
+    common_dir = git_dir
+    if os.path.isfile(os.path.join(git_dir, 'commondir')):
+        with open(os.path.join(git_dir, 'commondir'), encoding='utf8') as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    for dir_ in (git_dir, common_dir):
+        try:
+            with open(os.path.join(dir_, ref), encoding='utf8') as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.startswith('ref:'):
+            return _git_read_ref(git_dir, value[4:].strip())
+        return value
+    try:
+        with open(os.path.join(common_dir, 'packed-refs'), encoding='utf8') as f:
+            for line in f:
+                if line.endswith(' {}\n'.format(ref)) or line.rstrip('\n').endswith(' {}'.format(ref)):
+                    return line.split(' ', 1)[0]
+    except OSError:
+        pass
+    return ''
 
 
 def _git_get_full_hash(path) -> str:
-    run = subprocess.run(['git', '-C', path, 'log', '-n', '1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # HEAD читаем прямо из .git, git запускаем только если не разобрались (reftable и т.п.)
+    try:
+        git_dir = _git_dir(path)
+        head = _git_read_ref(git_dir, 'HEAD') if git_dir else ''
+    except OSError:
+        head = ''
+    if re.fullmatch('[0-9a-f]{40}|[0-9a-f]{64}', head):
+        return head
+    run = _run(['git', '-C', path, 'log', '-n', '1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if not run.returncode:
         # commit 2a2f3f60c7bc168c3121c07fefc84bedf9ed4abd\n -> 2a2f3f60c7bc168c3121c07fefc84bedf9ed4abd or ''
         return run.stdout.decode().split('\n')[0].split(' ')[-1]
     return ''
 
 
+# путь -> (хеш HEAD, отметка тегов, {c_short, tag_full, tag}). Одинаковые репы в разных целях считаются один раз,
+# на путь - только последний HEAD, чтобы в режиме демона кеш не рос с каждым комитом
+_git_meta_cache = {}
+_git_meta_lock = threading.Lock()
+
+
+def _git_tags_stamp(path) -> tuple:
+    # Новый тег не двигает HEAD, но меняет refs/tags или packed-refs
+    git_dir = _git_dir(path)
+    stamp = []
+    for name in ('refs/tags', 'packed-refs'):
+        try:
+            stamp.append(os.stat(os.path.join(git_dir, name)).st_mtime_ns if git_dir else 0)
+        except OSError:
+            stamp.append(0)
+    return tuple(stamp)
+
+
+def _git_get_meta(path: str, c_full: str) -> dict:
+    # Один вызов git на все: describe --long --always дает тег, число комитов после него и короткий хеш,
+    # а без тегов - только короткий хеш.
+    path, key = os.path.abspath(path), (c_full, _git_tags_stamp(path))
+    with _git_meta_lock:
+        cached = _git_meta_cache.get(path)
+        if cached and cached[:2] == key:
+            return cached[2]
+    run = _run(
+        ['git', '-C', path, 'describe', '--long', '--always', '--abbrev=7'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    meta = {'c_short': '', 'tag_full': '', 'tag': ''}
+    if not run.returncode:
+        describe = run.stdout.decode().strip()
+        match = re.fullmatch(r'(.+)-(\d+)-g([0-9a-f]+)', describe)
+        if match:
+            # 0.7.1-0-gdc36179 -> 0.7.1, как у обычного describe на самом теге
+            meta['tag'] = match.group(1)
+            meta['tag_full'] = match.group(1) if match.group(2) == '0' else describe
+            meta['c_short'] = match.group(3)
+        else:
+            meta['c_short'] = describe
+    with _git_meta_lock:
+        _git_meta_cache[path] = key + (meta,)
+    return meta
+
+
 def _git_get_tags(path: str, cfg: dict) -> dict:
     # вернет заполненные теги
-    def get_git_str(cmd_: list) -> str:
-        cmd = ['git', '-C', path]
-        run = subprocess.run(cmd + cmd_, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return run.stdout.decode().strip('\n') if not run.returncode else ''
-
     tag_c_full = _git_get_full_hash(path)
+    meta = _git_get_meta(path, tag_c_full) if tag_c_full else {}
     ready = {
         # arm64v8
         'arch': cfg['arch'],
         # 2a2f3f60c7bc168c3121c07fefc84bedf9ed4abd
         'c_full': tag_c_full,
         # 2a2f3f60c7bc168c3121c07fefc84bedf9ed4abd -> 2a2f3f6
-        'c_short': get_git_str(['rev-parse', '--short=7', tag_c_full]),
+        'c_short': meta.get('c_short'),
         # 0.7.1-1-gdc36179
-        'tag_full': get_git_str(['describe', ]),
+        'tag_full': meta.get('tag_full'),
         # 0.7.1
-        'tag': get_git_str(['describe', '--abbrev=0'])
+        'tag': meta.get('tag')
     }
     tags = DEF_TAGS.copy()
     for key, value in ready.items():
@@ -221,14 +1470,39 @@ def _git_get_tags(path: str, cfg: dict) -> dict:
     return tags
 
 
-def __docker_run_fatal(cmd2: list, fatal: bool = True):
-    run = subprocess.run(['docker', ] + cmd2, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    if run.returncode:
+# Один клиент докера (и пул соединений к демону) на весь процесс, его делят все потоки.
+DOCKER_POOL_SIZE = 32
+# Сколько удалений контейнеров\образов идут к демону одновременно
+DOCKER_BATCH_T = 8
+_docker_lock = threading.Lock()
+_docker_clients = {}
+# {'username': ..., 'password': ...} после логина, новые клиенты логинятся сами
+_docker_credentials = {}
+
+
+def _docker_client(base_url: str = None) -> docker.DockerClient:
+    with _docker_lock:
+        if base_url not in _docker_clients:
+            if base_url:
+                client = docker.DockerClient(base_url=base_url, max_pool_size=DOCKER_POOL_SIZE)
+            else:
+                client = docker.from_env(max_pool_size=DOCKER_POOL_SIZE)
+            client.api.request = _traced_request(client.api.request, 'docker')
+            if _docker_credentials:
+                client.login(**_docker_credentials)
+            _docker_clients[base_url] = client
+        return _docker_clients[base_url]
+
+
+def __docker_run_fatal(call, name: str, fatal: bool = True):
+    # Вызов API докера, ошибки как раньше у CLI: исключение или просто сообщение
+    try:
+        return call()
+    except (docker.errors.APIError, requests.exceptions.RequestException) as e:
         if fatal:
-            raise RuntimeError('Error docker {}: {}'.format(' '.join(cmd2), run.stderr.decode()))
-        else:
-            print('Error docker {}: {}'.format(' '.join(cmd2), run.stderr.decode()))
-    return run
+            raise RuntimeError('Error docker {}: {}'.format(name, e))
+        print('Error docker {}: {}'.format(name, e))
+    return None
 
 
 def _docker_login(cfg):
@@ -237,46 +1511,177 @@ def _docker_login(cfg):
         data = [i.strip() for i in f.readline().strip('\n').split(' ', 1)]
     if len(data) != 2:
         raise RuntimeError('Bad credentials, file {}, len={}!=2'.format(cfg['credentials'], len(data)))
-    run = subprocess.run(
-        ['docker', 'login', '-u', data[0], '-p', data[1]],
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE
-    )
     cfg['user'] = data[0]
-    if run.returncode:
-        raise RuntimeError('Error docker login: {}'.format(run.stderr.decode()))
+    with _docker_lock:
+        if _docker_credentials == {'username': data[0], 'password': data[1]}:
+            return  # В режиме демона уже залогинены с прошлого запуска
+    try:
+        _docker_client().login(username=data[0], password=data[1])
+    except docker.errors.APIError as e:
+        raise RuntimeError('Error docker login: {}'.format(e))
+    with _docker_lock:
+        _docker_credentials.update(username=data[0], password=data[1])
 
 
 def docker_logout():
-    __docker_run_fatal(['logout', ])
+    # Забываем авторизацию и закрываем соединения
+    with _docker_lock:
+        _docker_credentials.clear()
+        for client in _docker_clients.values():
+            client.close()
+        _docker_clients.clear()
 
 
-def _docker_containers():
-    # вернет список из [ид образа, имя контейнера], ps -a --format "{{.Image}} {{.Names}}"
-    run = __docker_run_fatal(['ps', '-a', '--format', '{{.Image}} {{.Names}}'])
-    return [line.split(' ', 1) for line in run.stdout.decode().split('\n') if len(line) > 2]
+def _docker_containers(base_url: str = None):
+    # вернет список из [ид образа, имя контейнера, образ из которого создан], ps -a
+    api = _docker_client(base_url).api
+    containers = __docker_run_fatal(lambda: api.containers(all=True), 'ps')
+    return [[c['ImageID'], name.lstrip('/'), c['Image']] for c in containers for name in c['Names'][:1]]
 
 
-def _docker_images():
-    # Вернет список из [ид образа, реп:тег], docker images --format "{{.ID}} {{.Repository}}:{{.Tag}}
-    run = __docker_run_fatal(['images', '--format', '{{.ID}} {{.Repository}}:{{.Tag}}'])
-    return [line.split(' ', 1) for line in run.stdout.decode().split('\n') if len(line) > 2]
+def _docker_images(base_url: str = None):
+    # Вернет список из [ид образа, реп:тег], docker images
+    api = _docker_client(base_url).api
+    images = __docker_run_fatal(lambda: api.images(), 'images')
+    return [[image['Id'], tag] for image in images for tag in image['RepoTags'] or [] if tag != '<none>:<none>']
 
 
-def _docker_prune_container(name: str):
+def _docker_prune_container(name: str, base_url: str = None):
     # Остановит и удалит контейнер
-    __docker_run_fatal(['stop', name])
-    __docker_run_fatal(['rm', name])
+    api = _docker_client(base_url).api
+    __docker_run_fatal(lambda: api.stop(name), 'stop {}'.format(name))
+    __docker_run_fatal(lambda: api.remove_container(name), 'rm {}'.format(name))
+
+
+def _docker_image_exists(image_id: str) -> bool:
+    try:
+        _docker_client().api.inspect_image(image_id)
+    except docker.errors.ImageNotFound:
+        return False
+    return True
+
+
+def docker_root_dir() -> str or None:
+    # Каталог данных докера, если демон на этой машине
+    info = __docker_run_fatal(lambda: _docker_client().info(), 'info', False)
+    root = info and info.get('DockerRootDir')
+    return root if root and os.path.isdir(root) else None
 
 
-def docker_prune_image(name: str, fatal: bool = True):
+def docker_image_size(image_id: str, base_url: str = None) -> int:
+    api = _docker_client(base_url).api
+    image = __docker_run_fatal(lambda: api.inspect_image(image_id), 'inspect {}'.format(image_id), False)
+    return image['Size'] if image else 0
+
+
+def docker_prune_image(name: str, fatal: bool = True, base_url: str = None) -> bool:
     # Удалит образ по реп:тег
-    __docker_run_fatal(['rmi', name], fatal)
+    api = _docker_client(base_url).api
+    return bool(__docker_run_fatal(lambda: api.remove_image(name) or True, 'rmi {}'.format(name), fatal))
 
 
 def docker_system_prune(fatal: bool = False):
     # docker system prune -f
-    __docker_run_fatal(['system', 'prune', '-f'], fatal)
+    api = _docker_client().api
+    for name, call in (
+            ('containers', api.prune_containers),
+            ('images', lambda: api.prune_images(filters={'dangling': True})),
+            ('networks', api.prune_networks),
+            ('builds', api.prune_builds),
+    ):
+        __docker_run_fatal(call, 'prune {}'.format(name), fatal)
+
+
+def _type_name(type_) -> str:
+    return ' or '.join(t.__name__ for t in type_) if isinstance(type_, tuple) else type_.__name__
+
+
+def check_cfg(cfg: dict, defaults: dict) -> list:
+    # Ошибки в настройках: тип как у значения по умолчанию (числа взаимозаменяемы) и допустимые значения.
+    # Неизвестные ключи только печатаем
+    errors = []
+    for key, value in cfg.items():
+        if key not in defaults:
+            print('Unknown setting \'{}\', ignore'.format(key))
+            continue
+        default = defaults[key]
+        if isinstance(default, bool) or not isinstance(default, (int, float)):
+            type_ = type(default)
+        else:
+            type_ = (int, float)
+        if not isinstance(value, type_) or (isinstance(value, bool) and not isinstance(default, bool)):
+            errors.append('\'{}\' must be {}, not {}'.format(key, _type_name(type_), type(value).__name__))
+    if errors:
+        return errors
+    cfg = dict(defaults, **cfg)
+    if cfg['cache'] not in CACHE_POLICIES:
+        errors.append('\'cache\' must be one of {}'.format(', '.join(CACHE_POLICIES)))
+    for key in ('max_sync_t', 'max_build_t', 'max_push_t'):
+        if cfg[key] < 1:
+            errors.append('\'{}\' must be at least 1'.format(key))
+    if not 0 <= cfg['disk_watermark'] <= 100:
+        errors.append('\'disk_watermark\' must be from 0 to 100')
+    for arch, urls in cfg['nodes'].items():
+        if not isinstance(urls, list) or not urls or not all(isinstance(url, str) and url for url in urls):
+            errors.append('\'nodes\'.{}: must be a non-empty list of DOCKER_HOST urls'.format(arch))
+    return errors
+
+
+def check_targets(targets: list) -> list:
+    # Ошибки в TARGETS, с путем до неверного значения. Подстановки в тегах проверяются при планировании
+    errors = []
+
+    def need(where: str, value, type_, items=None) -> bool:
+        if isinstance(value, type_) and (items is None or all(isinstance(item, items) for item in value)):
+            return True
+        of = ' of {}'.format(_type_name(items)) if items else ''
+        errors.append('{}: must be {}{}'.format(where, _type_name(type_), of))
+        return False
+
+    for n, entry in enumerate(targets):
+        where = 'TARGETS[{}]'.format(n)
+        if not need(where, entry, dict):
+            continue
+        need(where + '.git', entry.get('git'), str)
+        need(where + '.dir', entry.get('dir'), str)
+        if not need(where + '.targets', entry.get('targets'), list):
+            continue
+        for i, target in enumerate(entry['targets']):
+            at = '{}.targets[{}]'.format(where, i)
+            if not need(at, target, dict):
+                continue
+            need(at + '.registry', target.get('registry'), str)
+            for key in ('triggers', 'depends', 'manifest', 'manifest_tags'):
+                if key in target:
+                    need('{}.{}'.format(at, key), target[key], list, str)
+            if 'cache' in target and target['cache'] not in CACHE_POLICIES:
+                errors.append('{}.cache: must be one of {}'.format(at, ', '.join(CACHE_POLICIES)))
+            if 'cache_days' in target:
+                need(at + '.cache_days', target['cache_days'], (int, float))
+            if not need(at + '.build', target.get('build'), list):
+                continue
+            for b, build in enumerate(target['build']):
+                if not isinstance(build, list) or len(build) not in (2, 3) \
+                        or not all(isinstance(item, str) for item in build[:2]) \
+                        or (len(build) == 3 and not isinstance(build[2], dict)):
+                    errors.append('{}.build[{}]: must be [dockerfile, tag] or [dockerfile, tag, {{buildargs}}]'.format(
+                        at, b))
+    return errors
+
+
+def check_git_triggers(git_triggers: dict) -> list:
+    # Ошибки в GIT_TRIGGERS
+    errors = []
+    for dir_, entry in git_triggers.items():
+        where = 'GIT_TRIGGERS[{}]'.format(dir_)
+        if not isinstance(entry, dict) or not isinstance(entry.get('git'), str) \
+                or not isinstance(entry.get('triggers'), dict):
+            errors.append('{}: must be {{\'git\': url, \'triggers\': {{name: [files]}}}}'.format(where))
+            continue
+        for name, files in entry['triggers'].items():
+            if not isinstance(files, list) or not all(isinstance(file, str) for file in files):
+                errors.append('{}.triggers.{}: must be list of str'.format(where, name))
+    return errors
 
 
 def _cfg_prepare(cfg: dict):
@@ -297,6 +1702,151 @@ def _cfg_prepare(cfg: dict):
     return cfg
 
 
+# Сколько последних отпечатков сборки помнить на докерфайл цели, более старые удаляются из BuildState
+FINGERPRINT_KEEP = 3
+
+
+class BuildState:
+    """Состояние сборок между запусками, лежит в work_dir.
+    Журнал из JSON-строк {"key": ..., "value": ...}, побеждает последняя запись по ключу, null - ключ удален.
+    Запись дописывается сразу, так что прерванный запуск ничего не теряет."""
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._data = {}
+        self._load()
+
+    def _load(self):
+        lines = 0
+        try:
+            with open(self._path, encoding='utf8') as fp:
+                for line in fp:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                        if record['value'] is None:
+                            self._data.pop(record['key'], None)
+                        else:
+                            self._data[record['key']] = record['value']
+                    except (ValueError, KeyError, TypeError):
+                        # Недописанная строка из упавшего запуска
+                        continue
+        except FileNotFoundError:
+            return
+        if lines > 2 * len(self._data) + 100:
+            self._compact()
+
+    def _compact(self):
+        tmp = '{}.tmp'.format(self._path)
+        with open(tmp, 'w', encoding='utf8') as fp:
+            for key, value in self._data.items():
+                fp.write(json.dumps({'key': key, 'value': value}) + '\n')
+        os.replace(tmp, self._path)
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key: str, value):
+        self.update({key: value})
+
+    def update(self, values: dict):
+        # Пачка записей одной дозаписью в журнал
+        with self._lock:
+            lines = []
+            for key, value in values.items():
+                if self._data.get(key) != value:
+                    self._data[key] = value
+                    lines.append(json.dumps({'key': key, 'value': value}) + '\n')
+            if lines:
+                with open(self._path, 'a', encoding='utf8') as fp:
+                    fp.writelines(lines)
+
+    def delete(self, keys: list):
+        with self._lock:
+            lines = [
+                json.dumps({'key': key, 'value': None}) + '\n' for key in keys if self._data.pop(key, None) is not None
+            ]
+            if lines:
+                with open(self._path, 'a', encoding='utf8') as fp:
+                    fp.writelines(lines)
+
+
+class RepoSync:
+    """Синхронизация репов ограниченным пулом потоков.
+    Каждый url синхронизируется один раз за запуск, остальные запросы ждут результат первого."""
+    def __init__(self, workers: int):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='sync')
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._start = time.time()
+        self._wall = 0
+        self._busy = 0.0
+
+    def submit(self, url: str, func, *args) -> concurrent.futures.Future:
+        with self._lock:
+            if url not in self._futures:
+                self._futures[url] = self._pool.submit(self._timed, url, func, *args)
+            return self._futures[url]
+
+    def _timed(self, url: str, func, *args):
+        work_time, result = time.time(), None
+        try:
+            with tracer.span('sync {}'.format(url), 'thread'):
+                result = func(*args)
+            return result
+        finally:
+            with self._lock:
+                self._busy += time.time() - work_time
+            metrics.task('sync', url, time.time() - work_time, result is not None)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self._wall = time.time() - self._start
+
+    def report(self) -> str:
+        count = len(self._futures)
+        return 'Repo sync: {} repos in {:.2f} sec, {:.2f} repos/sec, busy {:.2f} sec'.format(
+            count, self._wall, count / self._wall if self._wall else 0, self._busy
+        )
+
+
+class BuildPlan:
+    """Сборка одного докерфайла цели. Отброшенные планировщиком тоже здесь, с причиной в reason."""
+    __slots__ = ('name', 'source', 'path', 'w_dir', 'buildargs', 'reuse', 'cache', 'arch', 'bases', 'depends',
+                 'state_key', 'state', 'repo', 'fingerprint', 'reason', 'allowed', 'skip')
+
+    def __init__(self, name: str, source: str = '', path: str = '', w_dir: str = '', buildargs: dict = None,
+                 cache: dict = None, arch: str = '', bases: list = None, depends: set = None, state_key: str = '',
+                 state: dict = None, repo: dict = None):
+        # реп:тег, докерфайл относительно work_dir (для сообщений), полные пути докерфайла и контекста
+        self.name = name
+        self.source = source
+        self.path = path
+        self.w_dir = w_dir
+        self.buildargs = buildargs
+        # ид уже собранного образа с тем же отпечатком, его достаточно перетегировать
+        self.reuse = None
+        self.cache = cache or {'policy': 'nocache', 'nocache': True, 'cache_from': None}
+        # архитектура узла и внешние базовые образы из FROM
+        self.arch = arch
+        self.bases = bases or []
+        # реп:тег, от которых зависит
+        self.depends = depends or set()
+        # ключ и запись в BuildState, синхронизированный реп
+        self.state_key = state_key
+        self.state = state
+        self.repo = repo
+        self.fingerprint = None
+        self.reason = ''
+        # собирать ли; skip - уже собран и запушен такой же (по отпечатку)
+        self.allowed = True
+        self.skip = False
+
+    def __repr__(self):
+        return '<BuildPlan {} {}>'.format(self.name, 'allowed' if self.allowed else self.reason)
+
+
 class GenerateBuilds:
     def __init__(self, cfg, targets_all, git_triggers, args):
         self._cli = args
@@ -307,127 +1857,307 @@ class GenerateBuilds:
         self.to_build = []
         self.all_build_name = set()
         self.manifests = dict()
+        # реп:тег -> множество реп:тег от которых он зависит, только среди собираемых в этом запуске
+        self.depends = dict()
         # Не дублировать репозитории. Если реп уже обновлен используем его и его данные для других. Уникальный id - url
-        # Формат 'url': {dir: dir, files: [] or None}
+        # Формат 'url': {dir: dir, files: [] or None, old: хеш до пула или None, head: хеш после}
         self.known_repos = {}
+        # Последние успешно собранные комиты по целям, переживают упавшие и прерванные запуски
+        self.state = BuildState(os.path.join(self.cfg['work_dir'], self.cfg['state']))
+        # (url, комит) -> изменения от комита до head
+        self._changes_since = {}
+        self._sync = None
+        # url -> {tree: {файл: хеш блоба}, rules: правила .dockerignore, context: файлы контекста по регулярке,
+        # all: файлы дерева для триггеров, triggers: шаблоны триггеров -> отпечаток подходящих файлов}
+        self._repo_info = {}
+        # путь к докерфайлу -> {sources: источники COPY/ADD, regex: регулярка по ним, froms: ARG и FROM}
+        self._dockerfile_info = {}
+        # базовый образ -> digest: из регистра при base_trigger, иначе из скачанного заранее
+        self.base_digests = {}
         if self._cli.v:
             print('Architecture: {}'.format(self.cfg['arch']))
 
     def get(self):
-        self._generate()
+        with metrics.phase('plan'):
+            self._generate()
+            self._base_check()
+            self._resolve_depends()
+            self._mark_state()
         return_me = []
         print_allow = []
         print_ignore = []
         for i in self.to_build:
-            if i['true']:
-                print_allow.append('Allow building {} from {}: {}'.format(i['cmd'][0], i['cmd'][1], i['reason']))
-                # Дополняем пути
-                i['cmd'][1] = os.path.join(self.cfg['work_dir'], i['cmd'][1])
-                i['cmd'][2] = os.path.join(self.cfg['work_dir'], i['cmd'][2])
-                return_me.append(i['cmd'])
+            if i.allowed:
+                cache = 'no cache' if i.cache['nocache'] else 'cache: {}'.format(i.cache['policy'])
+                if i.arch != self.cfg['arch']:
+                    cache += ', node: {}'.format(i.arch)
+                print_allow.append('Allow building {} from {}: {} [{}]'.format(
+                    i.name, i.source, i.reason, cache))
+                return_me.append(i)
             else:
-                print_ignore.append('Ignore {} from {}: {}'.format(i['cmd'][0], i['cmd'][1], i['reason']))
+                print_ignore.append('Ignore {} from {}: {}'.format(i.name, i.source, i.reason))
         if len(print_ignore) and self._cli.v:
             print()
             print('\n'.join(print_ignore))
         if len(print_allow):
             print()
             print('\n'.join(print_allow))
-        return return_me, self.manifests
+        return return_me, self.manifests, self.depends
+
+    def _mark_state(self):
+        # Запланированные сборки помечаем как незавершенные, сохраняя комит последней успешной.
+        # Для остальных текущий комит становится точкой отсчета.
+        self._done = {}
+        marks = {}
+        for e in self.to_build:
+            if e.allowed:
+                commit = e.state['commit'] if e.state else e.repo['old']
+                marks[e.state_key] = {'commit': commit, 'pending': True}
+                self._done[e.name] = (e.state_key, e.repo['head'], e.fingerprint, e.cache['nocache'], e.bases)
+            elif e.repo['head']:
+                marks[e.state_key] = {'commit': e.repo['head'], 'pending': False}
+        self.state.update(marks)
+
+    def built(self, build_name: str, image_id: str or None):
+        # Образ собран, запоминаем его по отпечатку
+        if build_name not in self._done:
+            return
+        key, _, fingerprint, nocache, _ = self._done[build_name]
+        if nocache and image_id:
+            self.state.set('nocache:{}'.format(key), int(time.time()))
+        if fingerprint and image_id:
+            known = {'image': image_id, 'name': build_name, 'pushed': False}
+            # Отпечатки прошлых комитов больше не совпадут, храним только последние FINGERPRINT_KEEP на докерфайл
+            history = self.state.get('fingerprints:{}'.format(key), [])
+            history = [old for old in history if old != fingerprint] + [fingerprint]
+            self.state.update({
+                'fingerprint:{}'.format(fingerprint): known, 'fingerprints:{}'.format(key): history[-FINGERPRINT_KEEP:]
+            })
+            self.state.delete(['fingerprint:{}'.format(old) for old in history[:-FINGERPRINT_KEEP]])
+        if not self.cfg['auto_push']:
+            self.done(build_name)
+
+    def done(self, build_name: str):
+        # Образ собран и запушен (или просто собран, если пушить не нужно)
+        if build_name not in self._done:
+            return
+        key, commit, fingerprint, _, bases = self._done.pop(build_name)
+        self.state.set(key, {'commit': commit, 'pending': False})
+        digests = {image: self.base_digests[image] for image in bases if image in self.base_digests}
+        if digests:
+            self.state.set('bases:{}'.format(key), digests)
+        known = self.state.get('fingerprint:{}'.format(fingerprint)) if fingerprint else None
+        if known and known['name'] == build_name:
+            self.state.set('fingerprint:{}'.format(fingerprint), dict(known, pushed=True))
+
+    def base_pulled(self, image: str, digest: str or None):
+        if digest:
+            self.base_digests.setdefault(image, digest)
+
+    def _base_check(self):
+        # CFG['base_trigger']: базовый образ обновился в регистре с последней сборки - пересобираем.
+        # Образы разных целей одни и те же, каждый спрашиваем у регистра один раз и параллельно
+        if not self.cfg['base_trigger']:
+            return
+        entries = [e for e in self.to_build if e.bases]
+        images = sorted({image for e in entries for image in e.bases})
+        registries = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DOCKER_BATCH_T, thread_name_prefix='base') as pool:
+            digests = dict(zip(images, pool.map(lambda image: base_image_digest(image, registries), images)))
+        self.base_digests.update((image, digest) for image, digest in digests.items() if digest)
+        for e in entries:
+            key = 'bases:{}'.format(e.state_key)
+            known = self.state.get(key)
+            current = {image: digests[image] for image in e.bases if digests[image]}
+            if known is None:
+                # Точка отсчета. Собираемые запишем после сборки
+                if not e.allowed and current:
+                    self.state.set(key, current)
+                continue
+            changed = [image for image, digest in current.items() if known.get(image, digest) != digest]
+            if not changed:
+                continue
+            reason = 'Base image change: {}'.format(changed[0])
+            if e.allowed and e.reuse:
+                # Готовый образ собран на старой базе, перетегировать нельзя
+                e.reuse = None
+                e.reason += ', {}'.format(reason.lower())
+            elif e.skip or (not e.allowed and e.reason == 'No change' and e.name not in self.all_build_name):
+                e.allowed, e.skip, e.reason = True, False, reason
+                self.all_build_name.add(e.name)
+
+    def _resolve_depends(self):
+        # Пересобираем зависимые от пересобираемых образов, выкидываем циклы
+        # и упорядочиваем to_build так, чтобы базовые образы шли раньше зависимых.
+        by_name = {}
+        dependents = {}
+        for e in self.to_build:
+            by_name.setdefault(e.name, e)
+            for dep in e.depends:
+                dependents.setdefault(dep, []).append(e)
+
+        # Перетегированный образ не новый, его зависимым пересобираться незачем
+        queue_ = [e for e in self.to_build if e.allowed and not e.reuse]
+        while queue_:
+            base = queue_.pop()
+            for e in dependents.get(base.name, []):
+                if e.allowed and e.reuse:
+                    e.reuse = None
+                elif e.skip:
+                    e.skip = False
+                elif e.allowed or e.reason != 'No change' or e.name in self.all_build_name:
+                    continue
+                else:
+                    self.all_build_name.add(e.name)
+                e.allowed, e.reason = True, 'Dependency rebuild: {}'.format(base.name)
+                queue_.append(e)
+
+        # Топологическая сортировка (Кан) среди разрешенных сборок
+        allowed = [e for e in self.to_build if e.allowed]
+        depends = {
+            e.name: {dep for dep in e.depends if dep in by_name and by_name[dep].allowed} for e in allowed
+        }
+        in_degree = {name: len(deps) for name, deps in depends.items()}
+        ready = collections.deque(e for e in allowed if not in_degree[e.name])
+        ordered = []
+        while ready:
+            e = ready.popleft()
+            ordered.append(e)
+            for child in dependents.get(e.name, []):
+                if child.allowed and child.name in in_degree:
+                    in_degree[child.name] -= 1
+                    if not in_degree[child.name]:
+                        ready.append(child)
+        for e in allowed:
+            if in_degree[e.name]:
+                e.allowed, e.reason = False, 'Dependency cycle'
+                del depends[e.name]
+        self.depends = {name: deps for name, deps in depends.items() if deps}
+        self.to_build = ordered + [e for e in self.to_build if not e.allowed]
 
-    def _triggers_check(self, files: list, change_files: list or None):
+    @staticmethod
+    def _triggers_check(files: list, change_files: ChangedFiles or None):
         if change_files is None:
             return True, 'clone'
-        for file in files:
-            if file.startswith('*'):  # Триггер или любой файл
-                if len(file) == 1 and len(change_files):  # Любой файл. Триггеры в другом месте проверим
-                    return True, 'any'
-            elif file.endswith('*'):
-                if self._startswith_list(file[:-1], change_files):
-                    return True, file
-            elif file in change_files:
-                return True, file
-        return False, None
-
-    @staticmethod
-    def _startswith_list(start: str, files: list) -> bool:
-        for file in files:
-            if file.startswith(start):
-                return True
-        return False
+        if not len(change_files):
+            return False, None
+        matcher = _trigger_matcher(tuple(files))
+        if matcher.any:  # Любой файл. Триггеры в другом месте проверим
+            return True, 'any'
+        change_of = matcher.match(change_files)
+        return change_of is not None, change_of
 
     @staticmethod
     def _git_triggers_check(files: list, triggers: dict):
         for file in files:
-            if file.startswith('*') and len(file) > 1:  # Триггер
+            if file.startswith('*') and len(file) > 1 and not file.startswith('**'):  # Триггер
                 if triggers.get(file[1:], False):
                     return True, file[1:]
         return False, None
 
     def _generate_git_triggers(self):
-        # Обработка GIT_TRIGGERS
-        workers = []
+        # Обработка GIT_TRIGGERS. Репы из TARGETS уже отданы на синхронизацию, такие же url ждут их результат
+        futures = []
         for dir_ in self.git_triggers:
             git = self.git_triggers[dir_]['git']
             file_triggers = self.git_triggers[dir_]['triggers']
-            th = threading.Thread(target=self.__git_triggers_th, args=(dir_, git, file_triggers))
-            th.start()
-            workers.append(th)
-        while [True for th in workers if th.is_alive()]:
-            time.sleep(0.02)
-
-    def __git_triggers_th(self, dir_, git, file_triggers):
-        if not len(file_triggers):
-            return
-        if git in self.known_repos:
-            change_files = self.known_repos[git]['files']
-        else:
+            if not len(file_triggers):
+                continue
             git_path = os.path.join(self.cfg['triggers'], dir_)
-            full_git_path = os.path.join(self.cfg['work_dir'], git_path)
-            change_files = None
-            if _is_git(full_git_path):  # Делаем пул
-                change_files = _git_pull(full_git_path)
-            else:  # клонируем
-                if not _git_clone(git, full_git_path):
-                    print('Ignore git-triggers from {}'.format(git))
-                    return
-            self.known_repos[git] = {'dir': git_path, 'files': change_files}
-        # Обходим триггеры
-        for trigger, file_list in file_triggers.items():
-            result, _ = self._triggers_check(file_list, change_files)
-            self.filled_triggers[trigger] = self.filled_triggers.get(trigger, False) | result
-
-    def _generate_targets_repo(self):
-        workers = [threading.Thread(target=self.__targets_repo_th, args=(t, )) for t in self.targets_all]
-        _ = [t.start() for t in workers]
-        while [True for th in workers if th.is_alive()]:
-            time.sleep(0.02)
-
-    def __targets_repo_th(self, targets):
-        if 'git' not in targets or 'dir' not in targets or 'targets' not in targets:
-            print('Wrong target, ignore: {}'.format(targets))
-            return
-        if targets['git'] in self.known_repos:
-            targets['dir'] = self.known_repos[targets['git']]['dir']
+            sync = self._sync_mirror if self.cfg['triggers_mirror'] else self._sync_repo
+            futures.append((git, file_triggers, self._sync.submit(git, sync, git, git_path)))
+        for git, file_triggers, future in futures:
+            repo = future.result()
+            if repo is None:
+                print('Ignore git-triggers from {}'.format(git))
+                continue
+            # Обходим триггеры
+            for trigger, file_list in file_triggers.items():
+                result, _ = self._triggers_check(file_list, repo['files'])
+                self.filled_triggers[trigger] = self.filled_triggers.get(trigger, False) | result
+
+    def _generate_targets_repo(self) -> list:
+        futures = []
+        for targets in self.targets_all:
+            future = self._sync.submit(targets['git'], self._sync_repo, targets['git'], targets['dir'])
+            futures.append((targets, future))
+        return futures
+
+    @staticmethod
+    def _wait_targets_repo(futures: list):
+        for targets, future in futures:
+            repo = future.result()
+            if repo is None:
+                print('Ignore {}'.format(targets['git']))
+            else:
+                targets['dir'] = repo['dir']
+
+    def _sync_repo(self, git, git_path) -> dict or None:
+        full_git_path = os.path.join(self.cfg['work_dir'], git_path)
+        is_git = _is_git(full_git_path)
+        head = self._precheck(git, full_git_path) if is_git else ''
+        if head:  # Удаленный реп не сдвинулся, пул не нужен
+            change_files, old_hash, new_hash = [], head, head
+        elif is_git:  # Делаем пул
+            change_files, old_hash, new_hash = _git_pull(full_git_path)
+        else:  # клонируем
+            if not _git_clone(git, full_git_path):
+                return None
+            change_files, old_hash, new_hash = None, None, _git_get_full_hash(full_git_path)
+        if change_files is not None:
+            change_files = ChangedFiles(change_files)
+        self.known_repos[git] = {'dir': git_path, 'files': change_files, 'old': old_hash, 'head': new_hash}
+        return self.known_repos[git]
+
+    def _precheck(self, git, full_git_path) -> str:
+        # Вернет локальный HEAD, если он совпадает с удаленным (git ls-remote), иначе ''
+        if not self.cfg['precheck']:
+            return ''
+        head = _git_get_full_hash(full_git_path)
+        return head if head and head == _git_remote_head(git) else ''
+
+    def _sync_mirror(self, git, git_path) -> dict or None:
+        # Для GIT_TRIGGERS нужны только имена измененных файлов, рабочая копия не нужна.
+        # Новое зеркало сравниваем с последним виденным комитом, а не считаем изменившимся целиком.
+        full_git_path = os.path.join(self.cfg['work_dir'], git_path)
+        state_key = 'trigger:{}'.format(git)
+        is_mirror = _is_git_mirror(full_git_path)
+        head = self._precheck(git, full_git_path) if is_mirror else ''
+        if head:
+            change_files, old_hash, new_hash = [], head, head
+        elif is_mirror:
+            change_files, old_hash, new_hash = _git_fetch(full_git_path)
         else:
-            full_git_path = os.path.join(self.cfg['work_dir'], targets['dir'])
-            change_files = None
-            if _is_git(full_git_path):  # Делаем пул
-                change_files = _git_pull(full_git_path)
-            else:  # клонируем
-                if not _git_clone(targets['git'], full_git_path):
-                    print('Ignore {}'.format(targets['git']))
-                    return
-            self.known_repos[targets['git']] = {'dir': targets['dir'], 'files': change_files}
+            # Была обычная рабочая копия - ее HEAD лучшая точка отсчета
+            old_hash = _git_get_full_hash(full_git_path) if _is_git(full_git_path) else self.state.get(state_key)
+            if not _git_clone(git, full_git_path, mirror=True):
+                return None
+            new_hash = _git_get_full_hash(full_git_path)
+            change_files = _git_diff_tree(full_git_path, old_hash, new_hash) if old_hash else None
+        if new_hash:
+            self.state.set(state_key, new_hash)
+        if change_files is not None:
+            change_files = ChangedFiles(change_files)
+        self.known_repos[git] = {'dir': git_path, 'files': change_files, 'old': old_hash, 'head': new_hash}
+        return self.known_repos[git]
 
     def _docker_login(self):
-        _docker_login(self.cfg)
+        with tracer.span('login', 'thread'):
+            _docker_login(self.cfg)
 
     def _prepare_all(self):
         auth_th = threading.Thread(target=self._docker_login, name='_docker_login')
         auth_th.start()
-        self._generate_targets_repo()
-        self._generate_git_triggers()
+        self._sync = RepoSync(self.cfg['max_sync_t'])
+        try:
+            with metrics.phase('sync'):
+                futures = self._generate_targets_repo()
+                self._generate_git_triggers()
+                self._wait_targets_repo(futures)
+        finally:
+            self._sync.close()
+        if self._cli.v:
+            print(self._sync.report())
         return auth_th.join()
 
     def _generate(self):
@@ -438,97 +2168,394 @@ class GenerateBuilds:
             git = targets['git']
             if git not in self.known_repos:
                 continue
+            if self._is_settled(targets):
+                if self._cli.v:
+                    print('No change in {}, skip'.format(git))
+                continue
             full_git_path = os.path.join(self.cfg['work_dir'], self.known_repos[git]['dir'])
-            change_files = self.known_repos[git]['files']
             tags = _git_get_tags(full_git_path, self.cfg)
             for target in targets['targets']:
-                self._target_check(target, change_files, tags, targets['dir'])
+                self._target_check(target, git, tags, targets['dir'])
+
+    def _is_settled(self, targets) -> bool:
+        # Реп не сдвинулся, триггеры не сработали и все его сборки уже отработаны на этом комите.
+        # Тогда его не нужно даже разбирать. С base_trigger разбираем всегда, база могла обновиться и без комитов.
+        repo = self.known_repos[targets['git']]
+        if self.cfg['force'] or self.cfg['base_trigger'] or repo['files'] is None or repo['old'] != repo['head']:
+            return False
+        for target in targets['targets']:
+            if target.get('depends') or self._git_triggers_check(target.get('triggers', []), self.filled_triggers)[0]:
+                return False
+            for build in target['build']:
+                state = self.state.get(self._state_key(targets['git'], target['registry'], build[0]))
+                if not state or state.get('pending') or state.get('commit') != repo['head']:
+                    return False
+        return True
 
-    def _target_check(self, target, change_files, tags, git_path):
-        is_file_change, change_of = self._triggers_check(target.get('triggers', []), change_files)
+    @staticmethod
+    def _state_key(git: str, registry: str, dockerfile: str) -> str:
+        return '{}|{}|{}'.format(git, registry, dockerfile)
+
+    def _build_changes(self, git: str, state: dict or None) -> ChangedFiles or None:
+        # Изменения с последней успешной сборки, а если ее не помним - с прошлого пула. None - собрать все.
+        repo = self.known_repos[git]
+        if not state or not state.get('commit') or state['commit'] == repo['old']:
+            return repo['files']
+        if state['commit'] == repo['head']:
+            return ChangedFiles([])
+        key = (git, state['commit'])
+        if key not in self._changes_since:
+            full_git_path = os.path.join(self.cfg['work_dir'], repo['dir'])
+            change_files = _git_diff(full_git_path, state['commit'], repo['head'])
+            self._changes_since[key] = ChangedFiles(change_files) if change_files is not None else None
+        return self._changes_since[key]
+
+    def _target_check(self, target, git, tags, git_path):
         is_triggered, triggered_of = self._git_triggers_check(target.get('triggers', []), self.filled_triggers)
-        is_change = self.cfg['force'] or is_file_change or is_triggered
-        main_name = '{}/{}'.format(self.cfg['user'], target['registry']) if self.cfg['user'] else target['registry']
+        main_name = self._main_name(target['registry'])
         if target.get('manifest') and target['build']:
-            self.manifests[main_name] = target['manifest']
+            try:
+                self.manifests[main_name] = {
+                    'tags': [tag.format(**tags) for tag in target['manifest']],
+                    'names': [name.format(**tags) for name in target.get('manifest_tags', ['latest'])],
+                }
+            except (KeyError, ValueError, IndexError):
+                print('Wrong manifest in {}, ignore'.format(target['registry']))
+        wrong_depends = set()
         for build in target['build']:
-            dockerfile_change = change_files is not None and build[0] in change_files
-            is_change |= dockerfile_change
-            tag = build[1].format(**tags)
+            state_key = self._state_key(git, target['registry'], build[0])
+            state = self.state.get(state_key)
             path = os.path.join(git_path, build[0])
             full_path = os.path.join(self.cfg['work_dir'], path)
+            info = self._get_dockerfile_info(full_path)
+            # Чужую архитектуру соберет ее узел из CFG['nodes'], {arch} в тегах - ее
+            file_arch = info.arch if self.cfg['arch_detect'] and info else None
+            arch = file_arch if file_arch in self.cfg['nodes'] else self.cfg['arch']
+            build_tags = tags if arch == self.cfg['arch'] else dict(tags, arch=arch)
+            tag = build[1].format(**build_tags)
+            buildargs = {k: str(v).format(**build_tags) for k, v in build[2].items()} if len(build) > 2 else None
+            with metrics.phase('triggers'):
+                change_files = self._build_changes(git, state)
+                is_file_change, change_of = self._triggers_check(target.get('triggers', []), change_files)
+                is_context_change, context_of = self._context_check(git, build[0], change_files, buildargs)
+            dockerfile_change = is_context_change and context_of == build[0]
+            is_retry = bool(state and state.get('pending'))
+            is_change = self.cfg['force'] or is_file_change or is_triggered or is_context_change or is_retry
             build_name = '{}:{}'.format(main_name, tag)
-            e = {
-                'reason': '',
-                'cmd': [build_name, path, git_path],
-                'true': True
-            }
-            # Пошли проверочки на исключение
+            # {arch} в depends - архитектура этой сборки, как и в ее теге
+            depends = set()
+            for dep in target.get('depends', []):
+                try:
+                    depends.add(self._main_name(dep.format(**build_tags)))
+                except (KeyError, ValueError, IndexError):
+                    wrong_depends.add(dep)
+            e = BuildPlan(
+                build_name, path, full_path, os.path.join(self.cfg['work_dir'], git_path), buildargs,
+                self._cache_policy(target, state_key, build_name), arch, info.bases(buildargs) if info else [],
+                depends - {build_name}, state_key, state, self.known_repos[git]
+            )
+            # Пошли проверочки на исключение.
+            # 'No change' последний - такую сборку еще может включить пересборка зависимости.
             if not len(tag):
-                e['reason'] = 'Empty tag'
+                e.reason = 'Empty tag'
             elif not len(target['registry']):
-                e['reason'] = 'Empty registry'
-            elif not is_change:
-                e['reason'] = 'No change'
-            elif not os.path.isfile(full_path):
-                e['reason'] = 'File not found: {}'.format(e['cmd'][1])
-            elif self.cfg['arch_detect'] and self.cfg['arch'] != _get_arch_from_dockerfile(full_path):
-                e['reason'] = 'Arch no {}'.format(self.cfg['arch'])
+                e.reason = 'Empty registry'
+            elif info is None:
+                e.reason = 'File not found: {}'.format(e.source)
+            elif file_arch is not None and file_arch != arch:
+                e.reason = 'Arch no {}'.format(', '.join(sorted({self.cfg['arch'], *self.cfg['nodes']})))
             elif build_name in self.all_build_name:
-                e['reason'] = 'Name:tag \'{}\' already present'.format(build_name)
+                e.reason = 'Name:tag \'{}\' already present'.format(build_name)
+            elif not is_change:
+                e.reason = 'No change'
 
-            if e['reason']:
-                e['true'] = False
+            if e.reason:
+                e.allowed = False
 
-            if e['true']:
+            if e.allowed:
                 # Добавляем причины включения
                 if self.cfg['force']:
-                    e['reason'] = 'force: True'
+                    e.reason = 'force: True'
                 elif dockerfile_change:
-                    e['reason'] = 'Dockerfile change'
+                    e.reason = 'Dockerfile change'
+                elif is_context_change:
+                    e.reason = 'Context change: {}'.format(context_of)
                 elif is_file_change:
-                    e['reason'] = 'File change: {}'.format(change_of)
+                    e.reason = 'File change: {}'.format(change_of)
                 elif is_triggered:
-                    e['reason'] = 'Triggered from git-trigger: {}'.format(triggered_of)
+                    e.reason = 'Triggered from git-trigger: {}'.format(triggered_of)
+                elif is_retry:
+                    e.reason = 'Retry unfinished build'
                 # Имя билда должно быть уникально
                 self.all_build_name.add(build_name)
+                self._fingerprint_check(e, git, build[0], tag, info, target.get('triggers', []))
             self.to_build.append(e)
+        for dep in sorted(wrong_depends):
+            print('Wrong depends \'{}\' in {}, ignore'.format(dep, target['registry']))
+
+    def _cache_policy(self, target: dict, state_key: str, build_name: str) -> dict:
+        # Параметры кеша слоев для сборки: CFG['cache'] и CFG['cache_days'], их можно переопределить в цели
+        policy = target.get('cache', self.cfg['cache'])
+        days = target.get('cache_days', self.cfg['cache_days'])
+        cache = {'policy': policy, 'nocache': True, 'cache_from': None}
+        if policy == 'cache':
+            cache['nocache'] = False
+        elif policy == 'force':
+            cache['nocache'] = bool(self.cfg['force'])
+        elif policy == 'cache_from':
+            cache['nocache'], cache['cache_from'] = False, [build_name]
+        if not cache['nocache'] and days:
+            # Кеш протухает через days дней после последней сборки без кеша
+            last = self.state.get('nocache:{}'.format(state_key)) or 0
+            if time.time() - last > days * 86400:
+                cache.update(nocache=True, cache_from=None, policy='{} days expired'.format(days))
+        return cache
+
+    def _get_repo_info(self, git: str) -> dict:
+        if git not in self._repo_info:
+            full_git_path = os.path.join(self.cfg['work_dir'], self.known_repos[git]['dir'])
+            self._repo_info[git] = {
+                'tree': None, 'rules': _dockerignore(full_git_path), 'context': {}, 'all': None, 'triggers': {}
+            }
+        return self._repo_info[git]
+
+    def _get_repo_tree(self, git: str) -> dict:
+        repo = self._get_repo_info(git)
+        if repo['tree'] is None:
+            repo['tree'] = _git_tree(os.path.join(self.cfg['work_dir'], self.known_repos[git]['dir']))
+        return repo['tree']
+
+    def _get_dockerfile_info(self, path: str) -> DockerfileInfo or None:
+        # None - файла нет
+        if path not in self._dockerfile_info:
+            self._dockerfile_info[path] = DockerfileInfo(path) if os.path.isfile(path) else None
+        return self._dockerfile_info[path]
+
+    def _context_check(self, git: str, dockerfile: str, change_files: list or None, buildargs: dict or None):
+        # Изменился ли сам докерфайл или что-то из его контекста: COPY/ADD без игнорируемых в .dockerignore
+        full_path = os.path.join(self.cfg['work_dir'], self.known_repos[git]['dir'], dockerfile)
+        info = self._get_dockerfile_info(full_path) if change_files else None
+        if info is None:
+            return False, None
+        if dockerfile in change_files:
+            return True, dockerfile
+        regex = info.regex(buildargs)
+        if regex is None:
+            return False, None
+        rules = self._get_repo_info(git)['rules']
+        for file in change_files:
+            if file == '.dockerignore' or (regex.match(file) and not _is_ignored(file, rules)):
+                return True, file
+        return False, None
 
-
-def docker_prune(targets: list) -> int:
-    # Удалить контейнеры и образы из списка реп:тег.
+    def _fingerprint_check(self, e: BuildPlan, git: str, dockerfile: str, tag: str, info: DockerfileInfo,
+                           triggers: list):
+        # Такой же контекст уже собирали - не собираем, или перетегируем готовый образ
+        full_git_path = os.path.join(self.cfg['work_dir'], self.known_repos[git]['dir'])
+        triggers_state = self._triggers_state(git, triggers)
+        if triggers_state is None:
+            # Что под триггерами - не знаем, значит и сравнивать не с чем
+            return
+        self._get_repo_tree(git)
+        e.fingerprint = _build_fingerprint(
+            full_git_path, dockerfile, tag, e.buildargs, info, self._get_repo_info(git), triggers_state
+        )
+        known = self.state.get('fingerprint:{}'.format(e.fingerprint))
+        if not known or self.cfg['force']:
+            return
+        if known['name'] == e.name and known['pushed']:
+            e.allowed, e.skip = False, True
+            e.reason = 'Fingerprint match, {} is up to date'.format(known['name'])
+        elif e.arch == self.cfg['arch'] and _docker_image_exists(known['image']):
+            # Перетегировать можно только образ с локального демона
+            e.reuse = known['image']
+            e.reason += ', fingerprint match: reuse {}'.format(known['name'])
+
+    def _triggers_state(self, git: str, triggers: list) -> str or None:
+        # Отпечаток файлов под триггерами цели: в своем репе и в репах GIT_TRIGGERS, по хешам блобов HEAD.
+        # Триггеры нужны для того, что в контекст не попадает: сработавший меняет отпечаток сборки так же,
+        # как изменение контекста, а тронутый без изменений - нет. '' - триггеров нет, None - реп не синхронизирован
+        if not triggers:
+            return ''
+        parts = [(git, tuple(triggers))]
+        for file in triggers:
+            if file.startswith('*') and len(file) > 1 and not file.startswith('**'):
+                parts.extend(
+                    (entry['git'], tuple(entry['triggers'][file[1:]])) for _, entry in sorted(self.git_triggers.items())
+                    if file[1:] in entry['triggers']
+                )
+        state = hashlib.sha256()
+        for url, patterns in parts:
+            if url not in self.known_repos:
+                return None
+            state.update('{}\0{}\0'.format(url, self._triggers_files(url, patterns)).encode())
+        return state.hexdigest()
+
+    def _triggers_files(self, git: str, patterns: tuple) -> str:
+        # Отпечаток файлов репа, подходящих под шаблоны триггеров. Зеркалу без блобов хватает дерева
+        repo = self._get_repo_info(git)
+        if patterns not in repo['triggers']:
+            tree = self._get_repo_tree(git)
+            if repo['all'] is None:
+                repo['all'] = ChangedFiles(tree)
+            state = hashlib.sha256()
+            for file in _trigger_matcher(patterns).select(repo['all']):
+                state.update('{}\0{}\0'.format(file, tree[file]).encode())
+            repo['triggers'][patterns] = state.hexdigest()
+        return repo['triggers'][patterns]
+
+    def _main_name(self, registry: str) -> str:
+        return '{}/{}'.format(self.cfg['user'], registry) if self.cfg['user'] else registry
+
+
+def docker_prune(targets: list, base_url: str = None) -> int:
+    # Удалить контейнеры и образы из списка реп:тег на узле base_url.
     # Ошибок быть не должно, вообще.
-    # Чекает первый элемент, т.е. тоже что вернул generate_builds
+    # targets - BuildPlan, то что вернул GenerateBuilds.get
     work_time = time.time()
-    containers = _docker_containers()
-    images_ = _docker_images()
-
-    # Заменяем ид образа у контейнеров на реп:тег. реп:тег всех образов в один список
-    images = []
-    for image in images_:
-        for container in containers:
-            if image[0] == container[0]:
-                container[0] = image[1]
-        images.append(image[1])
-    del images_
-
-    for target in targets:
-        if target[0] in images:  # А может ли быть контейнер без образа? Да пофиг.
-            # сносим контейнеры
-            for container in containers:
-                if target[0] == container[0]:
-                    _docker_prune_container(container[1])
-            # И образ
-            docker_prune_image(target[0])
+    containers, remove = _prune_select(targets, _docker_images(base_url), _docker_containers(base_url))
+    # Сначала контейнеры, потом образы. Внутри пачки все параллельно
+    _docker_batch(functools.partial(_docker_prune_container, base_url=base_url), containers)
+    _docker_batch(functools.partial(docker_prune_image, base_url=base_url), remove)
+    metrics.add_phase('prune', time.time() - work_time)
     return int(time.time() - work_time)
 
 
+def _prune_select(targets: list, images_list: list, containers_list: list) -> tuple:
+    # Что удалить: (имена контейнеров, реп:тег образов). images_list и containers_list - как вернули
+    # _docker_images и _docker_containers, сопоставляем через индексы по ид образа и реп:тег
+    images = {}  # реп:тег -> ид образа
+    tags = {}  # ид образа -> все его реп:тег
+    for image_id, tag in images_list:
+        images[tag] = image_id
+        tags.setdefault(image_id, set()).add(tag)
+    # Перетегируемые и собираемые с кешем образы не трогаем, их слои еще пригодятся
+    remove = {plan.name for plan in targets if not plan.reuse and plan.cache['nocache'] and plan.name in images}
+
+    # Контейнер мешает удалению, если создан из удаляемого реп:тег или его образ теряет все теги
+    containers = []
+    for image_id, name, image in containers_list:
+        if image in remove or (image_id in tags and tags[image_id] <= remove):
+            containers.append(name)
+    return containers, sorted(remove)
+
+
+def _docker_batch(func, items: list):
+    if len(items) < 2:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOCKER_BATCH_T, thread_name_prefix='docker') as pool:
+        return list(pool.map(func, items))
+
+
+def url_key(url: str) -> str:
+    # Один реп под разными url: https://github.com/a/b.git, git@github.com:a/b, ssh://git@github.com/a/b/
+    url = url.strip().lower()
+    match = re.match(r'^[\w.-]+@([^:/]+):(.*)$', url)
+    if match:
+        url = '{}/{}'.format(*match.groups())
+    url = re.sub(r'^[a-z+]+://', '', url)
+    url = re.sub(r'^[^/@]*@', '', url).rstrip('/')
+    return url[:-4] if url.endswith('.git') else url
+
+
+def _webhook_urls(data, depth: int = 0) -> set:
+    # url репов из уведомления о пуше: GitHub, GitLab, Gitea, Bitbucket или просто {"git": url}
+    keys = ('clone_url', 'git_url', 'ssh_url', 'html_url', 'url', 'git_http_url', 'git_ssh_url', 'homepage', 'git')
+    urls = set()
+    if isinstance(data, dict) and depth < 4:
+        for key, value in data.items():
+            if key in keys and isinstance(value, str):
+                urls.add(value)
+            elif isinstance(value, (dict, list)):
+                urls |= _webhook_urls(value, depth + 1)
+    elif isinstance(data, list) and depth < 4:
+        for value in data:
+            urls |= _webhook_urls(value, depth + 1)
+    return urls
+
+
+class _WebhookHandler(http.server.BaseHTTPRequestHandler):
+    MAX_BODY = 1 << 20
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, message: str):
+        body = (message + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(200, 'ok')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > self.MAX_BODY:
+            return self._send(413, 'too large')
+        body = self.rfile.read(length)
+        if not self._authorized(body):
+            return self._send(403, 'forbidden')
+        try:
+            if body.startswith(b'payload='):  # GitHub с application/x-www-form-urlencoded
+                body = urllib.parse.parse_qs(body.decode()).get('payload', ['{}'])[0]
+            data = json.loads(body or '{}')
+        except (ValueError, UnicodeDecodeError):
+            return self._send(400, 'bad payload')
+        if self.server.on_push(_webhook_urls(data)):
+            return self._send(202, 'queued')
+        self._send(404, 'unknown repository')
+
+    def _authorized(self, body: bytes) -> bool:
+        secret = self.server.secret
+        if not secret:
+            return True
+        digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        token = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('token', [''])[0]
+        return any(hmac.compare_digest(a, b) for a, b in (
+            (self.headers.get('X-Hub-Signature-256', ''), 'sha256=' + digest),  # GitHub
+            (self.headers.get('X-Gitea-Signature', ''), digest),  # Gitea
+            (self.headers.get('X-Gitlab-Token', ''), secret),  # GitLab
+            (token, secret),
+        ))
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    """Принимает уведомления о пуше (POST с JSON от GitHub, GitLab, Gitea или {"git": url}) и отдает url
+    репов в on_push. on_push вернет False, если таких репов не знает. Если задан secret - проверяется
+    подпись GitHub/Gitea, токен GitLab или ?token=."""
+    daemon_threads = True
+
+    def __init__(self, listen: str, secret: str, on_push):
+        # host:port, [::1]:port или :port (127.0.0.1)
+        address = urllib.parse.urlsplit('//' + listen)
+        host = address.hostname or '127.0.0.1'
+        if address.port is None:
+            raise ValueError('Webhook address must be host:port, got \'{}\''.format(listen))
+        if ':' in host:
+            self.address_family = socket.AF_INET6
+        super().__init__((host, address.port), _WebhookHandler)
+        self.secret = secret
+        self.on_push = on_push
+        self._thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
 class SystemD:
-    def __init__(self, action):
+    def __init__(self, action, daemon: bool = False):
         self._root_test()
         name = 'docker builder auto'
         f_name = '_'.join(name.lower().split())
         self._files = ['{}.service'.format(f_name), '{}.timer'.format(f_name)]
+        # Демон работает сам по себе, таймер ему не нужен
+        self._daemon = daemon
+        self._unit = self._files[0] if daemon else self._files[1]
         self._systemd_path = '/etc/systemd/system/'
         self._path = {
             '_TIME_': '72h',
@@ -536,7 +2563,7 @@ class SystemD:
             '_MAIN_': os.path.abspath(sys.argv[0]),
             '_NAME_': name
         }
-        self._data = {k: self._getter(k) for k in self._files}
+        self._data = {k: self._getter(k) for k in self._files[:1 if daemon else 2]}
         if action is None:
             raise RuntimeError('Action is None')
         elif action:
@@ -545,6 +2572,9 @@ class SystemD:
             self.uninstall()
 
     def install(self):
+        # Переход между таймером и демоном: старый юнит убираем
+        self._systemd_disable()
+        self._remove_files()
         for k in self._data:
             path = os.path.join(self._systemd_path, k)
             with open(path, 'w') as fp:
@@ -554,12 +2584,15 @@ class SystemD:
 
     def uninstall(self):
         self._systemd_disable()
-        for k in self._data:
+        self._remove_files()
+        self._systemd_reload()
+
+    def _remove_files(self):
+        for k in self._files:
             try:
                 os.remove(os.path.join(self._systemd_path, k))
             except FileNotFoundError:
                 pass
-        self._systemd_reload()
 
     @staticmethod
     def _get_params_str() -> str:
@@ -582,16 +2615,32 @@ class SystemD:
         subprocess.run(['systemctl', 'daemon-reload'])
 
     def _systemd_enable(self):
-        subprocess.run(['systemctl', 'enable', self._files[1]])
-        subprocess.run(['systemctl', 'start', self._files[1]])
+        subprocess.run(['systemctl', 'enable', self._unit])
+        subprocess.run(['systemctl', 'start', self._unit])
 
     def _systemd_disable(self):
-        subprocess.run(['systemctl', 'stop', self._files[1]])
-        subprocess.run(['systemctl', 'disable', self._files[1]])
+        for unit in reversed(self._files):
+            if os.path.isfile(os.path.join(self._systemd_path, unit)):
+                subprocess.run(['systemctl', 'stop', unit], stderr=subprocess.DEVNULL)
+                subprocess.run(['systemctl', 'disable', unit], stderr=subprocess.DEVNULL)
 
     def _getter(self, file: str) -> str:
         d = {
             self._files[0]: [
+                '[Unit]',
+                'Description={_NAME_} daemon',
+                'After=network-online.target docker.service',
+                'Wants=network-online.target',
+                '',
+                '[Service]',
+                'Type=simple',
+                'ExecStart=/usr/bin/python3 -u {_MAIN_} {_PARAMS_}',
+                'Restart=on-failure',
+                'RestartSec=30',
+                '',
+                '[Install]',
+                'WantedBy=multi-user.target'
+            ] if self._daemon else [
                 '[Unit]',
                 'Description={_NAME_} job',
                 '',
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
 import json
 import os
+import queue
+import resource
+import shutil
+import signal
 import time
 
 import docker_builder
@@ -12,6 +17,9 @@ CFG = {
     'work_dir': os.path.expanduser('~'),
     # Субдиректория с триггерами
     'triggers': '.triggers',
+    # Держать репы из GIT_TRIGGERS голыми зеркалами без блобов (clone --mirror --filter=blob:none),
+    # для триггеров нужны только имена измененных файлов. Занимают намного меньше места.
+    'triggers_mirror': True,
     # ID в хабе. Если auto_push: True то перезапишет при логине.
     'user': '',
     # Файл с login pass от хаба в work_dir. Если начинается с / то абсолютный путь.
@@ -19,20 +27,82 @@ CFG = {
     'credentials': '.docker_credentials',
     # Автоматически определять архитектуру докерфайлов по FROM и игнорировать неподдерживаемые.
     'arch_detect': True,
+    # Узлы сборки для архитектур: {'arm64v8': ['tcp://10.0.0.2:2375', 'ssh://pi@10.0.0.3']} (как DOCKER_HOST).
+    # Докерфайлы этих архитектур не игнорируются, а собираются и пушатся на их узлах, {arch} в тегах - архитектура
+    # узла. Сборки распределяются по самым незагруженным узлам, на узле до max_build_t сборок. Зависимая ('depends')
+    # собирается на узле своей базы, а от баз с разных узлов - после их пуша.
+    # Локальный демон всегда узел своей архитектуры. Список манифеста публикуется после сборки всех архитектур.
+    'nodes': {},
     # Пушить образы в хаб.
     'auto_push': True,
     # Удалить запушенные образы.
     'remove_after_push': True,
-    # !!!: Файлы будут удалены сразу а не в самом конце. Сломает зависимости сборки, если они есть.
+    # Файлы будут удалены сразу а не в самом конце.
+    # Образы из 'depends' других целей удаляются только после сборки всех зависимых от них.
     'remove_fast': True,
-    # Потоков сборки.
+    # Потоков синхронизации git-репов (clone\pull\fetch). Один url синхронизируется один раз за запуск.
+    'max_sync_t': 8,
+    # Потоков сборки. Зависимые цели ('depends') ждут сборки своих базовых образов.
     'max_build_t': 1,
+    # Предел занятого места на разделе с данными докера, в процентах. Если с идущими сборками он будет превышен,
+    # новые сборки ждут, а пуш и удаление запушенных образов идут в первую очередь (даже без remove_fast).
+    # Работает только с локальным демоном. 0 - не следить.
+    'disk_watermark': 90,
     # Потоков пуша
     'max_push_t': 1,
+    # Потоков предварительного pull базовых образов из FROM (все стадии, с подстановкой ARG), 0 - не качать заранее.
+    # Образы скачиваются один раз на узел сразу после планирования, сборка ждет только свои базовые образы.
+    'max_pull_t': 4,
+    # Пересобирать цели, у которых базовый образ обновился в регистре с последней сборки.
+    # Digest'ы базовых образов запоминаются в state, проверка - запрос HEAD манифеста на образ за запуск.
+    # Репы без новых комитов при этом тоже разбираются.
+    'base_trigger': False,
+    # Попыток пуша. Повторяются сетевые ошибки и ошибки регистра, кроме ошибок авторизации.
+    'push_retries': 4,
+    # Базовая задержка между попытками пуша, сек. Растет вдвое с каждой попыткой (до 60), со случайным джиттером.
+    'push_backoff': 2,
+    # Перед pull\fetch сверять HEAD с удаленным через git ls-remote и не трогать репы, которые не сдвинулись.
+    'precheck': True,
+    # Кеш слоев при сборке: 'nocache' - всегда собирать с нуля, 'cache' - использовать локальный кеш,
+    # 'force' - без кеша только с force,
+    # 'cache_from' - брать кеш из ранее запушенного образа (его скачаем перед сборкой).
+    # С remove_after_push локального кеша не остается, тогда нужен 'cache_from'.
+    # Можно переопределить в цели ключом 'cache'.
+    'cache': 'nocache',
+    # Через сколько дней после последней сборки без кеша собрать без кеша снова, 0 - никогда.
+    # Можно переопределить в цели ключом 'cache_days'.
+    'cache_days': 0,
     # Принудительно пересобрать образы.
     'force': False,
     # Выполнить docker system prune -f, если что-то собирали
     'prune': False,
+    # Файл состояния сборок в work_dir. Запоминает комиты последних успешных сборок, чтобы повторить
+    # упавшие и прерванные сборки в следующем запуске.
+    'state': '.docker_builder_state',
+    # Журнал таймингов сборок в work_dir: по JSON-строке на сборку с временем, кешем и объемом вывода каждого шага.
+    # Пустая строка - не писать.
+    'build_timings': '.build_timings',
+    # Каталог в work_dir для тарболов контекста сборки: один на реп, HEAD и .dockerignore, общий для всех
+    # докерфайлов репа. Без .git и игнорируемого, отдается докеру с диска. Пустая строка - контекст для каждой
+    # сборки собирает docker-py.
+    'context_cache': '.contexts',
+    # JSON-отчет о запуске в work_dir: время фаз и каждой задачи (sync, pull, context, build, push, remove, manifest).
+    # Пустая строка - не писать.
+    'metrics': '.run_report.json',
+    # Те же метрики для textfile collector node_exporter'а, полный путь к файлу *.prom.
+    # Например '/var/lib/node_exporter/textfile_collector/docker_builder.prom'. Пустая строка - не писать.
+    # У метрик задач есть метка node (base_url узла или local), повторы задачи на одном узле суммируются.
+    'metrics_prom': '',
+    # Режим демона (--daemon): слушать уведомления о пуше (webhook) на адресе host:port (IPv6 - [::1]:port),
+    # пустая строка - не слушать.
+    # POST с JSON от GitHub, GitLab, Gitea или {"git": url}, собираются только цели затронутых репов.
+    'daemon_listen': '127.0.0.1:8765',
+    # Секрет webhook'а: подпись GitHub/Gitea, X-Gitlab-Token или ?token=. Пустая строка - без проверки.
+    'daemon_secret': '',
+    # Полная проверка всех репов раз в столько секунд, на случай потерянных уведомлений.
+    'daemon_poll': 900,
+    # Сколько секунд копить уведомления перед запуском, пуши пачкой соберутся за раз.
+    'daemon_debounce': 5,
 }
 
 TARGETS = [
@@ -43,16 +113,32 @@ TARGETS = [
      # Список целей из репа.
      'targets': [
          {   # registry - регистр на хабе.
-             # triggers: список из файлов-триггеров, их обновление также активирует сборку. Может быть опущен.
+             # triggers: список из файлов-триггеров, их обновление также активирует сборку всех build цели.
+             # Может быть опущен: каждый докерфайл и так пересобирается при изменении файлов из его COPY/ADD
+             # (кроме игнорируемых в .dockerignore), триггеры нужны для того, что в контекст не попадает.
              # Если начинается с * - это триггер из GIT_TRIGGERS
              # Если просто * - изменение любого файла
              # * в конце - любой файл начинающийся с (пути без начального слеша). 'src*' in 'src/main.py' - > True
+             # Остальное - glob: * и ? в пределах каталога, ** - любое число каталогов, [...] - класс символов.
+             # Glob с начала пути пишется через **, например '**/*.py', иначе это триггер из GIT_TRIGGERS.
              'registry': 'mdmt2', 'triggers': ['crutch.py', 'entrypoint.sh', '*mdmt2'],
-             # Создаст и запушит универсальный тег latest, очень криво и будет ломаться если теги обновляемые (наверное)
+             # manifest: теги образов под разные архитектуры, из них собирается manifest list (мультиархитектурный тег).
+             # Публикуется через API регистра, когда все собираемые в этом запуске образы цели запушены.
+             # Если сборка или пуш любого из них упали, список не публикуется. Логин из credentials передается
+             # только Docker Hub, сторонний регистр должен пускать без него.
              'manifest': ['amd64', 'arm64v8', 'arm32v7'],
-             # build: список из списков [файл докера, тег].
-             # Добавлять докерфайлы в triggers не нужно.
-             # В теге возможны подстановки, см. DEF_TAGS.
+             # manifest_tags: под какими тегами опубликовать список, по умолчанию ['latest']. Может быть опущен.
+             # В тегах возможны подстановки, см. DEF_TAGS. Например ['latest', '{tag}'].
+             # cache, cache_days: переопределяют одноименные ключи CFG для этой цели. Могут быть опущены.
+             # depends: список из реп:тег (без ID хаба) других целей, на чьих образах собирается эта. Может быть опущен.
+             # В теге возможны подстановки, см. DEF_TAGS. Например ['mdmt2-base:{arch}'].
+             # Цель собирается после своих зависимостей и пересобирается вместе с ними.
+             # build: список из списков [файл докера, тег] или [файл докера, тег, {аргументы сборки}].
+             # Добавлять докерфайлы и их COPY/ADD в triggers не нужно.
+             # В теге и значениях аргументов возможны подстановки, см. DEF_TAGS.
+             # Если отпечаток сборки (докерфайл, файлы из его COPY/ADD, тег, аргументы и файлы под триггерами,
+             # в том числе в репах GIT_TRIGGERS) уже собирали, образ не пересобирается: уже запушенный
+             # пропускается, оставшийся локально перетегируется. Сработавший триггер отпечаток меняет.
              'build': [
                  ['Dockerfile.amd64',   '{arch}'],
                  ['Dockerfile.arm64v8', '{arch}'],
@@ -109,7 +195,7 @@ GIT_TRIGGERS = {
     # Сами триггеры похожи на targets, но вместо сборки образа они устанавливают триггер в True или False
     # Имя триггера может повторяться, при этом конечный результат будет выражен через логический or.
     # Т.е. если есть a: False и a: True будет False | True = True
-    # Главный недостаток в том, что все эти репы будут занимать место -_-
+    # Главный недостаток в том, что все эти репы будут занимать место -_- С 'triggers_mirror' уже не так много.
     # Ключ - директория
     'RHVoice-dictionary': {
         'git': 'https://github.com/vantu5z/RHVoice-dictionary',
@@ -140,118 +226,530 @@ class Builder:
         self.args = args
         self.install = install
         self.count = 0
+        self.planner = None
         self.to_build = []
         self.building = []
         self.builded = []
         self.pushing = []
         self.pushed = []
         self.manifests_pushing = []
+        # Удаление запушенных образов: очередь и идущие, до DOCKER_BATCH_T одновременно
+        self.removes = []
+        self.removing = []
+        # Предварительный pull базовых образов: очередь и ожидающие пары (узел, образ)
+        self.pulls = []
+        self.pulling = []
+        self.pull_wait = None
+        self.contexts = None
         self.manifests = {}
+        # реп -> его образы из этого запуска, еще не запушенные, и репы с упавшими образами
+        self.manifest_wait = {}
+        self.manifest_failed = set()
+        # реп:тег -> от каких реп:тег зависит. Собранные, упавшие, запушенные и не запушенные сборки,
+        # удаление ждущие зависимых
+        self.depends = {}
+        self.built = set()
+        self.failed = set()
+        self.uploaded = set()
+        self.push_failed = set()
+        self.remove_hold = []
+        # Раздел с данными докера, размеры собранных образов и ждут ли сборки места
+        self.disk_root = None
+        self.image_sizes = {}
+        self.disk_held = False
+        # Узлы сборки: архитектура -> DOCKER_HOST узлов (None - локальный демон), сборок на узле, узел образа
+        self.nodes = None
+        self.node_load = {}
+        self.node_of = {}
+        # Задачи сообщают о завершении сюда
+        self._events = queue.Queue()
+        # (стадия, реп:тег) -> время постановки в очередь, и сколько задачи ждали запуска по стадиям
+        self._ready_at = {}
+        self.queue_wait = {}
 
     def start(self):
         if self.install is not None:
-            docker_builder.SystemD(self.install)
+            docker_builder.SystemD(self.install, self.args.daemon)
             return
-        self.to_build, self.manifests = docker_builder.GenerateBuilds(
-            self.cfg, self.targets, self.git_triggers, self.args
-        ).get()
+        docker_builder.metrics.reset()
+        if self.args.trace:
+            docker_builder.tracer.enable()
+        try:
+            self._run()
+        finally:
+            metrics_json = self.cfg['metrics'] and os.path.join(self.cfg['work_dir'], self.cfg['metrics'])
+            docker_builder.metrics.write(metrics_json, self.cfg['metrics_prom'])
+            if self.args.trace:
+                docker_builder.tracer.write(self.args.trace)
+
+    def _run(self):
+        self.planner = docker_builder.GenerateBuilds(self.cfg, self.targets, self.git_triggers, self.args)
+        if self.args.profile:
+            # Профилируется только основной поток, синхронизация репов идет в своих
+            profile = cProfile.Profile()
+            self.to_build, self.manifests, self.depends = profile.runcall(self.planner.get)
+            profile.dump_stats(self.args.profile)
+        else:
+            self.to_build, self.manifests, self.depends = self.planner.get()
         if len(self.to_build) and not self.args.nope:
-            work_time = docker_builder.docker_prune(self.to_build)
+            self._init_nodes()
+            self._init_pulls()
+            # Базовые образы качаются, пока идет prune
+            self.add_new_pull()
+            work_time = 0
+            for arch, urls in self.nodes.items():
+                targets = [plan for plan in self.to_build if plan.arch == arch]
+                for url in urls if targets else ():
+                    work_time += docker_builder.docker_prune(targets, url)
             if self.args.v:
                 print('\nDocker prune in {} sec\n'.format(work_time))
         elif self.args.v:
             print()
             print('Nothing to do, bye')
         if not self.args.nope:
-            self.build()
-        docker_builder.docker_logout()
+            with docker_builder.metrics.phase('build'):
+                self.build()
+        if not self.args.daemon:
+            docker_builder.docker_logout()
 
     def build(self):
-        while len(self.to_build) or len(self.building):
-            self.build_check()
-            self.push_check()
-            self.add_new_build()
-            self.add_new_push()
-            if self.cfg['remove_fast']:
-                self.pushed_check()
-            time.sleep(5)
-        self.push()
-        self.manifests_check()
-
-    def push(self):
-        while self.cfg['auto_push'] and (len(self.builded) or len(self.pushing)):
-            self.push_check()
+        # Планировщик просыпается только когда какая-то задача завершилась, и сразу запускает следующие.
+        self._init_nodes()
+        self._init_pulls()
+        if self.cfg['context_cache']:
+            self.contexts = docker_builder.ContextCache(os.path.join(self.cfg['work_dir'], self.cfg['context_cache']))
+        self._enqueue('Build', [plan.name for plan in self.to_build])
+        if self.cfg['disk_watermark']:
+            self.disk_root = docker_builder.docker_root_dir()
+            if self.disk_root is None:
+                print('Docker data root not found, \'disk_watermark\' ignored')
+            elif self.args.v:
+                print('Docker data root {}: {:.1f}% used'.format(self.disk_root, self._disk_used()))
+        for plan in self.to_build:
+            target = plan.name.split(':', 1)[0]
+            if self.cfg['auto_push'] and target in self.manifests:
+                self.manifest_wait.setdefault(target, set()).add(plan.name)
+        self._schedule()
+        while len(self.building) or len(self.pushing) or len(self.manifests_pushing) or len(self.pulling) \
+                or len(self.removing):
+            self._complete(self._events.get())
+            self._schedule()
+        for plan in self.to_build:
+            # Задач больше нет, а сборку так и не запустили
+            print('Skip building {}: no usable {} node, nothing left to wait for'.format(plan.name, plan.arch))
+            self.failed.add(plan.name)
+            self.manifest_check(plan.name, False)
+        self._print_queue_wait()
+        if self.contexts:
+            self.contexts.cleanup()
+            self._print_contexts()
+
+    def _init_nodes(self):
+        if self.nodes is not None:
+            return
+        self.nodes = {arch: list(urls) for arch, urls in self.cfg['nodes'].items()}
+        self.nodes.setdefault(self.cfg['arch'], []).insert(0, None)
+        self.node_load = {url: 0 for urls in self.nodes.values() for url in urls}
+        if self.args.v and len(self.node_load) > 1:
+            print('Build nodes: {}'.format(', '.join(
+                '{} {}'.format(arch, url or 'local') for arch, urls in sorted(self.nodes.items()) for url in urls)))
+
+    def _init_pulls(self):
+        # Каждый базовый образ - один раз на каждый узел, куда может попасть его сборка. Свои образы из
+        # этого запуска не качаем, их соберем
+        if self.pull_wait is not None:
+            return
+        self.pull_wait = set()
+        if self.cfg['max_pull_t'] <= 0:
+            return
+        names = {plan.name for plan in self.to_build}
+        for plan in self.to_build:
+            for image in plan.bases if not plan.reuse else ():
+                for url in self.nodes.get(plan.arch, []) if image not in names else ():
+                    if (url, image) not in self.pull_wait:
+                        self.pull_wait.add((url, image))
+                        self.pulls.append((url, image))
+        self._enqueue('Pull', [image for _, image in self.pulls])
+
+    def _base_nodes(self, plan: docker_builder.BuildPlan) -> set:
+        # Узлы, где лежат еще не запушенные свои базы сборки: в регистре их нет, другой узел их не найдет
+        if plan.reuse:
+            return set()
+        return {self.node_of[dep] for dep in self.depends.get(plan.name, ())
+                if dep in self.node_of and dep not in self.uploaded}
+
+    def _bases_apart(self, plan: docker_builder.BuildPlan) -> set:
+        # Узлы незапушенных баз, если собрать сборку ни на одном из них нельзя: базы на разных узлах или
+        # на узле другой архитектуры. Иначе пустое множество
+        pinned = self._base_nodes(plan)
+        if len(pinned) > 1 or not pinned <= set(self.nodes.get(plan.arch, [])):
+            return pinned
+        return set()
+
+    def _free_node(self, plan: docker_builder.BuildPlan) -> list:
+        # Самый незагруженный свободный узел архитектуры сборки с уже скачанными базовыми образами, или [].
+        # Сборка от своих незапушенных баз - только на узле, где они собраны, а если там нельзя - после их пуша.
+        # Перетегировать можно только на локальном
+        nodes, bases = ([None], ()) if plan.reuse else (self.nodes.get(plan.arch, []), plan.bases)
+        pinned = self._base_nodes(plan)
+        if self._bases_apart(plan):
+            return []
+        free = [
+            url for url in nodes if self.node_load[url] < self.cfg['max_build_t']
+            and not any((url, image) in self.pull_wait for image in bases) and (not pinned or url in pinned)
+        ]
+        return sorted(free, key=lambda url: self.node_load[url])[:1]
+
+    def _schedule(self):
+        if self.disk_root and self._disk_next() > self.cfg['disk_watermark']:
+            # Места на еще одну сборку нет: сначала пушим самые большие образы и удаляем запушенные
+            self.builded.sort(key=lambda tag: self.image_sizes.get(tag, 0), reverse=True)
             self.add_new_push()
-            if self.cfg['remove_fast']:
-                self.pushed_check()
-            time.sleep(5)
-        self.pushed_check()
+            self.pushed_check()
+        self.add_new_pull()
+        self.add_new_build()
+        self.add_new_push()
+        if self.cfg['remove_fast'] or not (len(self.to_build) or len(self.building) or len(self.pushing)):
+            self.pushed_check()
+        self.add_new_remove()
+
+    def _complete(self, worker):
+        if worker in self.building:
+            self.building.remove(worker)
+            self.node_load[self.node_of[worker.tag]] -= 1
+            if not self._report(worker, 'Build'):
+                self.failed.add(worker.tag)
+                self.manifest_check(worker.tag, False)
+                return
+            self.built.add(worker.tag)
+            self.planner.built(worker.tag, worker.image_id)
+            if self.disk_root and self.node_of[worker.tag] is None:
+                self.image_sizes[worker.tag] = worker.image_size
+            self._print_steps(worker)
+            if self.cfg['auto_push']:
+                self.builded.append(worker.tag)
+                self._enqueue('Push', [worker.tag])
+        elif worker in self.pushing:
+            self.pushing.remove(worker)
+            if self._report(worker, 'Push'):
+                self._print_push(worker)
+                self.planner.done(worker.tag)
+                self.uploaded.add(worker.tag)
+                self.pushed.append(worker.tag)
+                if self.cfg['remove_after_push']:
+                    self._enqueue('Remove', [worker.tag])
+                self.manifest_check(worker.tag, True)
+            else:
+                self.push_failed.add(worker.tag)
+                self.manifest_check(worker.tag, False)
+        elif worker in self.manifests_pushing:
+            self.manifests_pushing.remove(worker)
+            self._report(worker, 'Manifest')
+        elif worker in self.pulling:
+            # Не скачался - сборка попробует сама
+            self.pulling.remove(worker)
+            self.pull_wait.discard((worker.base_url, worker.tag))
+            if self._report(worker, 'Pull'):
+                self.planner.base_pulled(worker.tag, worker.digest)
+        elif worker in self.removing:
+            self.removing.remove(worker)
+            if worker.status():
+                print('Remove {} failed: {}'.format(worker.tag, worker.err))
+
+    def _print_steps(self, worker):
+        if not self.args.v or not worker.steps:
+            return
+        cached = len([step for step in worker.steps if step['cached']])
+        slow = max(worker.steps, key=lambda step: step['duration'] or 0)
+        print('Build {}: {} steps, {} cached, slowest step {} ({:.1f} sec): {}'.format(
+            worker.tag, len(worker.steps), cached, slow['step'], slow['duration'] or 0, slow['instruction'][:60]))
+
+    def _print_push(self, worker):
+        if not self.args.v:
+            return
+        print('Push {}: {} layers, {} already exist, {:.1f} MB sent in {} attempt(s), digest {}'.format(
+            worker.tag, len(worker.layers), worker.layers_skipped, worker.bytes_pushed / 1024 / 1024,
+            worker.attempts, worker.digest))
+
+    def _print_contexts(self):
+        if not self.args.v or not (self.contexts.built or self.contexts.reused):
+            return
+        print('Build contexts: {} created ({:.1f} MB in {:.2f} sec), {} reused, peak RSS {:.1f} MB'.format(
+            self.contexts.built, self.contexts.size / 1024 / 1024, self.contexts.work_time, self.contexts.reused,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    def _enqueue(self, stage: str, tags: list):
+        now = time.time()
+        for tag in tags:
+            self._ready_at[(stage, tag)] = now
+
+    def _dequeue(self, stage: str, tag: str):
+        now = time.time()
+        self.queue_wait.setdefault(stage, []).append(now - self._ready_at.pop((stage, tag), now))
+
+    def _print_queue_wait(self):
+        if not self.args.v:
+            return
+        for stage, waits in self.queue_wait.items():
+            print('Queue wait {}: {} items, avg {:.3f} sec, max {:.3f} sec'.format(
+                stage, len(waits), sum(waits) / len(waits), max(waits)))
+
+    def _disk_used(self, builds: int = 0) -> float:
+        # Прогноз занятого места в процентах: сейчас, плюс идущие и еще builds сборок размером с самый большой образ
+        total, used, _ = shutil.disk_usage(self.disk_root)
+        estimate = max(self.image_sizes.values(), default=0)
+        return (used + estimate * (self.node_load.get(None, 0) + builds)) * 100 / total
+
+    def _disk_next(self) -> float:
+        return self._disk_used(1)
+
+    def _disk_admit(self) -> bool:
+        # Можно ли запустить еще одну сборку
+        if not self.disk_root:
+            return True
+        used = self._disk_next()
+        if used <= self.cfg['disk_watermark']:
+            self.disk_held = False
+            return True
+        if not (self.node_load.get(None, 0) or len(self.pushing) or len(self.removes) or len(self.removing)):
+            # Место освобождать некому, ждать бесполезно
+            print('Low disk space: {:.1f}% used after build, watermark {}%'.format(used, self.cfg['disk_watermark']))
+            return True
+        if not self.disk_held:
+            self.disk_held = True
+            print('Hold building: {:.1f}% disk used after build, watermark {}%'.format(
+                used, self.cfg['disk_watermark']))
+        return False
+
+    def _is_needed(self, target: str) -> bool:
+        # Образ еще нужен как база для ожидающих или идущих сборок
+        waiting = [plan.name for plan in self.to_build] + [worker.tag for worker in self.building]
+        return any(target in self.depends.get(name, ()) for name in waiting)
 
     def pushed_check(self):
+        hold, self.remove_hold = self.remove_hold, []
+        for target in hold:
+            if self._is_needed(target):
+                self.remove_hold.append(target)
+            else:
+                self._remove(target)
         while self.cfg['auto_push'] and len(self.pushed):
             target = self.pushed.pop(0)
-            if self.cfg['remove_after_push']:
-                print('Remove {}'.format(target))
-                docker_builder.docker_prune_image(target, False)
-            self.add_new_manifest_push(target)
-
-    def manifests_check(self):
-        results = []
-        while self.manifests_pushing:
-            self._x_check(self.manifests_pushing, results, 'Manifest')
-            time.sleep(1)
-
-    def add_new_manifest_push(self, target: str):
-        target = target.split(':', 1)[0]
-        if target in self.manifests:
-            self.manifests_pushing.append(docker_builder.ManifestPush(target, self.manifests[target]))
+            if self.cfg['remove_after_push'] and self._is_needed(target):
+                self.remove_hold.append(target)
+            elif self.cfg['remove_after_push']:
+                self._remove(target)
+
+    def _remove(self, target: str):
+        # Удаляет поток, планировщик его не ждет
+        self.removes.append(target)
+
+    def add_new_remove(self):
+        while len(self.removing) < docker_builder.DOCKER_BATCH_T and len(self.removes):
+            target = self.removes.pop(0)
+            self._dequeue('Remove', target)
+            print('Remove {}'.format(target))
+            self.removing.append(docker_builder.Remove(target, self._events, base_url=self.node_of.get(target)))
+
+    def manifest_check(self, tag: str, pushed: bool):
+        # Список публикуется один раз, когда все образы репа из этого запуска запушены. Разные репы - параллельно.
+        target = tag.split(':', 1)[0]
+        waiting = self.manifest_wait.get(target)
+        if waiting is None or tag not in waiting:
+            return
+        waiting.discard(tag)
+        if not pushed:
+            self.manifest_failed.add(target)
+        if waiting:
+            return
+        del self.manifest_wait[target]
+        if target in self.manifest_failed:
+            print('Skip manifest {}: not all images pushed'.format(target))
+            return
+        manifest = self.manifests[target]
+        print('Start pushing manifest {}:{}'.format(target, ','.join(manifest['names'])))
+        self.manifests_pushing.append(
+            docker_builder.ManifestPush(target, manifest['tags'], manifest['names'], self._events))
 
     def add_new_build(self):
-        while len(self.building) < self.cfg['max_build_t'] and len(self.to_build):
-            cmd = self.to_build.pop(0)
-            print('Start building {}'.format(cmd[0]))
+        # Запускаем готовые сборки - у которых все зависимости уже собраны и есть свободный узел их архитектуры
+        idx = 0
+        while idx < len(self.to_build) and any(load < self.cfg['max_build_t'] for load in self.node_load.values()):
+            plan = self.to_build[idx]
+            deps = self.depends.get(plan.name, set())
+            failed = deps & self.failed
+            apart = self._bases_apart(plan) if not failed and deps <= self.built else set()
+            if apart and (not self.cfg['auto_push'] or deps & self.push_failed):
+                # Базы так и не окажутся в регистре, а на их узлах эту сборку не собрать
+                print('Skip building {}: bases not pushed and left on nodes {}, not usable for {}'.format(
+                    plan.name, ', '.join(sorted(url or 'local' for url in apart)), plan.arch))
+                self.to_build.pop(idx)
+                self._dequeue('Build', plan.name)
+                self.failed.add(plan.name)
+                self.manifest_check(plan.name, False)
+                continue
+            if failed:
+                self.to_build.pop(idx)
+                self._dequeue('Build', plan.name)
+                self.failed.add(plan.name)
+                print('Skip building {}: dependency {} failed'.format(plan.name, ', '.join(sorted(failed))))
+                self.manifest_check(plan.name, False)
+                continue
+            node = self._free_node(plan)
+            if not deps <= self.built or not node or (node[0] is None and not self._disk_admit()):
+                idx += 1
+                continue
+            node = node[0]
+            self.to_build.pop(idx)
+            self._dequeue('Build', plan.name)
+            print('Start building {}{}'.format(plan.name, ' on {}'.format(node) if node else ''))
             self.count += 1
-            self.building.append(docker_builder.Build(*cmd))
+            self.node_load[node] += 1
+            self.node_of[plan.name] = node
+            timings = self.cfg['build_timings'] and os.path.join(self.cfg['work_dir'], self.cfg['build_timings'])
+            self.building.append(docker_builder.Build(
+                plan.name, plan.path, plan.w_dir, plan.buildargs, plan.reuse, plan.cache, events=self._events,
+                timings=timings, base_url=node, contexts=self.contexts, size=bool(self.disk_root) and node is None))
+
+    def add_new_pull(self):
+        while len(self.pulling) < self.cfg['max_pull_t'] and len(self.pulls):
+            url, image = self.pulls.pop(0)
+            self._dequeue('Pull', image)
+            print('Start pulling {}{}'.format(image, ' on {}'.format(url) if url else ''))
+            self.pulling.append(docker_builder.Pull(image, self._events, base_url=url))
 
     def add_new_push(self):
         while self.cfg['auto_push'] and len(self.pushing) < self.cfg['max_push_t'] and len(self.builded):
             cmd = self.builded.pop(0)
+            self._dequeue('Push', cmd)
             print('Start pushing {}'.format(cmd))
-            self.pushing.append(docker_builder.Push(cmd))
+            self.pushing.append(docker_builder.Push(
+                cmd, self._events, retries=self.cfg['push_retries'], backoff=self.cfg['push_backoff'],
+                base_url=self.node_of.get(cmd)))
 
     @staticmethod
-    def _x_check(src: list, dst: list, name: str):
-        if not len(src):
-            return
-        check = True
-        while check:
-            check = False
-            for el in range(0, len(src)):
-                if src[el].status() is not None:
-                    i = src.pop(el)
-                    if not i.status():
-                        print('{} {} successful in {} sec'.format(name, i.tag, i.work_time))
-                        dst.append(i.tag)
-                    else:
-                        print('{} {} failed [{}]: {}'.format(name, i.tag, i.status(), i.err))
-                        print()
-                    check = True
+    def _report(worker, name: str) -> bool:
+        if not worker.status():
+            print('{} {} successful in {} sec'.format(name, worker.tag, worker.work_time))
+            return True
+        print('{} {} failed [{}]: {}'.format(name, worker.tag, worker.status(), worker.err))
+        print()
+        return False
+
+
+class Daemon:
+    """--daemon: клиент докера, авторизация, скомпилированные триггеры и кеш git-метаданных живут между запусками.
+    Запуск - по уведомлению о пуше (только затронутые цели) или раз в daemon_poll секунд (все цели)."""
+    def __init__(self, cfg, targets, git_triggers, args):
+        self.cfg = cfg
+        self.targets = targets
+        self.git_triggers = git_triggers
+        self.args = args
+        # Наборы url из уведомлений, None - остановиться
+        self._events = queue.Queue()
+        self._stop = False
+        self._known = {docker_builder.url_key(target['git']) for target in targets if 'git' in target}
+        self._known |= {docker_builder.url_key(trigger['git']) for trigger in git_triggers.values()}
+
+    def start(self):
+        webhook = None
+        if self.cfg['daemon_listen']:
+            webhook = docker_builder.WebhookServer(self.cfg['daemon_listen'], self.cfg['daemon_secret'], self.on_push)
+            print('Listen webhook on {}'.format(self.cfg['daemon_listen']))
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        try:
+            self._loop()
+        finally:
+            if webhook is not None:
+                webhook.close()
+            docker_builder.docker_logout()
+
+    def _on_signal(self, *_):
+        # Текущий запуск доработает до конца
+        self._stop = True
+        self._events.put(None)
+
+    def on_push(self, urls: set) -> bool:
+        keys = {docker_builder.url_key(url) for url in urls} & self._known
+        if keys:
+            self._events.put(keys)
+        return bool(keys)
+
+    def _loop(self):
+        next_poll = 0
+        while not self._stop:
+            try:
+                keys = self._events.get(timeout=max(0.0, next_poll - time.time()))
+            except queue.Empty:
+                # Пора полной проверки
+                self._run(None)
+                next_poll = time.time() + self.cfg['daemon_poll']
+                continue
+            if keys is None:
+                break
+            time.sleep(self.cfg['daemon_debounce'])
+            while not self._events.empty():
+                more = self._events.get()
+                if more is None:
+                    self._stop = True
                     break
+                keys |= more
+            self._run(keys)
 
-    def push_check(self):
-        if self.cfg['auto_push']:
-            self._x_check(self.pushing, self.pushed, 'Push')
+    def _run(self, keys: set or None):
+        targets, git_triggers = (self.targets, self.git_triggers) if keys is None else self._affected(keys)
+        if keys is not None:
+            print('Push to {}: {} targets'.format(', '.join(sorted(keys)), len(targets)))
+        builder = Builder(dict(self.cfg), targets, git_triggers, self.args, None)
+        try:
+            builder.start()
+        except Exception as e:
+            print('Internal error: {}'.format(e))
+        if self.cfg['prune'] and builder.count:
+            print('Run system prune...')
+            docker_builder.docker_system_prune()
 
-    def build_check(self):
-        self._x_check(self.building, self.builded, 'Build')
+    def _affected(self, keys: set) -> tuple:
+        # Цели из репов с пушем, цели на триггерах из таких репов и все, кто от них зависит.
+        # Реп триггеров синхронизируем только со всеми его целями, иначе остальные пропустят изменение.
+        git_triggers = {
+            name: trigger for name, trigger in self.git_triggers.items()
+            if docker_builder.url_key(trigger['git']) in keys
+        }
+        names = {'*' + name for trigger in git_triggers.values() for name in trigger['triggers']}
+        selected = []
+        for targets in self.targets:
+            if docker_builder.url_key(targets.get('git', '')) in keys:
+                selected.append(targets)
+            elif any(names & set(target.get('triggers', [])) for target in targets.get('targets', [])):
+                selected.append(targets)
+        registries = {target['registry'] for targets in selected for target in targets['targets']}
+        changed = True
+        while changed:
+            # Добавляем зависимых, пока находятся новые
+            changed = False
+            for targets in self.targets:
+                if targets in selected:
+                    continue
+                if any(dep.split(':', 1)[0] in registries
+                       for target in targets.get('targets', []) for dep in target.get('depends', [])):
+                    selected.append(targets)
+                    registries |= {target['registry'] for target in targets['targets']}
+                    changed = True
+        return [targets for targets in self.targets if targets in selected], git_triggers
 
 
-def json_loader(fp: open, type_: type):
+def json_loader(fp: open, type_: type, check=None):
+    # check - проверка содержимого, вернет список ошибок
     data = None
     try:
         data = json.load(fp)
         if type(data) is not type_:
             raise ValueError('Wrong object: \'{}\' is not \'{}\''.format(type(data).__name__, type_.__name__))
+        errors = check(data) if check else []
+        if errors:
+            raise ValueError('\n  '.join([''] + errors))
     except (json.JSONDecodeError, ValueError, IOError) as e:
         print('Error load {}: {}'.format(fp.name, str(e)))
         fp.close()
@@ -271,13 +769,28 @@ def cl_parse():
     parser.add_argument('-t', metavar='FILE', type=open, help='File with build targets, in json')
     parser.add_argument('-g', metavar='FILE', type=open, help='File with git-triggers, in json')
     parser.add_argument('-p', metavar='PATH', help='rewrite work_dir')
+    parser.add_argument('--trace', metavar='FILE', help='Write spans of the run in Chrome Trace Event format')
+    parser.add_argument('--profile', metavar='FILE', help='Write cProfile stats of the planning phase')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running: build on webhook push notifications and periodic polls. '
+                             'With --install - install a daemon unit instead of the timer')
     one = parser.add_mutually_exclusive_group()
     one.add_argument('--install', action='store_true', help='Install systemd unit')
     one.add_argument('--uninstall', action='store_true', help='Remove systemd unit')
     args = parser.parse_args()
-    cfg = json_loader(args.c, dict) if args.c else CFG
-    targets = json_loader(args.t, list) if args.t else TARGETS
-    git_triggers = json_loader(args.g, dict) if args.g else GIT_TRIGGERS
+    # Настройки из файла дополняют CFG, отсутствующие ключи берутся по умолчанию.
+    # Все проверяется здесь, один раз: планировщик получает уже правильные цели
+    cfg = dict(CFG, **json_loader(args.c, dict, lambda data: docker_builder.check_cfg(data, CFG))) if args.c else CFG
+    targets = json_loader(args.t, list, docker_builder.check_targets) if args.t else TARGETS
+    git_triggers = json_loader(args.g, dict, docker_builder.check_git_triggers) if args.g else GIT_TRIGGERS
+    for name, errors in (
+            ('CFG', docker_builder.check_cfg(cfg, CFG) if not args.c else []),
+            ('TARGETS', docker_builder.check_targets(targets) if not args.t else []),
+            ('GIT_TRIGGERS', docker_builder.check_git_triggers(git_triggers) if not args.g else []),
+    ):
+        if errors:
+            print('Error in {}:\n  {}'.format(name, '\n  '.join(errors)))
+            exit(1)
     if args.force:
         cfg['force'] = True
     if args.prune:
@@ -293,6 +806,9 @@ def cl_parse():
 
 def main():
     cl_data = cl_parse()
+    if cl_data[3].daemon and cl_data[4] is None:
+        Daemon(*cl_data[:4]).start()
+        return
     prune = cl_data[0]['prune']
     builder = Builder(*cl_data)
     try: